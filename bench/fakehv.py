@@ -0,0 +1,109 @@
+# shared plumbing for the fake VBoxManage and vmrun executables: every invocation is logged to calls.log, sleeps
+# for its configured latency, then reads and writes the simulated hypervisor's state under an exclusive lock
+#
+# the bench directory is taken from $BENCH_DIR and holds:
+#   config.json - {"latency": {"<kind>": seconds, ...}, "ip_delay": seconds}
+#   state.json  - the hypervisor's VMs, created by run_bench.py
+#   calls.log   - one line per process spawned: "<epoch> <tool> <kind>"
+import fcntl
+import json
+import os
+import sys
+import time
+
+bench_dir = os.environ.get('BENCH_DIR', os.getcwd())
+
+
+def load_config():
+    try:
+        fh = open(os.path.join(bench_dir, 'config.json'))
+        try:
+            return json.load(fh)
+        finally:
+            fh.close()
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+config = load_config()
+
+
+# kinds are looked up most specific first, so "guestproperty wait" can be slower than "guestproperty"
+def latency(kind):
+    latencies = config.get('latency', {})
+    words = kind.split(' ')
+    for i in range(len(words), 0, -1):
+        if ' '.join(words[:i]) in latencies:
+            return float(latencies[' '.join(words[:i])])
+    return float(latencies.get('*', 0))
+
+
+def ip_delay():
+    return float(config.get('ip_delay', 0))
+
+
+def begin(tool, kind):
+    fh = open(os.path.join(bench_dir, 'calls.log'), 'a')
+    fh.write('%.6f %s %s\n' % (time.time(), tool, kind))
+    fh.close()
+    time.sleep(latency(kind))
+
+
+class State():
+    def __init__(self, name):
+        self.path = os.path.join(bench_dir, name)
+        self.lock_file = None
+        self.data = None
+
+    def __enter__(self):
+        self.lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        fh = open(self.path)
+        self.data = json.load(fh)
+        fh.close()
+        return self.data
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                tmp_path = self.path + '.' + str(os.getpid())
+                fh = open(tmp_path, 'w')
+                json.dump(self.data, fh)
+                fh.close()
+                os.rename(tmp_path, self.path)
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+
+
+# as in Fusion, the vmx of a suspended VM names the file its state was saved to
+def set_checkpoint(vmx, value):
+    fh = open(vmx)
+    lines = [line for line in fh.readlines() if not line.lower().startswith('checkpoint.vmstate')]
+    fh.close()
+    fh = open(vmx, 'w')
+    fh.write(''.join(lines) + 'checkpoint.vmState = "%s"\n' % value)
+    fh.close()
+
+
+# powers on a VM of the fake vmrun's state, giving it the next address, or resumes it with the one it had
+def power_on(state, vmx):
+    suspended = state.setdefault('suspended', {})
+    if vmx in suspended:
+        state['running'][vmx] = suspended.pop(vmx)
+        set_checkpoint(vmx, '')
+    elif vmx not in state['running']:
+        state['starts'] = state.get('starts', 0) + 1
+        state['running'][vmx] = dict(started=time.time(),
+                                     ip='172.%d.%d.%d' % (16 + state['starts'] // 62500 % 16,
+                                                          state['starts'] // 250 % 250, state['starts'] % 250 + 2))
+
+
+def suspend(state, vmx):
+    state.setdefault('suspended', {})[vmx] = state['running'].pop(vmx)
+    set_checkpoint(vmx, os.path.basename(vmx)[:-len('.vmx')] + '.vmss')
+
+
+def fail(message, returncode=1):
+    sys.stdout.write(message + '\n')
+    sys.exit(returncode)
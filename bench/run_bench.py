@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# drives vbox_instance and fusion_instance against the fake VBoxManage, vmrun and vmrest in this directory through three
+# scenarios, each a batch task run through the module's run_task as a controller would run it - cold provisioning of
+# the targets, an idempotent rerun against the same targets, and teardown - and reports per scenario the throughput,
+# per-VM latency percentiles, processes spawned per VM and how long after the guest got its IP address the module saw
+# it (ip lag). With --pool-size the cold provisioning claims standby VMs booted beforehand, and refills the pool.
+#
+#   python bench/run_bench.py --vms 20 --inventory 1000 --latency clonevm=0.3 startvm=0.5 --ip-delay 2
+#
+# results can be saved with --save and later compared with --compare, which exits with status 1 when spawns per VM,
+# ip lag or throughput have regressed against a baseline of the same workload. The modules import Ansible's
+# module_utils, so the Python running the benchmark needs Ansible installed, as when the modules run under Ansible.
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from time import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+sys.path.insert(0, os.path.join(os.path.dirname(bench_dir), 'module_utils'))
+
+import fusion_instance
+import vbox_instance
+from vmmanager_controller import TaskExit, TaskModule
+
+scenarios = [('cold', 'running'), ('rerun', 'running'), ('teardown', 'absent')]
+
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(share * len(values)))], 4)
+
+
+def spawned(work_dir):
+    try:
+        fh = open(os.path.join(work_dir, 'calls.log'))
+    except IOError:
+        return 0
+    try:
+        return sum(1 for call_line in fh)
+    finally:
+        fh.close()
+
+
+def write_json(path, data):
+    fh = open(path, 'w')
+    json.dump(data, fh)
+    fh.close()
+
+
+# lag between the guest getting its address (ip_delay after its boot) and the end of the module's wait for it
+def ip_lags(timings, ip_delay):
+    booted = {}
+    lags = []
+    for record in timings['phases']:
+        end = record['start'] + record['duration']
+        if record['phase'] == 'boot':
+            booted[record['vm']] = end
+        elif record['phase'] == 'ip_wait' and record['vm'] in booted:
+            lags.append(max(end - booted[record['vm']] - ip_delay, 0))
+    return lags
+
+
+# stands in for the AnsibleModule of a task, as the controller's does, and keeps the threads refilling the warm pool
+# so that they can be waited for before the next scenario
+class BenchModule(TaskModule):
+    def __init__(self, params):
+        TaskModule.__init__(self, params)
+        self.detached = []
+
+    def run_detached(self, function):
+        thread = threading.Thread(target=function)
+        thread.start()
+        self.detached.append(thread)
+
+
+# runs a task through the module's run_task and returns whether it failed and its result
+def run_task(module, params):
+    task = BenchModule(params)
+    try:
+        module.run_task(task)
+    except TaskExit as e:
+        return e.failed, e.result, task
+    return True, dict(msg='run_task returned without a result'), task
+
+
+def run_scenario(work_dir, module, params, options):
+    latencies = {}
+    batch = module.run_batch
+
+    # times each target's worker in the module's own batch, which the pool's refill also goes through
+    def timed_batch(targets, worker, max_parallel):
+        def timed_worker(target_image):
+            start = time()
+            try:
+                return worker(target_image)
+            finally:
+                latencies[target_image] = time() - start
+
+        return batch(targets, timed_worker, max_parallel)
+
+    targets = params['target_images']
+    calls = spawned(work_dir)
+    module.run_batch = timed_batch
+    try:
+        start = time()
+        failed, result, task = run_task(module, params)
+        wall = time() - start
+        # processes spawned refilling the pool count towards the scenario whose claims emptied it
+        for thread in task.detached:
+            thread.join()
+    finally:
+        module.run_batch = batch
+    spawns = spawned(work_dir) - calls
+    results = result.get('results', [])
+    errors = [vm_result['msg'] for vm_result in results if vm_result['failed']]
+    if failed and not errors:
+        errors = [result['msg']]
+    lags = ip_lags(result.get('timings', dict(phases=[])), options.ip_delay)
+    latencies = [latencies[target] for target in targets if target in latencies]
+    return dict(vms=len(targets), failed=failed and max(len(errors), 1) or 0, errors=sorted(set(errors))[:3],
+                wall=round(wall, 3), throughput=round(len(targets) / wall, 3),
+                latency_p50=percentile(latencies, 0.5),
+                latency_p90=percentile(latencies, 0.9),
+                latency_p99=percentile(latencies, 0.99),
+                spawns=spawns, spawns_per_vm=round(float(spawns) / len(targets), 2),
+                ip_lag_p50=percentile(lags, 0.5), ip_lag_p90=percentile(lags, 0.9))
+
+
+def setup_vbox(work_dir, options):
+    vms = dict(('filler-%05d' % i, dict(uuid='00000000-0000-0000-0000-%012d' % i, snapshots=[], started=0,
+                                        state=i < options.inventory * options.running_share and 'running' or
+                                        'poweroff', ip='10.255.%d.%d' % (i // 250 % 256, i % 250 + 2),
+                                        settings=dict(memory='1024', nic1='nat')))
+               for i in range(options.inventory))
+    vms['golden-image'] = dict(uuid='00000000-0000-0000-0001-000000000000', snapshots=[], started=0,
+                               state='poweroff', ip='10.254.0.2', settings=dict(memory='512', nic1='nat'))
+    write_json(os.path.join(work_dir, 'state.json'),
+               dict(vms=vms, interfaces=dict(bridged=['en0: Wi-Fi (AirPort)', 'bridge0'], hostonly=['vboxnet0'])))
+    return vbox_instance, dict(vboxmanage=os.path.join(bench_dir, 'VBoxManage'), source_image='golden-image',
+                               memsize='512', network_type='bridged', bridge_adapter='en0.+|eth.+',
+                               hostonly_adapter='.+', interface_cache=os.path.join(work_dir, 'interfaces.json'),
+                               interface_cache_ttl=300, ip_timeout=60, ip_nic=0, backend='cli')
+
+
+def setup_fusion(work_dir, options):
+    vmbasedir = os.path.join(work_dir, 'Virtual Machines')
+    running = {}
+    for i in range(options.inventory + 1):
+        name = i < options.inventory and 'filler-%05d' % i or 'golden-image'
+        os.makedirs(os.path.join(vmbasedir, name + '.vmwarevm'))
+        vmx = os.path.join(vmbasedir, name + '.vmwarevm', name + '.vmx')
+        fh = open(vmx, 'w')
+        fh.write('.encoding = "UTF-8"\ndisplayName = "%s"\nmemsize = "512"\nethernet0.present = "TRUE"\n'
+                 'ethernet0.addressType = "generated"\nethernet0.generatedAddress = "00:0c:29:00:%02x:%02x"\n'
+                 'ethernet0.generatedAddressOffset = "0"\n' % (name, i // 256 % 256, i % 256))
+        fh.close()
+        if i < options.inventory * options.running_share:
+            running[vmx] = dict(started=0, ip='172.31.%d.%d' % (i // 250 % 256, i % 250 + 2))
+    write_json(os.path.join(work_dir, 'vmrun.json'), dict(running=running))
+    params = dict(vmrunexe=os.path.join(bench_dir, 'vmrun'), vmbasedir=vmbasedir, source_image='golden-image',
+                  memsize='512', numvcpus=None, clone_type=options.clone_type, clone_engine='auto', headless='yes',
+                  ip_resolver='auto', ip_nic=None, backend='vmrun', vmrest_url=None, vmrest_username=None,
+                  vmrest_password=None, dhcp_leases=[], library_cache=os.path.join(work_dir, 'library.json'))
+    if options.fusion_backend == 'vmrest':
+        # the fake vmrest exits once run_module removes the work directory
+        server = subprocess.Popen([sys.executable, os.path.join(bench_dir, 'vmrest')], stdout=subprocess.PIPE,
+                                  universal_newlines=True)
+        params.update(backend='vmrest', vmrest_url='http://127.0.0.1:' + server.stdout.readline().strip())
+    return fusion_instance, params
+
+
+def run_module(name, setup, options):
+    work_dir = tempfile.mkdtemp(prefix='vmmanager-bench-')
+    try:
+        write_json(os.path.join(work_dir, 'config.json'), dict(latency=options.latency, ip_delay=options.ip_delay))
+        os.environ['BENCH_DIR'] = work_dir
+        module, params = setup(work_dir, options)
+        # the rest of the module's arguments, as their defaults, with its state files kept in the work directory
+        params.update(target_image=None, target_images=None, target_pattern=None, max_parallel=options.parallel,
+                      pool_size=options.pool_size, pool_state=os.path.join(work_dir, 'pool.json'), admission=False,
+                      admission_state=os.path.join(work_dir, 'admission.json'), max_memory_share=0.8,
+                      boots_per_cpu=0.5, admission_timeout=600, wait_for_ready=options.wait_for_ready,
+                      wait_for_port=22, ready_timeout=300, trace_file=None, stop_timeout=0, controller_socket=None,
+                      suspend_state=os.path.join(work_dir, 'suspended.json'))
+        if options.pool_size:
+            failed, result, task = run_task(module, dict(params, state='pooled'))
+            if failed:
+                raise Exception('failed to fill the warm pool: ' + result['msg'])
+        targets = ['bench-%04d' % i for i in range(options.vms)]
+        results = {}
+        for scenario, state in scenarios:
+            results[scenario] = run_scenario(work_dir, module, dict(params, state=state, target_images=targets),
+                                             options)
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def report(results):
+    columns = ['vms', 'failed', 'wall', 'throughput', 'latency_p50', 'latency_p90', 'latency_p99', 'spawns_per_vm',
+               'ip_lag_p50', 'ip_lag_p90']
+    print('%-8s %-9s ' % ('module', 'scenario') + ' '.join('%13s' % column for column in columns))
+    for module_name in sorted(results):
+        for scenario, state in scenarios:
+            result = results[module_name][scenario]
+            print('%-8s %-9s ' % (module_name, scenario) +
+                  ' '.join('%13s' % ('-' if result[column] is None else result[column]) for column in columns))
+            for error in result['errors']:
+                print('    error: ' + error)
+
+
+# a regression is more processes spawned per VM, a later ip address or lower throughput than the baseline allows
+def compare(results, baseline, tolerance):
+    regressions = []
+    for module_name in sorted(results):
+        for scenario, state in scenarios:
+            base = baseline.get(module_name, {}).get(scenario)
+            if not base:
+                continue
+            result = results[module_name][scenario]
+            label = module_name + ' ' + scenario + ': '
+            if result['spawns_per_vm'] > base['spawns_per_vm'] * (1 + tolerance):
+                regressions.append(label + 'spawns per VM %s -> %s' % (base['spawns_per_vm'], result['spawns_per_vm']))
+            if base['ip_lag_p90'] is not None and result['ip_lag_p90'] is not None and \
+                    result['ip_lag_p90'] > base['ip_lag_p90'] * (1 + tolerance) + 0.25:
+                regressions.append(label + 'ip lag p90 %ss -> %ss' % (base['ip_lag_p90'], result['ip_lag_p90']))
+            if result['throughput'] < base['throughput'] * (1 - tolerance):
+                regressions.append(label + 'throughput %s -> %s VMs/s' % (base['throughput'], result['throughput']))
+    return regressions
+
+
+def parse_latency(value):
+    kind, seconds = value.rsplit('=', 1)
+    return kind.replace('_', ' '), float(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark vbox_instance and fusion_instance against fake '
+                                                 'hypervisors')
+    parser.add_argument('--modules', nargs='+', choices=['vbox', 'fusion'], default=['vbox', 'fusion'])
+    parser.add_argument('--vms', type=int, default=10, help='target VMs provisioned per scenario')
+    parser.add_argument('--inventory', type=int, default=100,
+                        help='VMs already registered with the hypervisor (e.g. 10 to 5000)')
+    parser.add_argument('--running-share', type=float, default=0.5, help='share of the inventory that is running')
+    parser.add_argument('--parallel', type=int, default=4, help='batch workers, as max_parallel')
+    parser.add_argument('--clone-type', choices=['linked', 'full'], default='linked',
+                        help='clone_type for fusion_instance; full clones copy the bundle with the clone engine')
+    parser.add_argument('--fusion-backend', choices=['vmrun', 'vmrest'], default='vmrun',
+                        help='backend for fusion_instance; vmrest is served by the fake vmrest in bench/')
+    parser.add_argument('--pool-size', type=int, default=0,
+                        help='standby VMs booted before the scenarios, for the cold provisioning to claim')
+    parser.add_argument('--wait-for-ready', action='store_true',
+                        help='wait for the guests to accept connections on port 22, as wait_for_ready')
+    parser.add_argument('--latency', nargs='*', type=parse_latency, default=[], metavar='KIND=SECONDS',
+                        help='latency per subcommand, e.g. clonevm=0.3 guestproperty_get=0.05 start=1 *=0.01')
+    parser.add_argument('--ip-delay', type=float, default=1.0,
+                        help='seconds from a guest\'s start until it reports its IP address')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slack allowed against the baseline')
+    options = parser.parse_args()
+    options.latency = dict(options.latency)
+
+    setups = dict(vbox=setup_vbox, fusion=setup_fusion)
+    results = dict((module_name, run_module(module_name, setups[module_name], options))
+                   for module_name in options.modules)
+    report(results)
+    # results are only comparable between runs of the same workload
+    workload = dict(vms=options.vms, inventory=options.inventory, running_share=options.running_share,
+                    parallel=options.parallel, clone_type=options.clone_type, latency=options.latency,
+                    ip_delay=options.ip_delay, fusion_backend=options.fusion_backend,
+                    pool_size=options.pool_size, wait_for_ready=options.wait_for_ready)
+    if options.save:
+        write_json(options.save, dict(workload=workload, results=results))
+    if options.compare:
+        fh = open(options.compare)
+        baseline = json.load(fh)
+        fh.close()
+        if baseline['workload'] != workload:
+            print('baseline workload differs: ' + json.dumps(baseline['workload'], sort_keys=True))
+            sys.exit(2)
+        regressions = compare(results, baseline['results'], options.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,41 +19,234 @@ options:
     default: '~/Documents/Virtual Machines.localized'
   source_image:
     description:
-      - name of the source VM to clone from
+      - name of the source VM to clone from, or a pattern matching exactly one VM bundle in I(vmbasedir)
     required: true
   target_image:
     description:
       - name for the target VM
-    required: true
+      - required unless I(target_images) is given
+    required: false
+  target_images:
+    description:
+      - list of target VM names to provision concurrently in one call
+      - mutually exclusive with I(target_image)
+    required: false
+  target_pattern:
+    description:
+      - with I(state=absent), tear down every VM bundle in I(vmbasedir) whose whole name matches this regular
+        expression, like I(target_images), or with I(state=suspended) suspend every running one; bundles matched by
+        the I(source_image) pattern and standby VMs of the warm pool are left alone
+      - mutually exclusive with I(target_image) and I(target_images)
+    required: false
+  max_parallel:
+    description:
+      - maximum number of VMs handled at the same time when I(target_images) or I(target_pattern) is given; when
+        tearing down more VMs than this, their bundles are moved aside once stopped and deleted in the background
+    required: false
+    default: 4
   memsize:
     description:
       - amount of physical memory (in MB) to allocate to the VM
     required: false
     default: '512'
+  numvcpus:
+    description:
+      - number of virtual CPUs to give a new clone; the source's setting is kept when omitted
+    required: false
+  library_cache:
+    description:
+      - file caching the index of VM bundles in I(vmbasedir); the index is rebuilt when the directory changes
+    required: false
+    default: '~/.ansible/tmp/fusion_library.json'
   clone_type:
     description:
       - the type of clone to perform
     required: false
     default: 'linked'
     choices: ['linked','full']
+  clone_engine:
+    description:
+      - how full clones are made; C(auto) copies the source bundle itself, with copy-on-write clones of its files
+        where the filesystem supports them (APFS, btrfs, XFS) and otherwise a copy that keeps sparse disks sparse;
+        C(vmrun) leaves the copy to vmrun. A running source is always cloned by vmrun.
+    required: false
+    default: 'auto'
+    choices: ['auto','vmrun']
+  ip_resolver:
+    description:
+      - how to find the guest's IP address; C(leases) looks up the MAC addresses from the target vmx in the
+        host's vmnet dhcpd.leases files, C(vmrun) asks VMware Tools in the guest (through vmrest with
+        I(backend=vmrest)), C(auto) tries the leases first
+    required: false
+    default: 'auto'
+    choices: ['auto','leases','vmrun']
+  ip_nic:
+    description:
+      - index N of the vmx C(ethernetN) NIC whose leased address is returned as the C(ipaddress) fact; vmrun
+        only reports the guest's primary address, so with I(ip_nic) the address always comes from the leases.
+        Every NIC is returned in the C(nics) fact
+    required: false
+    default: null
+  dhcp_leases:
+    description:
+      - list of vmnet dhcpd.leases files (glob patterns allowed) to read when resolving IP addresses from leases
+    required: false
+    default: ['/var/db/vmware/vmnet-dhcpd-vmnet*.leases', '/etc/vmware/vmnet*/dhcpd/dhcpd.leases']
   headless:
     description:
       - with or without gui
     required: false
     default: 'no'
     choices: ['yes','no']
+  pool_size:
+    description:
+      - with I(state=pooled), the number of cloned and booted standby VMs to keep ready for I(source_image);
+        C(state=running) then claims a ready standby VM for a new target instead of cloning and booting one,
+        and a replacement is built in the background
+    required: false
+    default: 0
+  pool_state:
+    description:
+      - file recording the warm pools and which standby VM each target instance has claimed
+    required: false
+    default: '~/.ansible/tmp/fusion_pool.json'
+  admission:
+    description:
+      - queue clones and boots, across all concurrent runs on this host, until the host has capacity for them
+    required: false
+    default: 'no'
+    choices: ['yes','no']
+  admission_state:
+    description:
+      - file through which concurrent runs share the admission queue, boots in progress and committed guest memory
+    required: false
+    default: '~/.ansible/tmp/vmmanager_admission.json'
+  max_memory_share:
+    description:
+      - with I(admission), the share of host RAM that guest memory committed by this module may use
+    required: false
+    default: 0.8
+  boots_per_cpu:
+    description:
+      - with I(admission), the number of concurrent boots allowed per host CPU (at least one boot is allowed)
+    required: false
+    default: 0.5
+  admission_timeout:
+    description:
+      - with I(admission), seconds to wait in the queue before failing
+    required: false
+    default: 600
+  wait_for_ready:
+    description:
+      - after the IP address is known, wait until the guest accepts TCP connections on I(wait_for_port); with
+        I(target_images) all VMs are probed at once
+    required: false
+    default: 'no'
+    choices: ['yes','no']
+  wait_for_port:
+    description:
+      - port probed by I(wait_for_ready), and after a resume to check that the guest kept its address
+    required: false
+    default: 22
+  ready_timeout:
+    description:
+      - with I(wait_for_ready), seconds to wait for the port before failing
+    required: false
+    default: 300
+  trace_file:
+    description:
+      - file to which every hypervisor command and provisioning phase (inventory, clone, configure, boot, resume,
+        ip_wait, suspend, delete) is appended as a JSON line with its duration; the same records are always
+        returned as C(timings)
+    required: false
+    default: null
+  stop_timeout:
+    description:
+      - seconds to let the guest shut down through VMware Tools (a soft stop) before stopping it hard; 0 leaves the
+        stop to vmrun's default, or with I(backend=vmrest) powers the VM off at once
+    required: false
+    default: 0
+  backend:
+    description:
+      - how VMs are listed, powered on and off, asked for their IP address and deleted; C(vmrest) talks to
+        VMware's vmrest REST API over one kept-alive connection instead of starting vmrun for each query, and
+        falls back to C(vmrun) when vmrest cannot be reached. Clones, VMs started with a window and the labels of
+        claimed standby VMs are always left to vmrun; vmrest deletes bundles itself, without I(max_parallel)'s
+        background deletes
+    required: false
+    default: 'vmrun'
+    choices: ['vmrun','vmrest']
+  vmrest_url:
+    description:
+      - URL of vmrest, as started with C(vmrest) on the host
+    required: false
+    default: 'http://127.0.0.1:8697'
+  vmrest_username:
+    description:
+      - user name set up with C(vmrest -C)
+    required: false
+  vmrest_password:
+    description:
+      - password set up with C(vmrest -C)
+    required: false
+  controller_socket:
+    description:
+      - Unix socket of a vmmanager_controller to hand the task to; the controller keeps the parsed DHCP leases and
+        the vmrest connection warm between tasks. When no controller is listening, the task runs in the module's
+        own process
+    required: false
+    default: '~/.ansible/tmp/vmmanager.sock'
+  suspend_state:
+    description:
+      - state file in which the address of every VM suspended with I(state=suspended) is kept; when the VM is next
+        started, it resumes from its suspended state and that address is used as soon as the guest accepts
+        connections on I(wait_for_port) again, rather than waiting for a DHCP lease or VMware Tools
+    required: false
+    default: '~/.ansible/tmp/fusion_suspended.json'
   state:
     description:
-      - create or terminate instances
+      - create or terminate instances, maintain a warm pool of standby instances, or suspend running instances to
+        disk with C(suspended); C(running) resumes a suspended instance, which is reported as C(resumed)
     required: false
     default: 'running'
-    choices: ['running', 'absent']
+    choices: ['running', 'absent', 'pooled', 'suspended']
 '''
 
 EXAMPLES = '''
 # Create a clone image called web01.localdomain from a source image called base-image-centos6
 - fusion_instance: source_image='base-image-centos6' target_image='web01.localdomain'
 
+# Provision a batch of VMs concurrently, four at a time, in a single task
+- fusion_instance:
+    source_image: packer-vmware-base-centos-6.6
+    target_images: ['web01.localdomain', 'web02.localdomain', 'web03.localdomain']
+    max_parallel: 4
+  register: batch_result
+
+# Keep three booted standby VMs ready, so that later state=running tasks for new targets return in seconds
+- fusion_instance: source_image=packer-vmware-base-centos-6.6 state=pooled pool_size=3
+
+# Tear down a lab of web VMs, 20 at a time, giving each a minute to shut down cleanly
+- fusion_instance:
+    source_image: packer-vmware-base-centos-6.6
+    target_pattern: 'web\d+\.localdomain'
+    state: absent
+    max_parallel: 20
+    stop_timeout: 60
+
+# Suspend a lab VM at the end of the day, and resume it with its address the next morning
+- fusion_instance: source_image=packer-vmware-base-centos-6.6 target_image=web01.localdomain state=suspended
+- fusion_instance: source_image=packer-vmware-base-centos-6.6 target_image=web01.localdomain state=running
+
+# Provision through vmrest, which must be running on the host (vmrest -C sets its credentials)
+- fusion_instance:
+    source_image: packer-vmware-base-centos-6.6
+    target_images: ['web01.localdomain', 'web02.localdomain', 'web03.localdomain']
+    headless: 'yes'
+    backend: vmrest
+    vmrest_username: ansible
+    vmrest_password: "{{ vmrest_password }}"
+
 # Complete playbook to provision a couple of VMs, set their hostname and install httpd...
 - hosts: localhost
   connection: local
@@ -83,173 +276,1086 @@ EXAMPLES = '''
 '''
 
 
+DEFAULT_DHCP_LEASES = [
+    '/var/db/vmware/vmnet-dhcpd-vmnet*.leases',
+    '/etc/vmware/vmnet*/dhcpd/dhcpd.leases',
+]
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+COPY_CHUNK = 1024 * 1024
+# bundles moved aside by a teardown until they are deleted; hidden, and no longer ending in .vmwarevm
+DOOMED_PREFIX = '.deleting-'
+# seconds a resumed guest has to accept connections at its old address before its address is waited for instead
+RESUME_PROBE_TIMEOUT = 10
+
+
+# a .vmx file as an ordered list of lines, with its key = "value" entries indexed by lower-cased key (vmx keys
+# are case-insensitive); edits are applied in memory and written back in one atomic replace
+class VMX():
+    def __init__(self, path):
+        self.path = path
+        self.entry_regex = re.compile('^\s*([^=#\s]+)\s*=\s*"(.*)"\s*$')
+        fh = open(path, 'r')
+        self.lines = [config_line.rstrip('\n') for config_line in fh.readlines()]
+        fh.close()
+
+    def entries(self):
+        for (index, config_line) in enumerate(self.lines):
+            match = self.entry_regex.match(config_line)
+            if match:
+                yield index, match.group(1), match.group(2)
+
+    def as_dict(self):
+        return dict((key.lower(), value) for (index, key, value) in self.entries())
+
+    def get(self, key, default=None):
+        return self.as_dict().get(key.lower(), default)
+
+    def set(self, key, value):
+        for (index, current_key, current_value) in self.entries():
+            if current_key.lower() == key.lower():
+                self.lines[index] = current_key + ' = "' + value + '"'
+                return
+        self.lines.append(key + ' = "' + value + '"')
+
+    def remove(self, key_regex):
+        key_regex = re.compile('^' + key_regex + '$', re.IGNORECASE)
+        removed = [index for (index, key, value) in self.entries() if key_regex.match(key)]
+        self.lines = [config_line for (index, config_line) in enumerate(self.lines) if index not in removed]
+
+    def nics(self):
+        config = self.as_dict()
+        return sorted(set(re.match('^(ethernet\d+)\.', key).group(1) for key in config
+                          if re.match('^ethernet\d+\.', key)))
+
+    def save(self):
+        tmp_path = self.path + '.' + str(os.getpid()) + '.tmp'
+        fh = open(tmp_path, 'w')
+        fh.write('\n'.join(self.lines) + '\n')
+        fh.close()
+        os.rename(tmp_path, self.path)
+
+
+# the guest's NICs in index order as configured by the present ethernetN entries of a vmx
+def vmx_nics(vmx_path):
+    config = VMX(vmx_path).as_dict()
+    nics = []
+    for key in config:
+        match = re.match('^ethernet(\d+)\.present$', key)
+        if match and config[key].lower() == 'true':
+            prefix = 'ethernet' + match.group(1) + '.'
+            mac = config.get(prefix + 'address') or config.get(prefix + 'generatedaddress')
+            nics.append(dict(index=int(match.group(1)), mac=mac and mac.lower(),
+                             connection_type=config.get(prefix + 'connectiontype', 'bridged'),
+                             status=config.get(prefix + 'startconnected', 'true').lower() == 'true' and 'up' or 'down'))
+    return sorted(nics, key=lambda nic: nic['index'])
+
+
+def vmx_mac_addresses(vmx_path):
+    return [nic['mac'] for nic in vmx_nics(vmx_path) if nic['mac']]
+
+
+# copies source to target as cheaply as the filesystem allows and returns how: a copy-on-write clone (FICLONE on
+# Linux, clonefile through cp -c on macOS), else copy_file_range, else a chunked copy; the last two copy only the
+# source's data regions and leave all-zero chunks unwritten, so that sparse disks stay sparse
+def clone_file(source, target):
+    if sys.platform == 'darwin':
+        devnull = open(os.devnull, 'w')
+        try:
+            if subprocess.call(['/bin/cp', '-c', source, target], stdout=devnull, stderr=devnull) == 0:
+                return 'clonefile'
+        finally:
+            devnull.close()
+    src = open(source, 'rb')
+    try:
+        dst = open(target, 'wb')
+        try:
+            if sys.platform.startswith('linux'):
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    return 'reflink'
+                except (IOError, OSError):
+                    pass
+            return copy_data(src, dst)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+
+# (offset, end) of each region of the file holding data, or the whole file where holes cannot be found
+def data_regions(fh, size):
+    seek_data = getattr(os, 'SEEK_DATA', None)
+    offset = 0
+    while offset < size:
+        if seek_data is None:
+            yield offset, size
+            return
+        try:
+            offset = os.lseek(fh.fileno(), offset, seek_data)
+            end = os.lseek(fh.fileno(), offset, os.SEEK_HOLE)
+        except OSError as e:
+            # ENXIO: no data beyond offset; EINVAL: the filesystem cannot tell, so everything is data
+            if e.errno == errno.EINVAL:
+                yield offset, size
+            return
+        yield offset, end
+        offset = end
+
+
+def copy_data(src, dst):
+    size = os.fstat(src.fileno()).st_size
+    method = hasattr(os, 'copy_file_range') and 'copy_file_range' or 'sparse'
+    zero_chunk = b'\0' * COPY_CHUNK
+    for offset, end in data_regions(src, size):
+        while offset < end:
+            length = min(COPY_CHUNK, end - offset)
+            if method == 'copy_file_range':
+                try:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), length, offset, offset)
+                    if copied > 0:
+                        offset += copied
+                        continue
+                except OSError:
+                    pass
+                # copy_file_range cannot copy between these files, so the rest is copied chunk by chunk
+                method = 'sparse'
+            src.seek(offset)
+            chunk = src.read(length)
+            if not chunk:
+                break
+            if chunk != zero_chunk[:len(chunk)]:
+                dst.seek(offset)
+                dst.write(chunk)
+            offset += len(chunk)
+    dst.truncate(size)
+    return method
+
+
+# makes a full clone of the powered-off VM at source_vmx as target_vmx, by cloning every file of the source bundle
+# except its locks, logs and suspended state; the disks keep their file names, the vmx is renamed after the target
+# and told to take new UUIDs, and disk descriptors drop the source's image UUIDs. Returns the copy methods used.
+def clone_bundle(source_vmx, target_vmx):
+    source_dir = os.path.dirname(source_vmx)
+    target_dir = os.path.dirname(target_vmx)
+    # the bundle is assembled under a name that BundleIndex does not take for a bundle, and renamed when complete
+    tmp_dir = os.path.join(os.path.dirname(target_dir), '.' + os.path.basename(target_dir) + '.' + str(os.getpid()))
+    os.mkdir(tmp_dir)
+    methods = set()
+    try:
+        for file_name in os.listdir(source_dir):
+            path = os.path.join(source_dir, file_name)
+            if not os.path.isfile(path) or re.search('\.(lck|log|vmem|vmss)$', file_name) or \
+                    re.match('^vmware(-\d+)?\.log$', file_name):
+                continue
+            if path == source_vmx:
+                target_path = os.path.join(tmp_dir, os.path.basename(target_vmx))
+            else:
+                target_path = os.path.join(tmp_dir, file_name)
+            methods.add(clone_file(path, target_path))
+            if file_name.endswith('.vmdk') and os.path.getsize(path) < 65536:
+                rewrite_disk_descriptor(target_path)
+        vmx = VMX(os.path.join(tmp_dir, os.path.basename(target_vmx)))
+        for key in ('uuid\.bios', 'uuid\.location', 'vc\.uuid', 'checkpoint\.vmState'):
+            vmx.remove(key)
+        vmx.set('uuid.action', 'create')
+        vmx.save()
+        os.rename(tmp_dir, target_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return methods
+
+
+# a text descriptor (as opposed to a binary extent) of a disk copied from another VM, which drops the other disk's
+# image UUID so that VMware gives the copy an identity of its own
+def rewrite_disk_descriptor(path):
+    fh = open(path, 'rb')
+    content = fh.read()
+    fh.close()
+    if not content.startswith(b'# Disk DescriptorFile'):
+        return
+    content = b''.join(descriptor_line for descriptor_line in content.splitlines(True)
+                       if not descriptor_line.startswith(b'ddb.uuid.image'))
+    fh = open(path + '.tmp', 'wb')
+    fh.write(content)
+    fh.close()
+    os.rename(path + '.tmp', path)
+
+
+# the VM bundles directly under vmbasedir, cached on disk and rebuilt only when the directory's mtime changes
+class BundleIndex():
+    def __init__(self, vmbasedir, cache_path):
+        self.vmbasedir = vmbasedir
+        self.cache_path = cache_path
+        self.bundles = None
+
+    def scan(self):
+        bundles = {}
+        for bundle in os.listdir(self.vmbasedir):
+            if bundle.endswith('.vmwarevm'):
+                vmx_files = glob.glob(os.path.join(self.vmbasedir, bundle, '*.vmx'))
+                if len(vmx_files) == 1:
+                    bundles[bundle[:-len('.vmwarevm')]] = vmx_files[0]
+        return bundles
+
+    def load(self):
+        if self.bundles is None:
+            mtime = os.stat(self.vmbasedir).st_mtime
+            with StateFile(self.cache_path) as cache:
+                entry = cache.get(self.vmbasedir)
+                if not entry or entry['mtime'] != mtime:
+                    entry = dict(mtime=mtime, bundles=self.scan())
+                    cache[self.vmbasedir] = entry
+            self.bundles = entry['bundles']
+        return self.bundles
+
+    def names(self):
+        return list(self.load())
+
+    def match(self, pattern):
+        return [name for name in self.load() if re.match('.*' + pattern + '.*', name)]
+
+    # an exact bundle name wins, otherwise the pattern has to match exactly one bundle, as in vbox_instance
+    def find(self, pattern):
+        bundles = self.load()
+        if pattern in bundles:
+            return bundles[pattern]
+        candidates = self.match(pattern)
+        if len(candidates) > 1:
+            raise Exception('Error: found more than one candidate for source image pattern: ".*' + pattern + '.*"')
+        elif len(candidates) == 0:
+            raise Exception('Error: cannot find a single candidate for source image pattern: ".*' + pattern + '.*"')
+        return bundles[candidates[0]]
+
+
+# index of MAC address -> leased IP built from the vmnet dhcpd.leases files, which dhcpd only appends to
+# between rewrites; each refresh reads just the bytes added since the previous one
+class LeaseIndex():
+    def __init__(self, lease_files):
+        self.lease_files = lease_files
+        self.lock = threading.Lock()
+        self.lease_regex = re.compile('lease\s+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s*\{([^}]*)\}')
+        self.mac_regex = re.compile('hardware ethernet ([0-9a-fA-F:]+);')
+        self.ends_regex = re.compile('ends \d (\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2});')
+        self.files = {}
+
+    def refresh(self):
+        paths = []
+        for lease_file in self.lease_files:
+            paths.extend(glob.glob(lease_file))
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state = self.files.get(path)
+            # a rewritten file gets a new inode or shrinks, and has to be read again from the start
+            if state is None or state['inode'] != stat.st_ino or stat.st_size < state['offset']:
+                state = dict(inode=stat.st_ino, offset=0, pending='', leases={})
+                self.files[path] = state
+            if stat.st_size == state['offset']:
+                continue
+            fh = open(path, 'r')
+            fh.seek(state['offset'])
+            data = state['pending'] + fh.read()
+            state['offset'] = fh.tell()
+            fh.close()
+            parsed_to = 0
+            for match in self.lease_regex.finditer(data):
+                mac = self.mac_regex.search(match.group(2))
+                if mac:
+                    ends = self.ends_regex.search(match.group(2))
+                    state['leases'][mac.group(1).lower()] = (match.group(1), ends and ends.group(1))
+                parsed_to = match.end()
+            state['pending'] = data[parsed_to:]
+
+    def lookup(self, macs):
+        with self.lock:
+            self.refresh()
+            now = datetime.datetime.utcnow().strftime('%Y/%m/%d %H:%M:%S')
+            for mac in macs:
+                for state in self.files.values():
+                    lease = state['leases'].get(mac)
+                    # lease end times are UTC in a sortable format, and leases without one never expire
+                    if lease and (lease[1] is None or lease[1] > now):
+                        return lease[0]
+        return None
+
+
+def wait_until_ready(module, target_image, ipaddress, timings):
+    if not module.params['wait_for_ready'] or not ipaddress:
+        return None
+    ready_time = ready_times({ipaddress: time()}, module.params, timings)[ipaddress]
+    if ready_time is None:
+        module.fail_json(msg='Timed out waiting for ' + target_image + ' to accept connections on port ' +
+                             str(module.params['wait_for_port']), timings=timings.summary())
+    return ready_time
+
+
+# one keep-alive HTTP connection to VMware's vmrest REST API, which a run's batch workers, or a vmmanager_controller's
+# tasks, take turns on; with the ids vmrest gives to registered vmx paths, as they were last listed
+class VmrestConnection():
+    media_type = 'application/vnd.vmware.vmw.rest-v1+json'
+
+    def __init__(self, url, username, password, timeout=30):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 8697
+        self.https = parsed.scheme == 'https'
+        self.timeout = timeout
+        self.headers = {'Accept': self.media_type, 'Content-Type': self.media_type}
+        if username:
+            credentials = (username + ':' + (password or '')).encode('utf-8')
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+        self.connection = None
+        self.lock = threading.Lock()
+        self.ids = None
+        self.ids_lock = threading.Lock()
+
+    def connect(self):
+        if self.https:
+            return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    # a kept-alive connection that vmrest has closed in the meantime reads as readable, with nothing to read
+    def dropped(self):
+        return bool(select.select([self.connection.sock], [], [], 0)[0])
+
+    # returns the HTTP status and the raw reply. A kept-alive connection that vmrest has closed is reopened before
+    # the request is sent; should it fail anyway, the request is sent again on a new connection if it was not sent
+    # in full, or if it was a GET, while other requests, which vmrest may have carried out, fail
+    def request(self, method, path, body):
+        with self.lock:
+            while True:
+                reused = self.connection is not None and self.connection.sock is not None
+                if reused and self.dropped():
+                    self.connection.close()
+                    self.connection = None
+                    reused = False
+                if self.connection is None:
+                    self.connection = self.connect()
+                sent = False
+                try:
+                    self.connection.request(method, path, body, self.headers)
+                    sent = True
+                    response = self.connection.getresponse()
+                    return response.status, response.read()
+                except (httplib.HTTPException, socket.error):
+                    self.connection.close()
+                    self.connection = None
+                    if not reused or (sent and method != 'GET'):
+                        raise
+
+
+# the vmrest API for one run, on a VmrestConnection. vmrest addresses VMs by ids it gives to registered vmx paths;
+# they are listed once per run, and a vmx it does not know yet is registered on first use. Requests are timed like
+# commands, with the HTTP status as returncode
+class VmrestClient():
+    def __init__(self, connection, timings):
+        self.connection = connection
+        self.timings = timings
+
+    # returns the HTTP status and the decoded JSON reply; a power action is sent as plain text, other bodies as JSON
+    def request(self, kind, method, path, body=None):
+        if body is not None and not isinstance(body, str):
+            body = json.dumps(body)
+        start = time()
+        try:
+            status, data = self.connection.request(method, path, body)
+        except (httplib.HTTPException, socket.error):
+            self.timings.command('vmrest ' + kind, start, None, 0)
+            raise
+        self.timings.command('vmrest ' + kind, start, status, len(data))
+        reply = None
+        if data:
+            try:
+                reply = json.loads(data.decode('utf-8'))
+            except ValueError:
+                reply = None
+        if status in (401, 403):
+            raise Exception('Error: vmrest refused the request: ' + str(reply and reply.get('Message') or data))
+        return status, reply
+
+    def vm_ids(self):
+        status, reply = self.request('list', 'GET', '/api/vms')
+        if status != 200:
+            raise Exception('Error: vmrest failed to list the VMs: ' + str(reply))
+        return dict((vm['path'], vm['id']) for vm in reply)
+
+    def load(self):
+        with self.connection.ids_lock:
+            self.connection.ids = self.vm_ids()
+
+    def vm_id(self, vmx):
+        if not os.path.isfile(vmx):
+            return None
+        with self.connection.ids_lock:
+            ids = self.connection.ids
+            if vmx not in ids:
+                name = os.path.splitext(os.path.basename(vmx))[0]
+                status, reply = self.request('register', 'POST', '/api/vms/registration', dict(name=name, path=vmx))
+                if reply and reply.get('id'):
+                    ids[vmx] = reply['id']
+                else:
+                    # registered meanwhile by another run
+                    ids = self.connection.ids = self.vm_ids()
+            return ids.get(vmx)
+
+    def power_state(self, vmx):
+        vm_id = self.vm_id(vmx)
+        if vm_id is None:
+            return None
+        status, reply = self.request('power', 'GET', '/api/vms/' + vm_id + '/power')
+        return status == 200 and reply.get('power_state') or None
+
+    # action is one of on, off, shutdown, suspend; returns the resulting power state, or None when it failed
+    def set_power(self, vmx, action):
+        vm_id = self.vm_id(vmx)
+        if vm_id is None:
+            return None
+        status, reply = self.request('power ' + action, 'PUT', '/api/vms/' + vm_id + '/power', action)
+        return status == 200 and reply.get('power_state') or None
+
+    # the address VMware Tools report for the guest, or None until they run
+    def ipaddress(self, vmx):
+        vm_id = self.vm_id(vmx)
+        if vm_id is None:
+            return None
+        status, reply = self.request('ip', 'GET', '/api/vms/' + vm_id + '/ip')
+        return status == 200 and reply.get('ip') or None
+
+    # deletes the VM's bundle along with its registration
+    def delete(self, vmx):
+        vm_id = self.vm_id(vmx)
+        if vm_id is None:
+            return False
+        status, reply = self.request('delete', 'DELETE', '/api/vms/' + vm_id)
+        if status not in (200, 204):
+            return False
+        with self.connection.ids_lock:
+            self.connection.ids.pop(vmx, None)
+        return True
+
+
 class Fusion():
-    def __init__(self, source_image, target_image, memsize, clone_type, headless, vmrunexe, vmbasedir):
+    def __init__(self, source_image, target_image, memsize, clone_type, headless, vmrunexe, vmbasedir,
+                 ip_resolver='auto', lease_index=None, pool=None, library=None, numvcpus=None, scheduler=None,
+                 timings=None, clone_engine='auto', ip_nic=None, stop_timeout=0, vmrest=None, suspended=None,
+                 probe_port=22):
         self.vmrunexe = vmrunexe
         self.vmbasedir = vmbasedir
         self.source_image = source_image
         self.target_image = target_image
         self.memsize = memsize
         self.clone_type = clone_type
+        self.clone_engine = clone_engine
+        self.clone_methods = None
         self.headless = headless
-        self.source_vmx = os.path.join(self.vmbasedir, self.source_image + '.vmwarevm', self.source_image + '.vmx')
-        self.target_vmx = os.path.join(self.vmbasedir, self.target_image + '.vmwarevm', self.target_image + '.vmx')
+        self.ip_resolver = ip_resolver
+        self.ip_nic = ip_nic
+        self.stop_timeout = stop_timeout
+        self.lease_index = lease_index or LeaseIndex(DEFAULT_DHCP_LEASES)
+        self.numvcpus = numvcpus
+        self.library = library or BundleIndex(vmbasedir, '~/.ansible/tmp/fusion_library.json')
+        self.pool = pool
+        self.claimed_standby = False
+        self.scheduler = scheduler
+        self.admission_ticket = None
+        self.timings = timings or Timings('fusion_instance')
+        self.vmrest = vmrest
+        self.suspended = suspended
+        self.probe_port = probe_port
+        self.resumed = False
+        # a target claimed from the warm pool keeps running from its standby bundle
+        self.target_vmx = self.bundle_vmx(pool and pool.claimed(target_image) or target_image)
 
         if not os.path.isfile(self.vmrunexe):
             raise Exception('Cannot find vmrunexe: ' + self.vmrunexe)
         if not os.path.isdir(self.vmbasedir):
             raise Exception('Cannot find vmbasedir: ' + self.vmbasedir)
 
-    @staticmethod
-    def escape_spaces(s):
-        return s.replace(' ', '\ ')
+    # args are passed to vmrun as they are, so paths with spaces need no escaping
+    def stream(self, args):
+        return CommandStream(args[0], [self.vmrunexe] + args, self.timings)
 
-    @staticmethod
-    def exec_command(command):
-        p = subprocess.Popen(command, shell=True, executable='/bin/bash',
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        p.wait()
-        return p
+    # runs a command to completion and returns its exit status and output lines
+    def run(self, args):
+        with self.stream(args) as output:
+            output_lines = list(output)
+        return output.returncode, output_lines
 
+    @property
+    def source_vmx(self):
+        with self.timings.phase('inventory', self.target_image):
+            return self.library.find(self.source_image)
+
+    def bundle_vmx(self, name):
+        return os.path.join(self.vmbasedir, name + '.vmwarevm', name + '.vmx')
+
+    def running_vmx(self):
+        with self.timings.phase('inventory', self.target_image):
+            returncode, output_lines = self.run(['list'])
+        if returncode != 0:
+            return set()
+        return set(output_lines)
+
+    # vmrest is asked about the one VM, where vmrun lists all the running ones
+    def vmx_running(self, vmx):
+        if self.vmrest:
+            with self.timings.phase('inventory', self.target_image):
+                return self.vmrest.power_state(vmx) == 'poweredOn'
+        return vmx in self.running_vmx()
+
+    # stops listing the running VMs as soon as the target is among them
     @property
     def is_running(self):
-        p = self.exec_command(self.escape_spaces(self.vmrunexe) + ' list')
-        if p.returncode != 0:
-            return False
-        stdout = p.stdout.readlines()
-        for stdoutline in stdout:
-            if self.target_vmx == stdoutline.replace('\n', ''):
-                return True
+        if self.vmrest:
+            return self.vmx_running(self.target_vmx)
+        with self.timings.phase('inventory', self.target_image):
+            with self.stream(['list']) as output:
+                for output_line in output:
+                    if output_line == self.target_vmx:
+                        return True
         return False
 
+    def claim_standby(self):
+        if self.pool is None:
+            return False
+        if self.vmrest:
+            is_ready = lambda name: self.vmx_running(self.bundle_vmx(name))
+        else:
+            running = self.running_vmx()
+            is_ready = lambda name: self.bundle_vmx(name) in running
+        name = self.pool.claim(self.target_image, is_ready)
+        if not name:
+            return False
+        self.target_vmx = self.bundle_vmx(name)
+        # the bundle of a running VM cannot be renamed, so the VM is labelled with its target instead
+        self.run(['writeVariable', self.target_vmx, 'guestVar', 'ansible.target_image', self.target_image])
+        self.claimed_standby = True
+        return True
+
+    # a suspended VM's vmx names the file its state was saved to
+    @property
+    def is_suspended(self):
+        return os.path.isfile(self.target_vmx) and bool(VMX(self.target_vmx).get('checkpoint.vmState'))
+
+    # reads the guest's lease from the host's vmnet dhcpd, which does not need VMware Tools in the guest
+    def lease_ipaddress(self):
+        if not os.path.isfile(self.target_vmx):
+            return None
+        return self.lease_index.lookup([nic['mac'] for nic in vmx_nics(self.target_vmx)
+                                        if nic['mac'] and self.ip_nic in (None, nic['index'])])
+
+    # the target's NICs from its vmx, each with the address leased to it; the guest's IPv6 addresses are not known
+    # to the host
+    def nic_facts(self):
+        if not os.path.isfile(self.target_vmx):
+            return []
+        nics = vmx_nics(self.target_vmx)
+        for nic in nics:
+            nic.update(ipv4=nic['mac'] and self.lease_index.lookup([nic['mac']]), ipv6=None)
+        return nics
+
+    def vmrun_ipaddress(self):
+        returncode, output_lines = self.run(['getGuestIPAddress', self.target_vmx])
+        if returncode != 0:
+            return None
+        return ''.join(output_lines)
+
+    # the address VMware Tools report, through vmrest when it is in use
+    def tools_ipaddress(self):
+        if self.vmrest:
+            return self.vmrest.ipaddress(self.target_vmx)
+        return self.vmrun_ipaddress()
+
+    # a boot holds its admission until the guest has reported an IP address
+    def admit(self):
+        if self.scheduler:
+            self.admission_ticket = self.scheduler.admit(self.target_vmx, self.memsize)
+            if self.admission_ticket is None:
+                raise Exception('Error: timed out waiting for host capacity to boot ' + self.target_image)
+
+    def release_admission(self):
+        if self.admission_ticket:
+            self.scheduler.release(self.admission_ticket)
+            self.admission_ticket = None
+
     @property
     def ipaddress(self):
+        try:
+            with self.timings.phase('ip_wait', self.target_image):
+                return self.resumed_ipaddress() or self.wait_for_ipaddress()
+        finally:
+            self.release_admission()
+
+    # a resumed guest keeps the address it was suspended with unless its lease has lapsed meanwhile, which is told by
+    # connecting to it rather than by waiting for a lease or for VMware Tools to come back
+    def resumed_ipaddress(self):
+        ipaddress = self.resumed and self.suspended and self.suspended.pop(self.target_vmx)
+        if not ipaddress:
+            return None
+        if wait_for_ports([ipaddress], self.probe_port, RESUME_PROBE_TIMEOUT)[ipaddress] is None:
+            return None
+        return ipaddress
+
+    # VMware Tools only report the guest's primary address, so the address of ip_nic always comes from the leases
+    def current_ipaddress(self):
+        ipaddress = None
+        if self.ip_resolver in ('auto', 'leases') or self.ip_nic is not None:
+            ipaddress = self.lease_ipaddress()
+        if ipaddress is None and self.ip_resolver in ('auto', 'vmrun') and self.ip_nic is None:
+            ipaddress = self.tools_ipaddress()
+        return ipaddress
+
+    def wait_for_ipaddress(self):
         maxtries = 60
         tries = 0
         while tries < maxtries:
-            p = self.exec_command(self.escape_spaces(self.vmrunexe) + ' getGuestIPAddress ' +
-                                  self.escape_spaces(self.target_vmx))
-            if p.returncode != 0:
-                tries += 1
-                sleep(1)
-            else:
-                ipaddress = p.stdout.read().replace('\n', '')
+            ipaddress = self.current_ipaddress()
+            if ipaddress:
                 return ipaddress
+            tries += 1
+            sleep(1)
         return False
 
     def clone_vm(self):
-        if not os.path.isfile(self.source_vmx):
-            raise Exception('Unable to find base image')
-        if not os.path.isfile(self.target_vmx):
-            p = self.exec_command(self.escape_spaces(self.vmrunexe) + ' clone ' +
-                                  self.escape_spaces(self.source_vmx) + ' ' +
-                                  self.escape_spaces(self.target_vmx) + ' ' + self.clone_type)
-            if p.returncode != 0:
-                raise Exception('Ooops!')
-            # update the vmx config...
-            new_config = []
-            fh = open(self.target_vmx, 'r')
-            current_config = fh.readlines()
-            fh.close()
-            for config_line in current_config:
-                if re.match('^displayname = "', config_line):
-                    config_line = 'displayname = "' + self.target_image + '"\n'
-                if re.match('^displayName = "', config_line):
-                    config_line = 'displayName = "' + self.target_image + '"\n'
-                if re.match('^memsize = "', config_line):
-                    config_line = 'memsize = "' + self.memsize + '"\n'
-                new_config.append(config_line)
-            fh = open(self.target_vmx, 'w')
-            fh.write(''.join(new_config))
-            fh.close()
+        with self.timings.phase('clone', self.target_image):
+            source_vmx = self.source_vmx
+            # vmrun copies a full clone's disks byte by byte, where the clone engine can share or skip their blocks;
+            # a running source is left to vmrun, which clones it from a snapshot
+            if self.clone_type == 'full' and self.clone_engine == 'auto' and not self.vmx_running(source_vmx):
+                self.clone_methods = sorted(clone_bundle(source_vmx, self.target_vmx))
+            else:
+                with source_lock(source_vmx):
+                    self._clone_vm(source_vmx)
+        with self.timings.phase('configure', self.target_image):
+            self.configure()
+
+    def _clone_vm(self, source_vmx):
+        returncode, output_lines = self.run(['clone', source_vmx, self.target_vmx, self.clone_type])
+        if returncode != 0:
+            raise Exception('Ooops!')
+        self.clone_methods = ['vmrun']
+
+    # update the vmx config...
+    def configure(self):
+        vmx = VMX(self.target_vmx)
+        vmx.set('displayName', self.target_image)
+        vmx.set('memsize', self.memsize)
+        if self.numvcpus:
+            vmx.set('numvcpus', self.numvcpus)
+        # without its generated MAC addresses the clone gets new ones, rather than the source's DHCP lease
+        for nic in vmx.nics():
+            vmx.remove(nic + '\.generatedAddress(Offset)?')
+        vmx.save()
 
     def start_vm(self):
-        if not os.path.isfile(self.target_vmx):
-            self.clone_vm()
-        if self.headless == 'yes':
-            guiparam = 'nogui'
-        else:
-            guiparam = 'gui'
-        p = self.exec_command(self.escape_spaces(self.vmrunexe) + ' start ' +
-                              self.escape_spaces(self.target_vmx) + ' ' + guiparam)
-        if p.returncode != 0:
+        if not os.path.isfile(self.target_vmx) and self.claim_standby():
+            return True
+        self.admit()
+        try:
+            if not os.path.isfile(self.target_vmx):
+                self.clone_vm()
+            if self.headless == 'yes':
+                guiparam = 'nogui'
+            else:
+                guiparam = 'gui'
+            # starting a suspended VM resumes it
+            self.resumed = self.is_suspended
+            with self.timings.phase(self.resumed and 'resume' or 'boot', self.target_image):
+                # vmrest starts VMs without their window
+                if self.vmrest and self.headless == 'yes':
+                    started = self.vmrest.set_power(self.target_vmx, 'on') == 'poweredOn'
+                else:
+                    returncode, output_lines = self.run(['start', self.target_vmx, guiparam])
+                    started = returncode == 0
+        except BaseException:
+            self.abandon_admission()
+            raise
+        if not started:
+            self.abandon_admission()
             return False
         return True
 
+    # the boot never happened, so its memory is not committed either
+    def abandon_admission(self):
+        self.release_admission()
+        if self.scheduler:
+            self.scheduler.forget(self.target_vmx)
+
     def stop_vm(self):
         if not os.path.isfile(self.target_vmx):
             raise Exception('Unable to find target vmx file: ' + self.target_vmx)
         if not self.is_running:
             raise Exception('Image ' + self.target_image + ' not running')
-        print 'stopping ' + self.target_image
-        p = self.exec_command(self.escape_spaces(self.vmrunexe) + ' stop ' +
-                              self.escape_spaces(self.target_vmx))
-        if p.returncode != 0:
-            raise Exception('Oops!')
+        self._stop_vm()
+
+    def _stop_vm(self):
+        if self.vmrest:
+            if not (self.stop_timeout > 0 and self.shutdown()) and \
+                    self.vmrest.set_power(self.target_vmx, 'off') != 'poweredOff':
+                raise Exception('Oops!')
+        elif not (self.stop_timeout > 0 and self.shutdown()):
+            returncode, output_lines = self.run(['stop', self.target_vmx] + (self.stop_timeout > 0 and ['hard'] or []))
+            if returncode != 0:
+                raise Exception('Oops!')
         if self.is_running:
             raise Exception('Failed to stop ' + self.target_image)
 
-    def delete_vm(self):
+    # a soft stop returns once the guest has shut down, or fails at once without VMware Tools; past stop_timeout it
+    # is abandoned for a hard stop
+    def shutdown(self):
+        if self.vmrest:
+            deadline = time() + self.stop_timeout
+            power_state = self.vmrest.set_power(self.target_vmx, 'shutdown')
+            while power_state == 'poweredOn' and time() < deadline:
+                sleep(min(0.5, max(deadline - time(), 0)))
+                power_state = self.vmrest.power_state(self.target_vmx)
+            return power_state == 'poweredOff'
+        with self.stream(['stop', self.target_vmx, 'soft']) as output:
+            return output.wait(self.stop_timeout) == 0
+
+    # suspends a running guest to disk, keeping its address for the resume; returns False for a VM that is suspended
+    # already
+    def suspend_vm(self):
+        if not os.path.isfile(self.target_vmx):
+            raise Exception('Unable to find target vmx file: ' + self.target_vmx)
+        if not self.is_running:
+            if not self.is_suspended:
+                raise Exception('Image ' + self.target_image + ' is powered off; only a running VM can be suspended')
+            return False
+        with self.timings.phase('suspend', self.target_image):
+            self._suspend_vm()
+        return True
+
+    def _suspend_vm(self):
+        ipaddress = self.current_ipaddress()
+        if self.vmrest:
+            suspended = self.vmrest.set_power(self.target_vmx, 'suspend') == 'suspended'
+        else:
+            suspended = self.run(['suspend', self.target_vmx])[0] == 0
+        if not suspended:
+            raise Exception('Failed to suspend ' + self.target_image)
+        # a suspended VM takes no host memory until it is resumed, which is admitted like a boot
+        if self.scheduler:
+            self.scheduler.forget(self.target_vmx)
+        if self.suspended and ipaddress:
+            self.suspended.record(self.target_vmx, ipaddress)
+
+    # with deferred, the bundle is only moved aside here, which frees its name at once, and deferred deletes it later;
+    # vmrest deletes it at once, as a moved bundle would stay registered with it
+    def delete_vm(self, deferred=None):
+        with self.timings.phase('delete', self.target_image):
+            self._delete_vm(deferred)
+
+    def _delete_vm(self, deferred):
         if not os.path.isfile(self.target_vmx):
             raise Exception('Unable to find image')
         if self.is_running:
-            self.stop_vm()
-        p = self.exec_command(self.escape_spaces(self.vmrunexe) + ' deleteVM ' +
-                              self.escape_spaces(self.target_vmx))
-        if p.returncode != 0:
-            raise Exception('Oops!')
-        print 'deleted ' + self.target_image
+            self._stop_vm()
+        if self.vmrest:
+            if not self.vmrest.delete(self.target_vmx):
+                raise Exception('Oops!')
+        elif deferred is None:
+            returncode, output_lines = self.run(['deleteVM', self.target_vmx])
+            if returncode != 0:
+                raise Exception('Oops!')
+        else:
+            bundle = os.path.dirname(self.target_vmx)
+            doomed = os.path.join(os.path.dirname(bundle), DOOMED_PREFIX + os.path.basename(bundle) + '.' +
+                                  uuid4().hex[:8])
+            os.rename(bundle, doomed)
+            deferred.add(self.target_image, lambda: shutil.rmtree(doomed))
+        if self.pool:
+            self.pool.release(self.target_image)
+        if self.scheduler:
+            self.scheduler.forget(self.target_vmx)
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            vmrunexe=dict(default='/Applications/VMware Fusion.app/Contents/Library/vmrun'),
-            vmbasedir=dict(default=os.path.expanduser("~") + '/Documents/Virtual Machines.localized'),
-            source_image=dict(required=True),
-            target_image=dict(required=True),
-            memsize=dict(default='512'),
-            clone_type=dict(default='linked'),
-            headless=dict(default='no'),
-            state=dict(default='running'),
-        )
-    )
+# the VMs committed to the admission scheduler that are no longer running, having been powered off from the guest
+# or the GUI, or whose bundle is gone; none are when vmrun fails to list them. vbox_instance commits its VMs by
+# name, and those are left to it
+def missing_vms(fusion, names):
+    names = [name for name in names if name.endswith('.vmx')]
+    if not names:
+        return []
+    if fusion.vmrest:
+        return [name for name in names if fusion.vmrest.power_state(name) != 'poweredOn']
+    returncode, output_lines = fusion.run(['list'])
+    if returncode != 0:
+        return []
+    return [name for name in names if name not in output_lines]
+
+
+# what a vmmanager_controller keeps warm between its tasks with the same settings: the parsed DHCP leases and the
+# vmrest connection
+class ControllerSession():
+    def __init__(self, params):
+        self.lease_index = LeaseIndex(params['dhcp_leases'])
+        self.vmrest = None
+        if params['backend'] == 'vmrest':
+            self.vmrest = VmrestConnection(params['vmrest_url'], params['vmrest_username'], params['vmrest_password'])
+        self.created_at = time()
+
+    @staticmethod
+    def key(params):
+        return ('fusion_instance', tuple(params['dhcp_leases']), params['backend'], params['vmrest_url'],
+                params['vmrest_username'], params['vmrest_password'])
+
+
+def make_lease_index(params, session):
+    return session and session.lease_index or LeaseIndex(params['dhcp_leases'])
+
+
+# the vmrest client shared by all of a run's Fusion instances, or None for vmrun, which is also used when vmrest
+# cannot be reached; the ids are listed again for every run, as VMs may have been registered in the meantime
+def make_vmrest(params, timings, connection=None):
+    if params['backend'] != 'vmrest':
+        return None
+    vmrest = VmrestClient(connection or VmrestConnection(params['vmrest_url'], params['vmrest_username'],
+                                                         params['vmrest_password']), timings)
+    try:
+        vmrest.load()
+    except (httplib.HTTPException, socket.error):
+        return None
+    return vmrest
+
+
+def make_fusion(params, target_image, lease_index=None, pool=None, timings=None, vmrest=None):
+    fusion = Fusion(source_image=params['source_image'], target_image=target_image, memsize=params['memsize'],
+                    clone_type=params['clone_type'], clone_engine=params['clone_engine'], headless=params['headless'],
+                    vmbasedir=params['vmbasedir'],
+                    vmrunexe=params['vmrunexe'], ip_resolver=params['ip_resolver'],
+                    lease_index=lease_index or LeaseIndex(params['dhcp_leases']), pool=pool,
+                    library=BundleIndex(params['vmbasedir'], params['library_cache']), numvcpus=params['numvcpus'],
+                    scheduler=make_scheduler(params, lambda names: missing_vms(fusion, names)), timings=timings,
+                    ip_nic=params['ip_nic'], stop_timeout=params['stop_timeout'], vmrest=vmrest,
+                    suspended=SuspendedVMs(params['suspend_state']), probe_port=params['wait_for_port'])
+    return fusion
+
+
+def make_pool(params):
+    return WarmPool(params['pool_state'], params['source_image'],
+                    dict(memsize=params['memsize'], numvcpus=params['numvcpus'], clone_type=params['clone_type']))
 
-    vmrunexe = module.params["vmrunexe"]
-    vmbasedir = module.params["vmbasedir"]
-    source_image = module.params["source_image"]
+
+# clones and boots standby VMs until the pool holds size of them, and removes any beyond that
+def fill_pool(params, size, session=None):
+    pool = make_pool(params)
+    lease_index = make_lease_index(params, session)
+    timings = Timings('fusion_instance', params['trace_file'])
+    vmrest = make_vmrest(params, timings, session and session.vmrest)
+    missing, surplus = pool.resize(size, lambda standby: [
+        name for name in standby if os.path.isfile(make_fusion(params, name, lease_index).target_vmx)])
+
+    def worker(name):
+        f = make_fusion(params, name, lease_index, timings=timings, vmrest=vmrest)
+        if name in surplus:
+            f.delete_vm()
+        else:
+            # a standby's boot holds its admission until the guest has an address, as any other boot does, and a
+            # standby whose guest gets none is deleted rather than handed out
+            try:
+                if not f.start_vm():
+                    raise Exception('Failed to start ' + name)
+                if not f.ipaddress:
+                    raise Exception('Timeout exceeded while trying to get VM ip address for ' + name)
+            except BaseException:
+                pool.abandon(name)
+                if os.path.isfile(f.target_vmx):
+                    f.delete_vm()
+                raise
+            pool.add_standby(name)
+        return dict(target_image=name, changed=True, failed=False)
+
+    return run_batch(missing + surplus, worker, params['max_parallel']), timings
+
+
+# a vmmanager_controller refills the pool in a thread of its own rather than a detached process
+def refill_pool(module, params, session=None):
+    getattr(module, 'run_detached', run_detached)(lambda: fill_pool(params, make_pool(params).size(), session))
+
+
+def run_batch_mode(module, params, session=None):
+    state = params['state']
+    lease_index = make_lease_index(params, session)
+    pool = make_pool(params)
+    timings = Timings('fusion_instance', params['trace_file'])
+    vmrest = make_vmrest(params, timings, session and session.vmrest)
+    known_at = {}
+    targets = params['target_images'] or \
+        pattern_targets(params, BundleIndex(params['vmbasedir'], params['library_cache']), pool)
+    # a deletion only waits for a free worker when there are more targets than workers
+    deferred = None
+    if state == 'absent' and len(targets) > params['max_parallel']:
+        deferred = DeferredDeletes(params['max_parallel'])
+        # bundles left behind by an interrupted teardown are deleted along with this one's
+        for doomed in glob.glob(os.path.join(params['vmbasedir'], DOOMED_PREFIX + '*')):
+            deferred.add(os.path.basename(doomed), lambda doomed=doomed: shutil.rmtree(doomed, True))
+
+    def worker(target_image):
+        f = make_fusion(params, target_image, lease_index, pool, timings, vmrest)
+        result = dict(target_image=target_image, changed=False, failed=False)
+        if state == 'running':
+            if not f.is_running:
+                if not f.start_vm() or not f.is_running:
+                    raise Exception('Failed to start ' + target_image)
+                result['changed'] = True
+                result['claimed_standby'] = f.claimed_standby
+                result['clone_methods'] = f.clone_methods
+                result['resumed'] = f.resumed
+            result['ipaddress'] = f.ipaddress
+            if not result['ipaddress']:
+                raise Exception('Timeout exceeded while trying to get VM ip address for ' + target_image)
+            result['nics'] = f.nic_facts()
+            known_at[result['ipaddress']] = time()
+            result['msg'] = 'instance: ' + target_image + ' running'
+        elif state == 'absent':
+            if os.path.isfile(f.target_vmx):
+                f.delete_vm(deferred)
+                result['changed'] = True
+            result['msg'] = 'instance: ' + target_image + ' absent'
+        elif state == 'suspended':
+            # of the VMs a pattern matches, only the running ones are suspended
+            if not params['target_pattern'] or f.is_running:
+                result['changed'] = f.suspend_vm()
+            result['msg'] = 'instance: ' + target_image + ' suspended'
+        return result
+
+    results = run_batch(targets, worker, params['max_parallel'])
+    finish_batch(module, params, results, timings, deferred, known_at, 'instances',
+                 lambda: refill_pool(module, params, session))
+
+
+# runs the task, in the module's process or in a vmmanager_controller, which passes the session it keeps warm
+def run_task(module, session=None):
     target_image = module.params["target_image"]
-    memsize = module.params["memsize"]
-    clone_type = module.params["clone_type"]
-    headless = module.params["headless"]
     state = module.params["state"]
 
-    f = Fusion(source_image=source_image, target_image=target_image, memsize=memsize,
-               clone_type=clone_type, headless=headless, vmbasedir=vmbasedir, vmrunexe=vmrunexe)
+    if state == 'pooled':
+        run_pool_mode(module, module.params, make_pool(module.params),
+                      lambda size: fill_pool(module.params, size, session))
+    check_targets(module)
+    if module.params["target_images"] or module.params["target_pattern"]:
+        run_batch_mode(module, module.params, session)
+
+    timings = Timings('fusion_instance', module.params['trace_file'])
+    f = make_fusion(module.params, target_image, lease_index=make_lease_index(module.params, session),
+                    pool=make_pool(module.params), timings=timings,
+                    vmrest=make_vmrest(module.params, timings, session and session.vmrest))
 
     if state == 'running':
         if f.is_running:
             msg = 'instance: ' + target_image + ' running'
-            module.exit_json(changed=False, msg=msg, ansible_facts=dict(ipaddress=f.ipaddress))
+            ipaddress = f.ipaddress
+            ready_time = wait_until_ready(module, target_image, ipaddress, timings)
+            module.exit_json(changed=False, msg=msg, ready_time=ready_time, timings=timings.summary(),
+                             ansible_facts=dict(ipaddress=ipaddress, nics=f.nic_facts()))
         else:
             if f.start_vm():
                 if f.is_running:
                     msg = 'instance: ' + target_image + ' running'
-                    module.exit_json(changed=True, msg=msg, ansible_facts=dict(ipaddress=f.ipaddress))
+                    ipaddress = f.ipaddress
+                    if f.claimed_standby:
+                        refill_pool(module, module.params, session)
+                    ready_time = wait_until_ready(module, target_image, ipaddress, timings)
+                    module.exit_json(changed=True, msg=msg, claimed_standby=f.claimed_standby,
+                                     clone_methods=f.clone_methods, resumed=f.resumed, ready_time=ready_time,
+                                     timings=timings.summary(), ansible_facts=dict(ipaddress=ipaddress,
+                                                                                   nics=f.nic_facts()))
     elif state == 'absent':
         if os.path.isfile(f.target_vmx):
             f.delete_vm()
             msg = 'instance: ' + target_image + ' absent'
-            module.exit_json(changed=True, msg=msg)
+            module.exit_json(changed=True, msg=msg, timings=timings.summary())
         else:
             msg = 'instance: ' + target_image + ' absent'
-            module.exit_json(changed=False, msg=msg)
+            module.exit_json(changed=False, msg=msg, timings=timings.summary())
+    elif state == 'suspended':
+        try:
+            changed = f.suspend_vm()
+        except Exception as e:
+            module.fail_json(msg=str(e), timings=timings.summary())
+        module.exit_json(changed=changed, msg='instance: ' + target_image + ' suspended', timings=timings.summary())
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            vmrunexe=dict(default='/Applications/VMware Fusion.app/Contents/Library/vmrun'),
+            vmbasedir=dict(default=os.path.expanduser("~") + '/Documents/Virtual Machines.localized'),
+            source_image=dict(required=True),
+            target_image=dict(required=False),
+            target_images=dict(required=False, type='list'),
+            target_pattern=dict(required=False),
+            max_parallel=dict(default=4, type='int'),
+            memsize=dict(default='512'),
+            numvcpus=dict(required=False),
+            clone_type=dict(default='linked'),
+            clone_engine=dict(default='auto', choices=['auto', 'vmrun']),
+            library_cache=dict(default='~/.ansible/tmp/fusion_library.json'),
+            headless=dict(default='no'),
+            ip_resolver=dict(default='auto', choices=['auto', 'leases', 'vmrun']),
+            ip_nic=dict(required=False, type='int'),
+            dhcp_leases=dict(default=DEFAULT_DHCP_LEASES, type='list'),
+            pool_size=dict(default=0, type='int'),
+            pool_state=dict(default='~/.ansible/tmp/fusion_pool.json'),
+            admission=dict(default=False, type='bool'),
+            admission_state=dict(default='~/.ansible/tmp/vmmanager_admission.json'),
+            max_memory_share=dict(default=0.8, type='float'),
+            boots_per_cpu=dict(default=0.5, type='float'),
+            admission_timeout=dict(default=600, type='int'),
+            wait_for_ready=dict(default=False, type='bool'),
+            wait_for_port=dict(default=22, type='int'),
+            ready_timeout=dict(default=300, type='int'),
+            trace_file=dict(required=False),
+            stop_timeout=dict(default=0, type='int'),
+            backend=dict(default='vmrun', choices=['vmrun', 'vmrest']),
+            vmrest_url=dict(default='http://127.0.0.1:8697'),
+            vmrest_username=dict(required=False),
+            vmrest_password=dict(required=False, no_log=True),
+            controller_socket=dict(default='~/.ansible/tmp/vmmanager.sock'),
+            suspend_state=dict(default='~/.ansible/tmp/fusion_suspended.json'),
+            state=dict(default='running', choices=['running', 'absent', 'pooled', 'suspended']),
+        ),
+        mutually_exclusive=[['target_image', 'target_images', 'target_pattern']],
+    )
+
+    run_on_controller(module, 'fusion_instance')
+    run_task(module)
+
 
 from ansible.module_utils.basic import *
+try:
+    from ansible.module_utils.vmmanager_common import *
+except ImportError:
+    # run by vmmanager_controller, vmmanager_inventory.py, the benchmark or the tests, with module_utils on sys.path
+    from vmmanager_common import *
 import os
 import subprocess
 import re
-from time import sleep
+import glob
+import datetime
+import fcntl
+import json
+import errno
+import select
+import socket
+from time import sleep, time
+from uuid import uuid4
+import threading
+import shutil
+import sys
+import base64
+try:
+    import httplib
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlparse
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,625 @@
+# Helpers shared by vbox_instance and fusion_instance: the state files that concurrent runs of both modules share
+# (the admission scheduler's, the warm pools' and the suspended VMs'), timings, batches of workers, readiness probes
+# and the hand-over of tasks to vmmanager_controller. Ansible ships it with the modules from its module_utils path;
+# see Installation in the README.
+import errno
+import fcntl
+import json
+import multiprocessing
+import os
+import re
+import select
+import socket
+import subprocess
+import threading
+from time import sleep, time
+from uuid import uuid4
+
+
+# JSON state shared between module invocations; the file is locked with flock while it is open, and written back
+# on a clean exit from the with block
+class StateFile():
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock_file = None
+        self.data = None
+
+    def __enter__(self):
+        # a bare file name lives in the working directory, and another run may create the directory first
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            fh = open(self.path, 'r')
+            try:
+                self.data = json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, OSError, ValueError):
+            self.data = {}
+        return self.data
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                tmp_path = self.path + '.' + str(os.getpid())
+                fh = open(tmp_path, 'w')
+                json.dump(self.data, fh)
+                fh.close()
+                os.rename(tmp_path, self.path)
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+
+
+# durations of every hypervisor command and provisioning phase in this run; with a trace file, each record is also
+# appended to it as a JSON line, so that timings can be aggregated across runs
+class Timings():
+    def __init__(self, module_name, trace_file=None):
+        self.module_name = module_name
+        self.trace_file = trace_file and os.path.expanduser(trace_file)
+        self.run_id = uuid4().hex
+        self.start = time()
+        self.commands = []
+        self.phases = []
+        self.lock = threading.Lock()
+        # the VM whose phase the current thread is in, so that commands are attributed to it
+        self.current = threading.local()
+
+    def add(self, records, record):
+        with self.lock:
+            records.append(record)
+            if self.trace_file:
+                line = dict(record, run=self.run_id, module=self.module_name, pid=os.getpid())
+                fh = open(self.trace_file, 'a')
+                try:
+                    fh.write(json.dumps(line, sort_keys=True) + '\n')
+                finally:
+                    fh.close()
+
+    def command(self, kind, start, returncode, output_bytes):
+        self.add(self.commands, dict(type='command', kind=kind, vm=getattr(self.current, 'vm', None), start=start,
+                                     duration=round(time() - start, 4), returncode=returncode,
+                                     output_bytes=output_bytes))
+
+    def phase(self, name, vm=None):
+        return TimedPhase(self, name, vm)
+
+    def summary(self):
+        with self.lock:
+            totals = {}
+            for record in self.phases:
+                totals[record['phase']] = round(totals.get(record['phase'], 0) + record['duration'], 4)
+            return dict(total=round(time() - self.start, 4), phase_totals=totals, phases=list(self.phases),
+                        commands=list(self.commands))
+
+
+class TimedPhase():
+    def __init__(self, timings, name, vm):
+        self.timings = timings
+        self.name = name
+        self.vm = vm
+        self.outer_vm = None
+        self.start = None
+
+    def __enter__(self):
+        self.outer_vm = getattr(self.timings.current, 'vm', None)
+        self.timings.current.vm = self.vm or self.outer_vm
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timings.current.vm = self.outer_vm
+        self.timings.add(self.timings.phases, dict(type='phase', phase=self.name, vm=self.vm or self.outer_vm,
+                                                   start=self.start, duration=round(time() - self.start, 4),
+                                                   failed=exc_type is not None))
+
+
+# a hypervisor command run without a shell, whose output is parsed line by line while the command runs; closing the
+# stream before the output is exhausted kills the command, so a parser can stop as soon as it has its answer
+class CommandStream():
+    def __init__(self, kind, argv, timings):
+        self.kind = kind
+        self.timings = timings
+        self.start = time()
+        self.output_bytes = 0
+        self.exhausted = False
+        self.returncode = None
+        self.process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        universal_newlines=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        # readline rather than file iteration, which reads ahead in blocks on Python 2
+        for output_line in iter(self.process.stdout.readline, ''):
+            self.output_bytes += len(output_line)
+            yield output_line.rstrip('\n')
+        self.exhausted = True
+
+    # waits up to timeout seconds for the command to exit without reading its output, and returns its exit status,
+    # or None while it is still running
+    def wait(self, timeout):
+        deadline = time() + timeout
+        while self.process.poll() is None and time() < deadline:
+            sleep(min(0.25, max(deadline - time(), 0)))
+        return self.process.poll()
+
+    def close(self):
+        if self.returncode is None:
+            if not self.exhausted and self.process.poll() is None:
+                self.process.kill()
+            self.process.stdout.close()
+            self.returncode = self.process.wait()
+            self.timings.command(self.kind, self.start, self.returncode, self.output_bytes)
+
+
+source_locks = {}
+source_locks_lock = threading.Lock()
+
+
+# linked clones snapshot their source, so cloning from a source is serialised between batch workers, and between the
+# tasks of a vmmanager_controller, while clones from other sources go ahead
+def source_lock(source):
+    with source_locks_lock:
+        return source_locks.setdefault(source, threading.Lock())
+
+
+def run_batch(targets, worker, max_parallel):
+    pending = list(targets)
+    results = {}
+    lock = threading.Lock()
+
+    def consume():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                target = pending.pop(0)
+            try:
+                result = worker(target)
+            except Exception as e:
+                result = dict(target_image=target, changed=False, failed=True, msg=str(e))
+            with lock:
+                results[target] = result
+
+    workers = [threading.Thread(target=consume) for i in range(max(1, min(max_parallel, len(pending))))]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return [results[target] for target in targets]
+
+
+# ends a batch with its workers' results: fails the targets whose deferred deletion failed or that did not accept
+# connections in time with wait_for_ready, refills the warm pool if standby VMs were claimed, and exits with every
+# instance's address and NICs as facts. known_at is when each address became known; noun names the targets in msg
+def finish_batch(module, params, results, timings, deferred, known_at, noun, refill):
+    if deferred:
+        errors = deferred.finish()
+        for result in results:
+            if result['target_image'] in errors:
+                result.update(failed=True, msg=errors[result['target_image']])
+    if params['state'] == 'running' and params['wait_for_ready']:
+        ready = ready_times(known_at, params, timings)
+        for result in results:
+            if not result['failed']:
+                result['ready_time'] = ready[result['ipaddress']]
+                if result['ready_time'] is None:
+                    result.update(failed=True, msg='Timed out waiting for ' + result['target_image'] +
+                                                   ' to accept connections on port ' + str(params['wait_for_port']))
+    changed = any(result['changed'] for result in results)
+    failed = [result['target_image'] for result in results if result['failed']]
+    if failed:
+        module.fail_json(changed=changed, results=results, timings=timings.summary(),
+                         msg='Error: ' + str(len(failed)) + ' of ' + str(len(results)) + ' ' + noun + ' failed: ' +
+                             ', '.join(failed))
+    if any(result.get('claimed_standby') for result in results):
+        refill()
+    instances = dict((result['target_image'], dict(ipaddress=result.get('ipaddress'), nics=result.get('nics')))
+                     for result in results)
+    module.exit_json(changed=changed, results=results, msg=str(len(results)) + ' ' + noun + ' ' + params['state'],
+                     timings=timings.summary(), ansible_facts=dict(instances=instances))
+
+
+# deletions handed off by teardown workers once their VM is unregistered (VirtualBox) or moved aside (Fusion), so
+# that a worker can move on to its next VM meanwhile; at most max_parallel run at once, and finish waits for all of
+# them and returns the failures
+class DeferredDeletes():
+    def __init__(self, max_parallel):
+        self.slots = threading.Semaphore(max(1, max_parallel))
+        self.lock = threading.Lock()
+        self.threads = []
+        self.errors = {}
+
+    def add(self, target, function):
+        def delete():
+            with self.slots:
+                try:
+                    function()
+                except Exception as e:
+                    with self.lock:
+                        self.errors[target] = str(e)
+        thread = threading.Thread(target=delete)
+        thread.start()
+        with self.lock:
+            self.threads.append(thread)
+
+    def finish(self):
+        for thread in list(self.threads):
+            thread.join()
+        return self.errors
+
+
+# waits until every address accepts a TCP connection on port, probing them all at once with non-blocking connects
+# multiplexed by select; an address whose probe is refused or gets no answer within probe_timeout is probed again
+# after a backoff. Returns the time each address first accepted a connection, or None where none did by the timeout.
+def wait_for_ports(addresses, port, timeout, probe_timeout=2):
+    start = time()
+    deadline = start + timeout
+    ready = dict((address, None) for address in addresses)
+    next_probe = dict((address, start) for address in addresses)
+    delays = dict((address, 0.25) for address in addresses)
+    probes = {}
+
+    def retry(address):
+        next_probe[address] = time() + delays[address]
+        delays[address] = min(delays[address] * 2, 5)
+
+    while (probes or next_probe) and time() < deadline:
+        for address in [address for (address, due) in next_probe.items() if due <= time()]:
+            del next_probe[address]
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            error = sock.connect_ex((address, port))
+            if error == 0:
+                ready[address] = time()
+                sock.close()
+            elif error in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                probes[sock] = (address, time() + probe_timeout)
+            else:
+                sock.close()
+                retry(address)
+        wake = min([expiry for (address, expiry) in probes.values()] + list(next_probe.values()) + [deadline])
+        writable = select.select([], list(probes), [], max(wake - time(), 0))[1]
+        for sock in writable:
+            address = probes.pop(sock)[0]
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                ready[address] = time()
+            else:
+                retry(address)
+            sock.close()
+        for sock, (address, expiry) in list(probes.items()):
+            if expiry <= time():
+                del probes[sock]
+                sock.close()
+                retry(address)
+    for sock in probes:
+        sock.close()
+    return ready
+
+
+# seconds from each address becoming known (known_at) until its guest accepted connections on wait_for_port, or
+# None where it did not within ready_timeout
+def ready_times(known_at, params, timings):
+    with timings.phase('ready'):
+        ready = wait_for_ports(list(known_at), params['wait_for_port'], params['ready_timeout'])
+    return dict((address, ready[address] and round(max(ready[address] - known_at[address], 0), 3))
+                for address in known_at)
+
+
+# the address of every VM suspended by the module, so that it can be checked rather than waited for on the resume
+class SuspendedVMs():
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, key, ipaddress):
+        with StateFile(self.path) as state:
+            state[key] = dict(ipaddress=ipaddress, suspended_at=time())
+
+    def pop(self, key):
+        with StateFile(self.path) as state:
+            return state.pop(key, {}).get('ipaddress')
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+# standby VMs cloned and booted ahead of time per source image, those being built, and the target names they have
+# been claimed for
+class WarmPool():
+    def __init__(self, path, source_image, settings):
+        self.path = path
+        self.source_image = source_image
+        self.settings = settings
+        # a batch's workers share the pool, and its claims as they were last read or written
+        self.lock = threading.RLock()
+        self.claims = None
+
+    # the name must not contain the source image, or the source pattern would match its own standby VMs
+    @staticmethod
+    def standby_name():
+        return 'ansible-standby-' + uuid4().hex[:12]
+
+    @property
+    def in_use(self):
+        return os.path.exists(os.path.expanduser(self.path))
+
+    def claimed(self, target_image):
+        with self.lock:
+            if self.claims is None:
+                claims = {}
+                if self.in_use:
+                    with StateFile(self.path) as state:
+                        claims = dict(state.get('claims', {}))
+                self.claims = claims
+            return self.claims.get(target_image)
+
+    # the standby VM claimed by each target; claimed loads the claims on first use
+    def claims_by_target(self):
+        with self.lock:
+            self.claimed(None)
+            return dict(self.claims)
+
+    def pool(self, state):
+        return state.setdefault('pools', {}).setdefault(self.source_image, dict(size=0, standby=[]))
+
+    def size(self):
+        with StateFile(self.path) as state:
+            return self.pool(state)['size']
+
+    def standby(self):
+        with StateFile(self.path) as state:
+            return list(self.pool(state)['standby'])
+
+    # sizes the pool in one session of its state file, so that no claim or other resize comes in between: drops the
+    # standby VMs that are gone (existing is given the standby VMs and returns those still there), keeps size of
+    # them, and reserves names for the standby VMs to build, counting those other runs are still building. Returns
+    # the names to build and the standby VMs to remove.
+    def resize(self, size, existing):
+        with StateFile(self.path) as state:
+            pool = self.pool(state)
+            standby = existing(list(pool['standby']))
+            building = [entry for entry in pool.get('building', []) if process_alive(entry['pid'])]
+            missing = [self.standby_name() for i in range(size - len(standby) - len(building))]
+            building.extend(dict(name=name, pid=os.getpid()) for name in missing)
+            pool.update(size=size, settings=self.settings, standby=standby[:size], building=building)
+            return missing, standby[size:]
+
+    def building(self, name, standby):
+        with StateFile(self.path) as state:
+            pool = self.pool(state)
+            pool['building'] = [entry for entry in pool.get('building', []) if entry['name'] != name]
+            if standby:
+                pool['standby'].append(name)
+
+    # a standby VM built for a name reserved by resize is ready to be claimed
+    def add_standby(self, name):
+        self.building(name, True)
+
+    def abandon(self, name):
+        self.building(name, False)
+
+    # hands out the first ready standby VM that was built with the requested settings
+    def claim(self, target_image, is_ready):
+        if not self.in_use:
+            return None
+        with self.lock, StateFile(self.path) as state:
+            pool = self.pool(state)
+            if pool.get('settings') != self.settings:
+                return None
+            for name in pool['standby']:
+                if is_ready(name):
+                    pool['standby'].remove(name)
+                    state.setdefault('claims', {})[target_image] = name
+                    self.claims = dict(state['claims'])
+                    return name
+        return None
+
+    def release(self, target_image):
+        with self.lock:
+            if not self.claimed(target_image):
+                return
+            with StateFile(self.path) as state:
+                state.setdefault('claims', {}).pop(target_image, None)
+                self.claims = dict(state['claims'])
+
+
+# what the modules' argument specs cannot tell about their targets
+def check_targets(module):
+    params = module.params
+    if params['target_pattern'] and params['state'] not in ('absent', 'suspended'):
+        module.fail_json(msg='target_pattern is only supported with state=absent and state=suspended')
+    if not params['target_image'] and not params['target_images'] and not params['target_pattern']:
+        module.fail_json(msg='one of the following is required: target_image, target_images, target_pattern')
+
+
+# the VMs whose whole name matches target_pattern, other than those the source_image pattern matches and the warm
+# pool's standby VMs; a claimed standby VM is matched by the name of its target. vms lists the hypervisor's VMs by
+# name with names(), and those a pattern matches with match()
+def pattern_targets(params, vms, pool):
+    regex = re.compile('^(?:' + params['target_pattern'] + ')$')
+    excluded = set(vms.match(params['source_image']))
+    claims = {}
+    if pool.in_use:
+        claims = pool.claims_by_target()
+        excluded.update(pool.standby())
+        excluded.update(claims.values())
+    names = set(name for name in vms.names() if name not in excluded) | set(claims)
+    return sorted(name for name in names if regex.match(name))
+
+
+# state=pooled: fill, given the pool size, builds and removes standby VMs and returns their results and timings
+def run_pool_mode(module, params, pool, fill):
+    results, timings = fill(params['pool_size'])
+    changed = len(results) > 0
+    failed = [result['target_image'] for result in results if result['failed']]
+    if failed:
+        module.fail_json(changed=changed, results=results, timings=timings.summary(),
+                         msg='Error: failed to prepare standby instances: ' + ', '.join(failed))
+    module.exit_json(changed=changed, results=results, standby=pool.standby(), timings=timings.summary(),
+                     msg='warm pool for ' + params['source_image'] + ': ' + str(params['pool_size']) +
+                         ' standby instances')
+
+
+# admits clone+boot work across concurrent module runs, coordinated through a state file: requests are served in
+# FIFO order, each once its memsize plus the guest memory already committed fits within memory_share of host RAM
+# and fewer than boots_per_cpu boots per host CPU are in progress. missing, given the VMs committed outside of any
+# boot in progress, returns those of its own module's that no longer exist or no longer run, whose memory is then
+# released
+class AdmissionScheduler():
+    def __init__(self, path, memory_share, boots_per_cpu, timeout, missing=None):
+        self.path = path
+        self.memory_share = memory_share
+        self.max_boots = max(1, int(boots_per_cpu * multiprocessing.cpu_count()))
+        self.timeout = timeout
+        self.missing = missing
+
+    @staticmethod
+    def host_memory():
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1048576
+        except (ValueError, OSError, AttributeError):
+            p = subprocess.Popen(['sysctl', '-n', 'hw.memsize'], stdout=subprocess.PIPE)
+            return int(p.communicate()[0]) // 1048576
+
+    # queued and booting entries of runs that died without cleaning up are dropped
+    def prune(self, state):
+        state['queue'] = [entry for entry in state.setdefault('queue', []) if process_alive(entry['pid'])]
+        state['booting'] = dict((ticket, entry) for (ticket, entry) in state.setdefault('booting', {}).items()
+                                if process_alive(entry['pid']))
+        state.setdefault('committed', {})
+
+    def fits(self, state, vm_name, memsize):
+        committed = sum(memory for (name, memory) in state['committed'].items() if name != vm_name)
+        return len(state['booting']) < self.max_boots and \
+            committed + memsize <= self.memory_share * self.host_memory()
+
+    @staticmethod
+    def settled(state):
+        booting = set(entry['vm'] for entry in state['booting'].values())
+        return [name for name in state['committed'] if name not in booting]
+
+    # blocks until the boot is admitted and returns its ticket, or returns None after timeout seconds
+    def admit(self, vm_name, memsize):
+        memsize = int(memsize)
+        ticket = uuid4().hex
+        with StateFile(self.path) as state:
+            self.prune(state)
+            state['queue'].append(dict(ticket=ticket, pid=os.getpid(), vm=vm_name, memsize=memsize))
+        deadline = time() + self.timeout
+        delay = 0.1
+        # VMs deleted, powered off or failed outside of this module leave their memory committed, so the first time
+        # the boot has to wait the committed VMs are checked; they are looked up outside the lock, and only those
+        # that were not booting when the lock was taken, which run by now unless they were stopped or are gone
+        checked = self.missing is None
+        while True:
+            gone = []
+            with StateFile(self.path) as state:
+                self.prune(state)
+                if state['queue'][0]['ticket'] == ticket and self.fits(state, vm_name, memsize):
+                    state['queue'].pop(0)
+                    state['booting'][ticket] = dict(pid=os.getpid(), vm=vm_name)
+                    state['committed'][vm_name] = memsize
+                    return ticket
+                if time() > deadline:
+                    state['queue'] = [entry for entry in state['queue'] if entry['ticket'] != ticket]
+                    return None
+                settled = not checked and self.settled(state)
+            if settled:
+                checked = True
+                gone = self.missing(settled)
+            if gone:
+                self.forget_gone(gone)
+                continue
+            sleep(delay)
+            delay = min(delay * 2, 2)
+
+    # VMs admitted again since they were found missing are booting, and keep their memory
+    def forget_gone(self, gone):
+        with StateFile(self.path) as state:
+            self.prune(state)
+            settled = self.settled(state)
+            for vm_name in gone:
+                if vm_name in settled:
+                    del state['committed'][vm_name]
+
+    def release(self, ticket):
+        with StateFile(self.path) as state:
+            state.setdefault('booting', {}).pop(ticket, None)
+
+    def rename(self, vm_name, new_name):
+        with StateFile(self.path) as state:
+            committed = state.setdefault('committed', {})
+            if vm_name in committed:
+                committed[new_name] = committed.pop(vm_name)
+
+    def forget(self, vm_name):
+        with StateFile(self.path) as state:
+            state.setdefault('committed', {}).pop(vm_name, None)
+
+
+def make_scheduler(params, missing=None):
+    if params['admission']:
+        return AdmissionScheduler(params['admission_state'], params['max_memory_share'], params['boots_per_cpu'],
+                                  params['admission_timeout'], missing)
+    return None
+
+
+# runs function in a grandchild detached from the module's session and output, so that the module can exit
+def run_detached(function):
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            function()
+    finally:
+        os._exit(0)
+
+
+# hands the task to the vmmanager_controller listening on controller_socket, if there is one, and exits with its
+# result; returns when none is listening, for the task to be run in this process
+def run_on_controller(module, module_name):
+    path = module.params['controller_socket'] and os.path.expanduser(module.params['controller_socket'])
+    if not path or not os.path.exists(path):
+        return
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        client.close()
+        return
+    try:
+        client.sendall((json.dumps(dict(module=module_name, params=module.params)) + '\n').encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+        data = b''.join(iter(lambda: client.recv(65536), b''))
+    finally:
+        client.close()
+    try:
+        reply = json.loads(data.decode('utf-8'))
+    except ValueError:
+        module.fail_json(msg='Error: vmmanager_controller at ' + path + ' closed the connection without a result')
+    if reply['failed']:
+        module.fail_json(**reply['result'])
+    module.exit_json(**reply['result'])
@@ -0,0 +1,301 @@
+# fusion_instance's resolution of guest addresses from the host's DHCP leases and the bundles' vmx files, and its
+# full clones of VM bundles, and its reuse of vmrest connections
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils'))
+
+import fusion_instance
+from fusion_instance import Fusion, LeaseIndex, VmrestConnection, clone_bundle, clone_file, copy_data, vmx_nics
+from vmmanager_controller import TaskExit, TaskModule
+
+vmrun = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench', 'vmrun')
+
+VMX = '''.encoding = "UTF-8"
+displayName = "web01"
+memsize = "512"
+ethernet0.present = "TRUE"
+ethernet0.addressType = "generated"
+ethernet0.generatedAddress = "00:0C:29:AA:00:01"
+ethernet1.present = "TRUE"
+ethernet1.connectionType = "hostonly"
+ethernet1.addressType = "static"
+ethernet1.address = "00:50:56:3F:00:02"
+ethernet1.startConnected = "FALSE"
+ethernet2.present = "FALSE"
+ethernet2.generatedAddress = "00:0c:29:aa:00:03"
+'''
+
+
+def lease(ipaddress, mac, ends='2099/01/01 00:00:00'):
+    return 'lease %s {\n\tstarts 4 2024/01/01 00:00:00;\n\tends 4 %s;\n\thardware ethernet %s;\n}\n' % \
+        (ipaddress, ends, mac)
+
+
+def write(path, data, mode='w'):
+    fh = open(str(path), mode)
+    fh.write(data)
+    fh.close()
+
+
+@pytest.fixture
+def vmbasedir(tmpdir):
+    bundle = tmpdir.mkdir('Virtual Machines').mkdir('web01.vmwarevm')
+    write(bundle.join('web01.vmx'), VMX)
+    return tmpdir.join('Virtual Machines')
+
+
+def make_fusion(vmbasedir, leases, **kwargs):
+    return Fusion('golden-image', 'web01', '512', 'linked', 'yes', vmrun, str(vmbasedir),
+                  lease_index=LeaseIndex([str(leases)]), **kwargs)
+
+
+def test_vmx_nics_lists_the_present_nics_in_order(vmbasedir):
+    nics = vmx_nics(str(vmbasedir.join('web01.vmwarevm', 'web01.vmx')))
+    assert nics == [dict(index=0, mac='00:0c:29:aa:00:01', connection_type='bridged', status='up'),
+                    dict(index=1, mac='00:50:56:3f:00:02', connection_type='hostonly', status='down')]
+
+
+def test_lease_index_reads_only_what_was_appended(tmpdir):
+    leases = tmpdir.join('vmnet8.leases')
+    write(leases, lease('172.16.0.10', '00:0c:29:aa:00:01'))
+    index = LeaseIndex([str(leases)])
+    assert index.lookup(['00:0c:29:aa:00:01']) == '172.16.0.10'
+    offset = index.files[str(leases)]['offset']
+    assert offset == os.path.getsize(str(leases))
+
+    # a lease being written is kept until it is complete
+    record = lease('172.16.0.11', '00:50:56:3f:00:02')
+    write(leases, record[:20], 'a')
+    assert index.lookup(['00:50:56:3f:00:02']) is None
+    assert index.files[str(leases)]['pending'].endswith(record[:20])
+    write(leases, record[20:], 'a')
+    assert index.lookup(['00:50:56:3f:00:02']) == '172.16.0.11'
+    assert index.lookup(['00:0c:29:aa:00:01']) == '172.16.0.10'
+
+    # a renewal appends a newer lease for the same MAC address
+    write(leases, lease('172.16.0.12', '00:0c:29:aa:00:01'), 'a')
+    assert index.lookup(['00:0c:29:aa:00:01']) == '172.16.0.12'
+    assert index.files[str(leases)]['offset'] == os.path.getsize(str(leases))
+
+
+def test_lease_index_reads_a_rewritten_file_again(tmpdir):
+    leases = tmpdir.join('vmnet8.leases')
+    write(leases, lease('172.16.0.10', '00:0c:29:aa:00:01') + lease('172.16.0.11', '00:50:56:3f:00:02'))
+    index = LeaseIndex([str(leases)])
+    assert index.lookup(['00:50:56:3f:00:02']) == '172.16.0.11'
+    # dhcpd compacts its leases file by writing a shorter one in its place
+    write(str(leases) + '.new', lease('172.16.0.20', '00:0c:29:aa:00:01'))
+    os.rename(str(leases) + '.new', str(leases))
+    assert index.lookup(['00:50:56:3f:00:02']) is None
+    assert index.lookup(['00:0c:29:aa:00:01']) == '172.16.0.20'
+
+
+def test_lease_index_ignores_expired_leases(tmpdir):
+    leases = tmpdir.join('vmnet8.leases')
+    write(leases, lease('172.16.0.10', '00:0c:29:aa:00:01', ends='2000/01/01 00:00:00'))
+    assert LeaseIndex([str(tmpdir.join('*.leases'))]).lookup(['00:0c:29:aa:00:01']) is None
+
+
+def test_lease_ipaddress_of_ip_nic(vmbasedir, tmpdir):
+    leases = tmpdir.join('vmnet8.leases')
+    write(leases, lease('172.16.0.10', '00:0c:29:aa:00:01') + lease('192.168.56.5', '00:50:56:3f:00:02'))
+    assert make_fusion(vmbasedir, leases).lease_ipaddress() == '172.16.0.10'
+    assert make_fusion(vmbasedir, leases, ip_nic=1).lease_ipaddress() == '192.168.56.5'
+    # the address of ip_nic comes from the leases even with ip_resolver=vmrun, as VMware Tools only report one
+    assert make_fusion(vmbasedir, leases, ip_nic=1, ip_resolver='vmrun').current_ipaddress() == '192.168.56.5'
+    assert make_fusion(vmbasedir, leases, ip_nic=2).lease_ipaddress() is None
+
+
+def test_nic_facts_carry_the_leased_addresses(vmbasedir, tmpdir):
+    leases = tmpdir.join('vmnet8.leases')
+    write(leases, lease('192.168.56.5', '00:50:56:3f:00:02'))
+    nics = make_fusion(vmbasedir, leases).nic_facts()
+    assert [(nic['index'], nic['ipv4']) for nic in nics] == [(0, None), (1, '192.168.56.5')]
+
+
+def test_suspending_a_missing_vm_fails_the_task(vmbasedir, tmpdir):
+    params = dict(source_image='golden-image', target_image='web09', target_images=None, target_pattern=None,
+                  state='suspended', memsize='512', numvcpus=None, clone_type='linked', clone_engine='auto',
+                  headless='yes', vmrunexe=vmrun, vmbasedir=str(vmbasedir), ip_resolver='auto', ip_nic=None,
+                  dhcp_leases=[], library_cache=str(tmpdir.join('library.json')), admission=False, stop_timeout=0,
+                  backend='vmrun', pool_state=str(tmpdir.join('pool.json')), trace_file=None, wait_for_port=22,
+                  suspend_state=str(tmpdir.join('suspended.json')))
+    with pytest.raises(TaskExit) as task_exit:
+        fusion_instance.run_task(TaskModule(params))
+    assert task_exit.value.failed
+    assert 'web09' in task_exit.value.result['msg']
+    assert 'timings' in task_exit.value.result
+
+
+def test_vms_powered_off_outside_the_module_are_missing(vmbasedir, tmpdir, monkeypatch):
+    monkeypatch.setenv('BENCH_DIR', str(tmpdir))
+    write(tmpdir.join('vmrun.json'), '{"running": {}}')
+    f = make_fusion(vmbasedir, tmpdir.join('vmnet-dhcpd.leases'))
+    web01, web02 = f.bundle_vmx('web01'), f.bundle_vmx('web02')
+    assert f.run(['start', web01])[0] == 0
+    assert fusion_instance.missing_vms(f, [web01, web02, 'web03']) == [web02]
+    # shut down from the guest
+    assert f.run(['stop', web01])[0] == 0
+    assert fusion_instance.missing_vms(f, [web01, web02, 'web03']) == [web01, web02]
+
+
+GOLDEN_VMX = '''.encoding = "UTF-8"
+displayName = "golden"
+uuid.bios = "56 4d 00 00 00 00 00 01-00 00 00 00 00 00 00 01"
+uuid.location = "56 4d 00 00 00 00 00 01-00 00 00 00 00 00 00 01"
+vc.uuid = "52 00 00 00 00 00 00 01-00 00 00 00 00 00 00 01"
+checkpoint.vmState = "golden-1a2b.vmss"
+scsi0:0.fileName = "disk.vmdk"
+'''
+
+DESCRIPTOR = b'''# Disk DescriptorFile
+version=1
+CID=fffffffe
+createType="twoGbMaxExtentSparse"
+RW 8388608 SPARSE "disk-s001.vmdk"
+ddb.adapterType = "lsilogic"
+ddb.uuid.image = "1a2b3c4d-0000-0000-0000-000000000001"
+ddb.virtualHWVersion = "19"
+'''
+
+
+def sparse_file(path, size, data_offset):
+    fh = open(str(path), 'wb')
+    fh.truncate(size)
+    fh.seek(data_offset)
+    fh.write(b'x' * 65536)
+    fh.close()
+    if os.stat(str(path)).st_blocks * 512 >= size:
+        pytest.skip('the filesystem of the test directory does not keep holes')
+
+
+def assert_sparse_copy(source, target):
+    assert os.path.getsize(str(target)) == os.path.getsize(str(source))
+    assert open(str(target), 'rb').read() == open(str(source), 'rb').read()
+    assert os.stat(str(target)).st_blocks <= os.stat(str(source)).st_blocks + 256
+
+
+def test_clone_file_keeps_sparse_files_sparse(tmpdir):
+    sparse_file(tmpdir.join('disk.vmdk'), 64 * 1048576, 32 * 1048576)
+    assert clone_file(str(tmpdir.join('disk.vmdk')), str(tmpdir.join('copy.vmdk'))) in \
+        ('reflink', 'clonefile', 'copy_file_range', 'sparse')
+    assert_sparse_copy(tmpdir.join('disk.vmdk'), tmpdir.join('copy.vmdk'))
+
+
+def test_chunked_copy_leaves_holes_and_zero_chunks_unwritten(tmpdir, monkeypatch):
+    monkeypatch.delattr(os, 'copy_file_range', raising=False)
+    sparse_file(tmpdir.join('disk.vmdk'), 16 * 1048576, 4 * 1048576)
+    # a run of zeros written out in full is not copied either
+    fh = open(str(tmpdir.join('disk.vmdk')), 'r+b')
+    fh.seek(8 * 1048576)
+    fh.write(b'\0' * 1048576)
+    fh.close()
+    src = open(str(tmpdir.join('disk.vmdk')), 'rb')
+    dst = open(str(tmpdir.join('copy.vmdk')), 'wb')
+    assert copy_data(src, dst) == 'sparse'
+    src.close()
+    dst.close()
+    assert_sparse_copy(tmpdir.join('disk.vmdk'), tmpdir.join('copy.vmdk'))
+    assert os.stat(str(tmpdir.join('copy.vmdk'))).st_blocks * 512 < 1048576
+
+
+def test_clone_bundle_copies_the_vm_without_its_identity_or_state(vmbasedir):
+    source = vmbasedir.mkdir('golden.vmwarevm')
+    write(source.join('golden.vmx'), GOLDEN_VMX)
+    write(source.join('disk.vmdk'), DESCRIPTOR, 'wb')
+    write(source.join('disk-s001.vmdk'), 'extent')
+    for name in ('golden.nvram', 'golden.vmx.lck', 'vmware.log', 'vmware-1.log', 'golden-1a2b.vmss',
+                 'golden-1a2b.vmem'):
+        write(source.join(name), 'data')
+    target_vmx = str(vmbasedir.join('web02.vmwarevm', 'web02.vmx'))
+    assert clone_bundle(str(source.join('golden.vmx')), target_vmx)
+    assert sorted(os.listdir(os.path.dirname(target_vmx))) == ['disk-s001.vmdk', 'disk.vmdk', 'golden.nvram',
+                                                                'web02.vmx']
+    # the bundle was assembled aside and renamed into place
+    assert sorted(os.listdir(str(vmbasedir))) == ['golden.vmwarevm', 'web01.vmwarevm', 'web02.vmwarevm']
+    descriptor = open(str(vmbasedir.join('web02.vmwarevm', 'disk.vmdk')), 'rb').read()
+    assert b'ddb.uuid.image' not in descriptor
+    assert descriptor == DESCRIPTOR.replace(b'ddb.uuid.image = "1a2b3c4d-0000-0000-0000-000000000001"\n', b'')
+    config = fusion_instance.VMX(target_vmx).as_dict()
+    assert not [key for key in config if key.startswith(('uuid.bios', 'uuid.location', 'vc.uuid', 'checkpoint.'))]
+    assert config['uuid.action'] == 'create'
+    assert config['displayname'] == 'golden'
+
+
+# answers the requests on its connections as scripted: 'reply' keeps the connection open, 'reply-close' closes it
+# after the reply, as vmrest does with idle connections, and 'drop' closes it without a reply
+class ScriptedServer():
+    def __init__(self, actions):
+        self.actions = list(actions)
+        self.requests = []
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.url = 'http://127.0.0.1:%d/api' % self.server.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_request(self, conn):
+        data = b''
+        while b'\r\n\r\n' not in data:
+            chunk = conn.recv(4096)
+            if not chunk:
+                return None
+            data += chunk
+        head, body = data.split(b'\r\n\r\n', 1)
+        for line in head.split(b'\r\n')[1:]:
+            if line.lower().startswith(b'content-length:'):
+                while len(body) < int(line.split(b':')[1]):
+                    body += conn.recv(4096)
+        return head.split(b'\r\n')[0].decode('ascii')
+
+    def serve(self):
+        while self.actions:
+            conn = self.server.accept()[0]
+            while self.actions:
+                request = self.read_request(conn)
+                if request is None:
+                    break
+                self.requests.append(request)
+                action = self.actions.pop(0)
+                if action != 'drop':
+                    conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}')
+                if action != 'reply':
+                    break
+            conn.close()
+        self.server.close()
+
+
+def test_vmrest_connection_closed_while_idle_is_reopened():
+    server = ScriptedServer(['reply-close', 'reply'])
+    connection = VmrestConnection(server.url, None, None, timeout=5)
+    assert connection.request('GET', '/api/vms', None) == (200, b'{}')
+    time.sleep(0.2)
+    assert connection.request('POST', '/api/vms/registration', '{}') == (200, b'{}')
+    assert server.requests == ['GET /api/vms HTTP/1.1', 'POST /api/vms/registration HTTP/1.1']
+
+
+def test_vmrest_get_without_a_reply_is_sent_again():
+    server = ScriptedServer(['reply', 'drop', 'reply'])
+    connection = VmrestConnection(server.url, None, None, timeout=5)
+    assert connection.request('GET', '/api/vms', None) == (200, b'{}')
+    assert connection.request('GET', '/api/vms/1/power', None) == (200, b'{}')
+    assert server.requests[1:] == ['GET /api/vms/1/power HTTP/1.1'] * 2
+
+
+@pytest.mark.parametrize('method', ['POST', 'PUT', 'DELETE'])
+def test_vmrest_request_without_a_reply_is_not_sent_again(method):
+    server = ScriptedServer(['reply', 'drop', 'reply'])
+    connection = VmrestConnection(server.url, None, None, timeout=5)
+    assert connection.request('GET', '/api/vms', None) == (200, b'{}')
+    with pytest.raises((fusion_instance.httplib.HTTPException, socket.error)):
+        connection.request(method, '/api/vms/1', '{}')
+    assert server.requests[1:] == [method + ' /api/vms/1 HTTP/1.1']
@@ -0,0 +1,260 @@
+# vbox_instance's provisioning flows against FakeBackend, its in-memory VirtualBox; the modules import Ansible's
+# module_utils, so Ansible has to be installed to run them, as for the benchmark
+import os
+import socket
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils'))
+
+import vbox_instance
+from vbox_instance import FakeBackend, InterfaceCache, IsolatedModule, SuspendedVMs, VBox, VBoxManageBackend, \
+    VMFailure, VMInventory, WarmPool
+
+
+@pytest.fixture
+def backend():
+    return FakeBackend(IsolatedModule(None), vms=['golden-image'])
+
+
+def make_vbox(backend, tmpdir, target_image, inventory=None, pool=None, probe_port=22):
+    return VBox(IsolatedModule(None), 'VBoxManage', 'golden-image', target_image, '512', 'bridged', 'running',
+                backend=backend, inventory=inventory or VMInventory(backend),
+                interfaces=InterfaceCache(backend, str(tmpdir.join('interfaces.json')), 0),
+                pool=pool, suspended=SuspendedVMs(str(tmpdir.join('suspended.json'))), probe_port=probe_port)
+
+
+def calls(backend, operation):
+    return [ref for (call, ref) in backend.calls if call == operation]
+
+
+def phases(backend, vm):
+    return [record['phase'] for record in backend.timings.phases if record['vm'] == vm]
+
+
+@pytest.fixture
+def listener():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    yield server.getsockname()[1]
+    server.close()
+
+
+def test_start_clones_configures_and_boots(backend, tmpdir):
+    v = make_vbox(backend, tmpdir, 'web01')
+    v.start_vm()
+    assert v.is_running
+    assert v.ipaddress == '10.0.0.3'
+    assert v.nics[0]['mac'] == '08:00:27:00:00:01'
+    # the clone's memory is already as desired, so only its network is changed
+    assert backend.vms['web01']['settings'] == {'--nic1': 'bridged', '--bridgeadapter1': 'en0: Wi-Fi (AirPort)'}
+    assert phases(backend, 'web01') == ['clone', 'configure', 'boot', 'ip_wait']
+
+
+def test_reconcile_of_a_configured_vm_changes_nothing(backend, tmpdir):
+    v = make_vbox(backend, tmpdir, 'web01')
+    v.start_vm()
+    v.stop_vm()
+    backend.calls = []
+    v = make_vbox(backend, tmpdir, 'web01')
+    assert v.reconcile() == []
+    assert calls(backend, 'modify') == []
+
+
+def test_reconcile_only_applies_the_differences(backend, tmpdir):
+    v = make_vbox(backend, tmpdir, 'web01')
+    v.start_vm()
+    v.stop_vm()
+    v = make_vbox(backend, tmpdir, 'web01')
+    v.memsize = '1024'
+    assert v.reconcile() == [('--memory', '1024')]
+
+
+def test_running_vm_is_not_reconfigured(backend, tmpdir):
+    v = make_vbox(backend, tmpdir, 'web01')
+    v.start_vm()
+    v = make_vbox(backend, tmpdir, 'web01')
+    v.memsize = '1024'
+    assert v.reconcile() == []
+
+
+def test_resume_takes_the_recorded_address(backend, tmpdir, listener):
+    v = make_vbox(backend, tmpdir, 'web01', probe_port=listener)
+    v.start_vm()
+    backend.vms['web01']['properties']['/VirtualBox/GuestInfo/Net/0/V4/IP'] = '127.0.0.1'
+    assert v.suspend_vm()
+    assert backend.vms['web01']['saved']
+    assert not v.is_running
+    # suspending a saved VM again changes nothing
+    assert not make_vbox(backend, tmpdir, 'web01').suspend_vm()
+
+    backend.timings.phases = []
+    v = make_vbox(backend, tmpdir, 'web01', probe_port=listener)
+    v.start_vm()
+    assert v.resumed
+    assert v.ipaddress == '127.0.0.1'
+    assert phases(backend, 'web01') == ['configure', 'resume', 'ip_wait']
+    # the recorded address is only used for one resume
+    assert SuspendedVMs(str(tmpdir.join('suspended.json'))).pop(v.target_ref) is None
+
+
+def test_resume_waits_for_an_address_when_the_recorded_one_is_unreachable(backend, tmpdir, listener):
+    v = make_vbox(backend, tmpdir, 'web01', probe_port=listener)
+    v.start_vm()
+    v.suspend_vm()
+    SuspendedVMs(str(tmpdir.join('suspended.json'))).record(v.target_ref, '127.0.0.2')
+    v = make_vbox(backend, tmpdir, 'web01', probe_port=listener)
+    v.resume_probe_timeout = 0.5
+    v.start_vm()
+    assert v.resumed
+    assert v.ipaddress == '10.0.0.3'
+
+
+def test_only_a_running_vm_can_be_suspended(backend, tmpdir):
+    v = make_vbox(backend, tmpdir, 'web01')
+    with pytest.raises(VMFailure):
+        v.suspend_vm()
+    v.start_vm()
+    v.stop_vm()
+    with pytest.raises(VMFailure):
+        v.suspend_vm()
+
+
+def test_claimed_standby_is_renamed_at_its_next_reconcile(backend, tmpdir):
+    inventory = VMInventory(backend)
+    pool = WarmPool(str(tmpdir.join('pool.json')), 'golden-image', dict(memsize='512', network_type='bridged'))
+    standby, = pool.resize(1, list)[0]
+    make_vbox(backend, tmpdir, standby, inventory=inventory).start_vm()
+    pool.add_standby(standby)
+    backend.calls = []
+
+    v = make_vbox(backend, tmpdir, 'web01', inventory=inventory, pool=pool)
+    v.start_vm()
+    assert v.claimed_standby
+    assert v.vm_name == standby
+    assert v.ipaddress == '10.0.0.3'
+    assert calls(backend, 'clone') == []
+    assert calls(backend, 'start') == []
+    assert backend.vms[standby]['extradata'] == {'ansible/target_image': 'web01'}
+    assert pool.standby() == []
+
+    v = make_vbox(backend, tmpdir, 'web01', inventory=inventory, pool=pool)
+    v.stop_vm()
+    v.start_vm()
+    assert not v.claimed_standby
+    assert 'web01' in backend.vms and standby not in backend.vms
+    assert inventory.uuid('web01') is not None
+    assert WarmPool(pool.path, 'golden-image', pool.settings).claimed('web01') is None
+
+
+def test_standby_with_other_settings_is_not_claimed(backend, tmpdir):
+    inventory = VMInventory(backend)
+    filled = WarmPool(str(tmpdir.join('pool.json')), 'golden-image', dict(memsize='1024', network_type='bridged'))
+    standby, = filled.resize(1, list)[0]
+    make_vbox(backend, tmpdir, standby, inventory=inventory).start_vm()
+    filled.add_standby(standby)
+
+    pool = WarmPool(filled.path, 'golden-image', dict(memsize='512', network_type='bridged'))
+    v = make_vbox(backend, tmpdir, 'web01', inventory=inventory, pool=pool)
+    v.start_vm()
+    assert not v.claimed_standby
+    assert pool.standby() == [standby]
+
+
+def test_standby_without_an_address_is_deleted_rather_than_pooled(backend, tmpdir, monkeypatch):
+    monkeypatch.setattr(vbox_instance, 'make_backend', lambda module, params, session=None: backend)
+    monkeypatch.setattr(VBox, 'wait_for_ipaddress',
+                        lambda self: self.module.fail_json(msg='Timeout exceeded while trying to get VM ip address'))
+    params = dict(vboxmanage='VBoxManage', source_image='golden-image', memsize='512', network_type='bridged',
+                  state='pooled', ip_timeout=1, interface_cache=str(tmpdir.join('interfaces.json')),
+                  interface_cache_ttl=0, bridge_adapter='en0.+|eth.+', hostonly_adapter='.+', admission=False,
+                  ip_nic=0, stop_timeout=0, suspend_state=str(tmpdir.join('suspended.json')), wait_for_port=22,
+                  pool_state=str(tmpdir.join('pool.json')), max_parallel=1)
+    results = vbox_instance.fill_pool(None, params, 1)[0]
+    assert [result['failed'] for result in results] == [True]
+    pool = vbox_instance.make_pool(params)
+    assert pool.standby() == []
+    # nor is it counted as being built
+    assert len(pool.resize(1, list)[0]) == 1
+    assert list(backend.vms) == ['golden-image']
+
+
+def test_delete_removes_the_vm(backend, tmpdir):
+    v = make_vbox(backend, tmpdir, 'web01')
+    v.start_vm()
+    v.delete_vm()
+    assert not v.exists
+    assert 'web01' not in backend.vms
+    assert calls(backend, 'poweroff')
+
+
+def test_deferred_delete_of_a_saved_vm_removes_its_machine_folder(tmpdir, monkeypatch):
+    folder = tmpdir.mkdir('web01')
+    for path in ('web01.vbox', 'web01.vbox-prev', 'Logs/VBox.log', 'Snapshots/{0000}.sav'):
+        folder.join(path).ensure()
+    # every VBoxManage command succeeds, and the VM's settings are as showvminfo reports them
+    backend = VBoxManageBackend(IsolatedModule(None), 'true')
+    monkeypatch.setattr(backend, 'vm_info', lambda ref: dict(
+        VMState='saved', CfgFile=str(folder.join('web01.vbox')),
+        VMStateFile=str(folder.join('Snapshots', '{0000}.sav'))))
+    backend.delete_media(backend.unregister('web01'))
+    assert not folder.exists()
+
+
+def test_batch_failure_is_isolated(backend, tmpdir):
+    def worker(target_image):
+        v = make_vbox(backend, tmpdir, target_image)
+        v.source_image = target_image == 'web02' and 'missing-image' or 'golden-image'
+        v.start_vm()
+        return dict(target_image=target_image, changed=True, failed=False)
+
+    results = vbox_instance.run_batch(['web01', 'web02', 'web03'], worker, 2)
+    assert [result['failed'] for result in results] == [False, True, False]
+    assert 'missing-image' in results[1]['msg']
+
+
+# a VBoxManage knowing only web01, whose guest reports its address once enumerated as often as given, and whose
+# guestproperty wait behaves as given; it logs its subcommands
+FAKE_VBOXMANAGE = '''#!%s
+import sys, time
+log = open(%r, 'a')
+log.write(' '.join(sys.argv[1:3]) + '\\n')
+log.close()
+if sys.argv[1:3] == ['list', 'vms']:
+    print('"web01" {00000000-0000-0000-0000-000000000001}')
+elif sys.argv[1:3] == ['guestproperty', 'enumerate']:
+    if len([line for line in open(%r) if line.startswith('guestproperty enumerate')]) > %d:
+        print("/VirtualBox/GuestInfo/Net/0/V4/IP = '10.0.0.9' @ 2024-01-01T00:00:00.000000000Z")
+elif sys.argv[1:3] == ['guestproperty', 'wait']:
+%s
+'''
+
+
+def scripted_vbox(tmpdir, enumerations, wait):
+    log = str(tmpdir.join('calls.log'))
+    script = tmpdir.join('VBoxManage')
+    script.write(FAKE_VBOXMANAGE % (sys.executable, log, log, enumerations, wait))
+    script.chmod(0o755)
+    v = VBox(IsolatedModule(None), str(script), 'golden-image', 'web01', '512', 'bridged', 'running',
+             backend=VBoxManageBackend(IsolatedModule(None), str(script)), ip_timeout=20)
+    return v, lambda: [line.strip() for line in open(log)]
+
+
+def test_vboxmanage_without_fail_on_timeout_is_polled(tmpdir):
+    v, calls = scripted_vbox(tmpdir, 2, "    print('Syntax error: Unknown option: --fail-on-timeout')\n"
+                                        "    sys.exit(2)")
+    assert v.wait_for_ipaddress() == '10.0.0.9'
+    assert calls().count('guestproperty wait') == 1
+    assert calls().count('guestproperty enumerate') == 3
+
+
+def test_address_reported_before_the_wait_ends_it(tmpdir):
+    v, calls = scripted_vbox(tmpdir, 0, "    time.sleep(30)")
+    start = time.time()
+    assert v.wait_for_ipaddress() == '10.0.0.9'
+    assert time.time() - start < 5
+    assert calls().count('guestproperty wait') == 1
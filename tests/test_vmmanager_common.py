@@ -0,0 +1,246 @@
+# the helpers that vbox_instance and fusion_instance share through module_utils
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils'))
+
+import vbox_instance
+from vmmanager_common import AdmissionScheduler, StateFile, WarmPool, pattern_targets, wait_for_ports
+
+
+@pytest.fixture
+def scheduler(tmpdir, monkeypatch):
+    monkeypatch.setattr(AdmissionScheduler, 'host_memory', staticmethod(lambda: 2048))
+    scheduler = AdmissionScheduler(str(tmpdir.join('admission.json')), 0.5, 1, 0.5)
+    scheduler.max_boots = 2
+    return scheduler
+
+
+@pytest.fixture
+def pool(tmpdir):
+    return WarmPool(str(tmpdir.join('pool.json')), 'golden-image', dict(memsize='512'))
+
+
+def state(scheduler):
+    with StateFile(scheduler.path) as admission:
+        return json.loads(json.dumps(admission))
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def listen(address, port, delay=0):
+    time.sleep(delay)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server.bind((address, port))
+    except socket.error:
+        server.close()
+        pytest.skip('cannot listen on ' + address)
+    server.listen(5)
+    return server
+
+
+def test_wait_for_ports_waits_for_a_listener_that_opens_late():
+    port = free_port()
+    servers = []
+    opener = threading.Thread(target=lambda: servers.append(listen('127.0.0.1', port, 0.6)))
+    start = time.time()
+    opener.start()
+    try:
+        ready = wait_for_ports(['127.0.0.1'], port, 10)
+    finally:
+        opener.join()
+        servers[0].close()
+    assert 0.6 <= ready['127.0.0.1'] - start < 5
+
+
+def test_wait_for_ports_gives_up_on_a_refused_port_at_the_timeout():
+    start = time.time()
+    assert wait_for_ports(['127.0.0.1'], free_port(), 1) == {'127.0.0.1': None}
+    assert 1 <= time.time() - start < 2
+
+
+def test_wait_for_ports_probes_every_address_at_once():
+    port = free_port()
+    servers = [listen('127.0.0.1', port), listen('127.0.0.2', port)]
+    start = time.time()
+    try:
+        ready = wait_for_ports(['127.0.0.1', '127.0.0.2', '127.0.0.3'], port, 1.5)
+    finally:
+        for server in servers:
+            server.close()
+    assert ready['127.0.0.1'] - start < 0.5
+    assert ready['127.0.0.2'] - start < 0.5
+    assert ready['127.0.0.3'] is None
+    # the refused address does not hold up the others, nor do they add to its timeout
+    assert time.time() - start < 2.5
+
+
+def test_state_file_with_a_bare_file_name_lives_in_the_working_directory(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    with StateFile('cache.json') as cache:
+        cache['key'] = 'value'
+    assert json.loads(tmpdir.join('cache.json').read()) == {'key': 'value'}
+
+
+def test_state_file_tolerates_a_directory_created_meanwhile(tmpdir, monkeypatch):
+    makedirs = os.makedirs
+
+    # another run creates the directory between the check and makedirs
+    def racing_makedirs(path):
+        makedirs(path)
+        makedirs(path)
+
+    monkeypatch.setattr(os, 'makedirs', racing_makedirs)
+    with StateFile(str(tmpdir.join('tmp', 'cache.json'))) as cache:
+        cache['key'] = 'value'
+    assert json.loads(tmpdir.join('tmp', 'cache.json').read()) == {'key': 'value'}
+
+
+def test_resize_counts_the_standby_vms_being_built(pool):
+    building = pool.resize(2, list)[0]
+    assert len(building) == 2
+    # a concurrent refill has nothing left to build
+    assert WarmPool(pool.path, pool.source_image, pool.settings).resize(2, list) == ([], [])
+    pool.add_standby(building[0])
+    pool.abandon(building[1])
+    assert pool.standby() == building[:1]
+    assert len(pool.resize(2, list)[0]) == 1
+
+
+def test_resize_drops_gone_and_surplus_standby_vms(pool):
+    building = pool.resize(3, list)[0]
+    for name in building:
+        pool.add_standby(name)
+    assert pool.resize(1, lambda standby: standby[1:]) == ([], building[2:])
+    assert pool.standby() == building[1:2]
+
+
+def test_standby_vms_of_dead_runs_are_built_again(pool):
+    with StateFile(pool.path) as pools:
+        pools['pools'] = {'golden-image': dict(size=1, standby=[], building=[dict(name='x', pid=2 ** 22 + 1)])}
+    assert len(pool.resize(1, list)[0]) == 1
+
+
+def test_claimed_standby_stays_claimed_through_a_resize(pool):
+    standby, = pool.resize(1, list)[0]
+    pool.add_standby(standby)
+    assert pool.claim('web01', lambda name: True) == standby
+    pool.resize(1, list)
+    assert pool.standby() == []
+    assert WarmPool(pool.path, pool.source_image, pool.settings).claimed('web01') == standby
+
+
+def test_pattern_targets_leave_the_source_and_standby_vms_alone(pool, tmpdir):
+    backend = vbox_instance.FakeBackend(vbox_instance.IsolatedModule(None), vms=['web-golden', 'web01', 'db01'])
+    standby, claimed = pool.resize(2, list)[0]
+    for name in (standby, claimed):
+        backend.vms[name] = dict(uuid=name, running=True)
+        pool.add_standby(name)
+    pool.claim('web02', lambda name: name == claimed)
+    params = dict(target_pattern='web.*|' + standby, source_image='golden')
+    assert pattern_targets(params, vbox_instance.VMInventory(backend), pool) == ['web01', 'web02']
+
+
+def test_admitted_boot_commits_its_memory_until_forgotten(scheduler):
+    ticket = scheduler.admit('web01', '512')
+    assert ticket
+    assert state(scheduler)['committed'] == {'web01': 512}
+    scheduler.release(ticket)
+    assert state(scheduler)['booting'] == {}
+    assert state(scheduler)['committed'] == {'web01': 512}
+    scheduler.forget('web01')
+    assert state(scheduler)['committed'] == {}
+
+
+def test_boot_beyond_the_memory_share_times_out(scheduler):
+    scheduler.release(scheduler.admit('web01', '768'))
+    assert scheduler.admit('web02', '512') is None
+    assert state(scheduler)['queue'] == []
+    # a VM admitted again is not counted twice
+    assert scheduler.admit('web01', '1024')
+
+
+def test_boots_beyond_the_boot_limit_wait(scheduler):
+    first = scheduler.admit('web01', '128')
+    assert scheduler.admit('web02', '128')
+    assert scheduler.admit('web03', '128') is None
+    scheduler.release(first)
+    assert scheduler.admit('web03', '128')
+
+
+def test_entries_of_dead_runs_are_pruned(scheduler):
+    with StateFile(scheduler.path) as admission:
+        admission['queue'] = [dict(ticket='dead', pid=2 ** 22 + 1, vm='web09', memsize=128)]
+        admission['booting'] = dict(dead=dict(pid=2 ** 22 + 1, vm='web09'))
+    assert scheduler.admit('web01', '128')
+    assert [entry['vm'] for entry in state(scheduler)['booting'].values()] == ['web01']
+
+
+def test_memory_of_missing_vms_is_released_once_a_boot_waits(scheduler):
+    checked = []
+
+    def missing(names):
+        checked.append(sorted(names))
+        return [name for name in names if name == 'gone']
+
+    scheduler.missing = missing
+    scheduler.release(scheduler.admit('gone', '768'))
+    booting = scheduler.admit('web01', '128')
+    assert scheduler.admit('web02', '256')
+    # the boot in progress is not checked
+    assert checked == [['gone']]
+    assert sorted(state(scheduler)['committed']) == ['web01', 'web02']
+    scheduler.release(booting)
+
+
+def test_failed_start_releases_its_memory(scheduler, tmpdir):
+    backend = vbox_instance.FakeBackend(vbox_instance.IsolatedModule(None), vms=['golden-image'])
+    v = vbox_instance.VBox(vbox_instance.IsolatedModule(None), 'VBoxManage', 'nomatch', 'web02', '512', 'bridged',
+                           'running', backend=backend, scheduler=scheduler)
+    with pytest.raises(vbox_instance.VMFailure):
+        v.start_vm()
+    assert state(scheduler)['booting'] == {}
+    assert state(scheduler)['committed'] == {}
+
+
+def test_vbox_vms_missing_from_the_registry_or_powered_off(scheduler):
+    backend = vbox_instance.FakeBackend(vbox_instance.IsolatedModule(None), vms=['web01', 'db01'])
+    backend.vms['web01']['running'] = True
+    assert vbox_instance.missing_vms(backend, ['web01', 'db01', 'web02', '/vms/web03.vmwarevm/web03.vmx']) == \
+        ['db01', 'web02']
+
+
+def test_memory_of_a_vm_powered_off_outside_the_module_is_released(scheduler, tmpdir):
+    backend = vbox_instance.FakeBackend(vbox_instance.IsolatedModule(None), vms=['golden-image'])
+    scheduler.missing = lambda names: vbox_instance.missing_vms(backend, names)
+
+    def make_vbox(target_image):
+        return vbox_instance.VBox(vbox_instance.IsolatedModule(None), 'VBoxManage', 'golden-image', target_image,
+                                  '768', 'bridged', 'running', backend=backend, scheduler=scheduler,
+                                  interfaces=vbox_instance.InterfaceCache(backend, str(tmpdir.join('if.json')), 0))
+
+    web01 = make_vbox('web01')
+    web01.start_vm()
+    web01.ipaddress
+    assert state(scheduler)['committed'] == {'web01': 768}
+    # shut down from the guest
+    backend.vms['web01']['running'] = False
+    web02 = make_vbox('web02')
+    web02.start_vm()
+    web02.ipaddress
+    assert state(scheduler)['committed'] == {'web02': 768}
@@ -0,0 +1,48 @@
+# vmmanager_inventory.py's discovery of VirtualBox VMs, against the benchmark's fake VBoxManage, and the hosts it lists
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'module_utils'))
+
+import vmmanager_inventory
+
+vboxmanage = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench', 'VBoxManage')
+
+
+def spawned(tmpdir):
+    return [line.split(' ', 2)[2].strip() for line in open(str(tmpdir.join('calls.log')))]
+
+
+def test_new_vms_take_their_config_files_from_one_listing(tmpdir, monkeypatch):
+    vms = dict(('web%02d' % i, dict(uuid='00000000-0000-0000-0000-%012d' % i, state=i and 'poweroff' or 'running',
+                                    started=0, ip='10.0.0.%d' % (i + 2), snapshots=[], settings={}))
+               for i in range(3))
+    tmpdir.join('state.json').write(json.dumps(dict(vms=vms, interfaces={})))
+    monkeypatch.setenv('BENCH_DIR', str(tmpdir))
+    found = vmmanager_inventory.vbox_vms({}, vboxmanage, 300, 0)
+    assert sorted(entry['config_file'] for entry in found.values()) == \
+        ['/bench/web00/web00.vbox', '/bench/web01/web01.vbox', '/bench/web02/web02.vbox']
+    assert sorted(spawned(tmpdir)) == ['guestproperty enumerate', 'list --long', 'list runningvms', 'list vms']
+
+    # cached entries keep their config files
+    tmpdir.join('calls.log').remove()
+    vmmanager_inventory.vbox_vms(dict((key, dict(entry, fetched_at=-1000)) for (key, entry) in found.items()),
+                                 vboxmanage, 300, 0)
+    assert 'list --long' not in spawned(tmpdir)
+
+
+def entry(hypervisor, name, uuid=None):
+    return dict(hypervisor=hypervisor, name=name, uuid=uuid, state='poweroff', addresses=[], nics=[],
+                config_file=None)
+
+
+def test_vms_sharing_a_name_are_qualified():
+    groups = vmmanager_inventory.inventory({'vbox:1': entry('vbox', 'web01', '1'),
+                                            'vbox:2': entry('vbox', 'web01', '2'),
+                                            'vbox:3': entry('vbox', 'db01', '3'),
+                                            'fusion:/web01.vmx': entry('fusion', 'web01')})
+    assert sorted(groups['vbox']['hosts']) == ['db01', 'web01@vbox-1', 'web01@vbox-2']
+    assert groups['fusion']['hosts'] == ['web01@fusion']
+    assert groups['_meta']['hostvars']['web01@fusion']['vm_name'] == 'web01'
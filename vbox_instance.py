@@ -19,7 +19,26 @@ options:
   target_image:
     description:
       - name for the target VM
-    required: true
+      - required unless I(target_images) is given
+    required: false
+  target_images:
+    description:
+      - list of target VM names to provision concurrently in one call
+      - mutually exclusive with I(target_image)
+    required: false
+  target_pattern:
+    description:
+      - with I(state=absent), tear down every VM whose whole name matches this regular expression, like
+        I(target_images), or with I(state=suspended) suspend every running one; VMs matched by the I(source_image)
+        pattern and standby VMs of the warm pool are left alone
+      - mutually exclusive with I(target_image) and I(target_images)
+    required: false
+  max_parallel:
+    description:
+      - maximum number of VMs handled at the same time when I(target_images) or I(target_pattern) is given; when
+        tearing down more VMs than this, their disks are deleted in the background once they are unregistered
+    required: false
+    default: 4
   memsize:
     description:
       - amount of memory to allocate VM (in MB)
@@ -31,18 +50,167 @@ options:
     required: false
     default: bridged
     choices: ['bridged','nat','hostonly']
+  bridge_adapter:
+    description:
+      - host interface to bridge to, given as its exact name or a regular expression matching exactly one interface
+    required: false
+    default: 'en0.+|eth.+'
+  hostonly_adapter:
+    description:
+      - host-only interface to attach to, given as its exact name or a regular expression matching exactly one
+        interface
+    required: false
+    default: '.+'
+  interface_cache:
+    description:
+      - file caching the host's bridged and host-only interfaces between runs; entries are refreshed when they
+        expire, when the host's network interfaces change or when the selected adapter is missing from them
+    required: false
+    default: '~/.ansible/tmp/vbox_host_interfaces.json'
+  interface_cache_ttl:
+    description:
+      - seconds a cached interface listing stays valid, 0 disables the cache
+    required: false
+    default: 300
+  ip_timeout:
+    description:
+      - seconds to wait for the guest to report an IP address; the wait blocks on guest property changes and
+        falls back to polling with exponential backoff on VBoxManage versions without C(guestproperty wait)
+    required: false
+    default: 60
+  ip_nic:
+    description:
+      - index of the guest NIC whose IPv4 address is returned as the C(ipaddress) fact, as numbered by the guest
+        additions (C(/VirtualBox/GuestInfo/Net/<ip_nic>)); every NIC is returned in the C(nics) fact
+    required: false
+    default: 0
+  backend:
+    description:
+      - how to drive VirtualBox; C(cli) runs VBoxManage for each operation, C(vboxapi) keeps one session open
+        through the VirtualBox Python API (requires the vboxapi package shipped with the VirtualBox SDK)
+    required: false
+    default: 'cli'
+    choices: ['cli','vboxapi']
+  pool_size:
+    description:
+      - with I(state=pooled), the number of cloned and booted standby VMs to keep ready for I(source_image);
+        C(state=running) then claims a ready standby VM for a new target instead of cloning and booting one,
+        and a replacement is built in the background
+    required: false
+    default: 0
+  pool_state:
+    description:
+      - file recording the warm pools and which standby VM each target instance has claimed
+    required: false
+    default: '~/.ansible/tmp/vbox_pool.json'
+  admission:
+    description:
+      - queue clones and boots, across all concurrent runs on this host, until the host has capacity for them
+    required: false
+    default: 'no'
+    choices: ['yes','no']
+  admission_state:
+    description:
+      - file through which concurrent runs share the admission queue, boots in progress and committed guest memory
+    required: false
+    default: '~/.ansible/tmp/vmmanager_admission.json'
+  max_memory_share:
+    description:
+      - with I(admission), the share of host RAM that guest memory committed by this module may use
+    required: false
+    default: 0.8
+  boots_per_cpu:
+    description:
+      - with I(admission), the number of concurrent boots allowed per host CPU (at least one boot is allowed)
+    required: false
+    default: 0.5
+  admission_timeout:
+    description:
+      - with I(admission), seconds to wait in the queue before failing
+    required: false
+    default: 600
+  wait_for_ready:
+    description:
+      - after the IP address is known, wait until the guest accepts TCP connections on I(wait_for_port); with
+        I(target_images) all VMs are probed at once
+    required: false
+    default: 'no'
+    choices: ['yes','no']
+  wait_for_port:
+    description:
+      - port probed by I(wait_for_ready), and after a resume to check that the guest kept its address
+    required: false
+    default: 22
+  ready_timeout:
+    description:
+      - with I(wait_for_ready), seconds to wait for the port before failing
+    required: false
+    default: 300
+  trace_file:
+    description:
+      - file to which every hypervisor command and provisioning phase (inventory, clone, configure, boot, resume,
+        ip_wait, suspend, delete) is appended as a JSON line with its duration; the same records are always
+        returned as C(timings)
+    required: false
+    default: null
+  stop_timeout:
+    description:
+      - seconds to let the guest shut down after pressing its ACPI power button before powering it off; 0 powers
+        it off at once
+    required: false
+    default: 0
+  controller_socket:
+    description:
+      - Unix socket of a vmmanager_controller to hand the task to; the controller keeps the VM inventory, host
+        interfaces and API session warm between tasks. When no controller is listening, the task runs in the
+        module's own process
+    required: false
+    default: '~/.ansible/tmp/vmmanager.sock'
+  suspend_state:
+    description:
+      - state file in which the address of every VM suspended with I(state=suspended) is kept; when the VM is next
+        started, it resumes from its saved state and that address is used as soon as the guest accepts connections
+        on I(wait_for_port) again, rather than waiting for the guest to report an address
+    required: false
+    default: '~/.ansible/tmp/vbox_suspended.json'
   state:
     description:
-      - create or terminate instances
+      - create or terminate instances, maintain a warm pool of standby instances, or save the state of running
+        instances to disk with C(suspended); C(running) resumes a suspended instance, which is reported as C(resumed)
     required: false
     default: 'running'
-    choices: ['running', 'absent']
+    choices: ['running', 'absent', 'pooled', 'suspended']
     '''
 
 EXAMPLES = '''
 # Create a clone image called web01.localdomain from a source image called base-image-centos6
 - vbox_instance: source_image='base-image-centos6' target_image='web01.localdomain'
 
+# Provision a batch of VMs concurrently, four at a time, in a single task
+- vbox_instance:
+    source_image: packer-virtualbox-base-centos7-1424513286
+    target_images: ['web01.localdomain', 'web02.localdomain', 'web03.localdomain']
+    max_parallel: 4
+  register: batch_result
+
+# Keep three booted standby VMs ready, so that later state=running tasks for new targets return in seconds
+- vbox_instance: source_image=packer-virtualbox-base-centos7-1424513286 state=pooled pool_size=3
+
+# Tear down a lab of web VMs, 20 at a time, giving each a minute to shut down cleanly
+- vbox_instance:
+    source_image: packer-virtualbox-base-centos7-1424513286
+    target_pattern: 'web\d+\.localdomain'
+    state: absent
+    max_parallel: 20
+    stop_timeout: 60
+
+# Suspend a lab VM at the end of the day, and resume it with its address the next morning
+- vbox_instance: source_image=packer-virtualbox-base-centos7-1424513286 target_image=web01.localdomain state=suspended
+- vbox_instance: source_image=packer-virtualbox-base-centos7-1424513286 target_image=web01.localdomain state=running
+
+# A VM with a NAT NIC first and a host-only NIC second, reachable on the host-only address
+- vbox_instance: source_image=packer-virtualbox-base-centos7-1424513286 target_image=web01.localdomain ip_nic=1
+
 # Complete playbook to provision a couple of VMs, set their hostname and install httpd...
 - hosts: localhost
   connection: local
@@ -74,8 +242,721 @@ EXAMPLES = '''
 '''
 
 
+class VMFailure(Exception):
+    pass
+
+
+# stands in for the AnsibleModule inside batch workers, so that a failing VM raises instead of exiting the module
+class IsolatedModule():
+    def __init__(self, module):
+        self.module = module
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def fail_json(self, **kwargs):
+        raise VMFailure(kwargs.get('msg', 'Unknown error'))
+
+
+# yields the match of regex in each line that has one
+def matches(regex, output_lines):
+    for output_line in output_lines:
+        match = regex.search(output_line)
+        if match:
+            yield match
+
+
+# runs every operation as a VBoxManage command
+class VBoxManageBackend():
+    # where a command's action follows its first word, e.g. "guestproperty get <vm>" or "controlvm <vm> poweroff"
+    action_positions = dict(list=1, guestproperty=1, snapshot=2, controlvm=2)
+
+    def __init__(self, module, vboxmanage, timings=None):
+        self.module = module
+        self.vboxmanage = vboxmanage
+        self.timings = timings or Timings('vbox_instance')
+        self.vm_regex = re.compile('^"(.*)" \{([0-9a-fA-F-]+)\}$')
+        self.snapshot_regex = re.compile('Name: (.*) \(UUID: (.*)\)')
+        self.interface_regex = re.compile('^Name:\s+(.+)$')
+        self.info_regex = re.compile('^"?([^"=]+)"?="?(.*?)"?$')
+        # the lines of 'list --long vms' that are not indented or part of a section, one of each per VM
+        self.long_regex = re.compile('^(UUID|Config file):\s+(.+)$')
+        # "<controller>-<port>-<device>", whose value is the path of the attached image
+        self.attachment_regex = re.compile('^.+-\d+-\d+$')
+        # the formats of hard disk images, as opposed to DVD and floppy images
+        self.disk_regex = re.compile('\.(vdi|vmdk|vhd|vhdx|hdd|qed|qcow2?)$', re.IGNORECASE)
+        # "Name: <name>, value: <value>, ..." before VirtualBox 7, "<name> = '<value>' @ ..." since
+        self.enumerate_regex = re.compile('^\s*(?:Name: )?(/[^,=\s]+)(?:, value: ([^,]*),|\s*=\s*\'(.*?)\'(?: @|$))')
+
+    # the same backend for another task of a vmmanager_controller, failing through its module and timed on its own
+    def timed(self, module, timings):
+        backend = copy.copy(self)
+        backend.module = module
+        backend.timings = timings
+        return backend
+
+    # args are passed to VBoxManage as they are, so names and values need no quoting
+    def stream(self, args):
+        kind = args[0]
+        if len(args) > self.action_positions.get(kind, len(args)):
+            kind += ' ' + args[self.action_positions[kind]]
+        return CommandStream(kind, [self.vboxmanage] + args, self.timings)
+
+    # yields the command's output lines as they are produced, and fails once they are exhausted if it did not succeed
+    def lines(self, args, error_msg):
+        with self.stream(args) as output:
+            for output_line in output:
+                yield output_line
+        if output.returncode != 0:
+            self.module.fail_json(msg=error_msg)
+
+    def run(self, args, error_msg):
+        return list(self.lines(args, error_msg))
+
+    def list_vms(self, kind='vms'):
+        return dict(match.groups() for match in
+                    matches(self.vm_regex, self.lines(['list', kind], 'Error trying to get VM list')))
+
+    def list_running(self):
+        return set(self.list_vms('runningvms').values())
+
+    # the settings file of every registered VM by UUID, from one listing; each VM's UUID comes before its file
+    def config_files(self):
+        config_files = {}
+        uuid = None
+        for match in matches(self.long_regex, self.lines(['list', '--long', 'vms'], 'Error trying to get VM list')):
+            if match.group(1) == 'UUID':
+                uuid = match.group(2)
+            elif uuid:
+                config_files[uuid] = match.group(2)
+                uuid = None
+        return config_files
+
+    def snapshot_names(self, ref):
+        with self.stream(['snapshot', ref, 'list']) as output:
+            return [match.group(1) for match in matches(self.snapshot_regex, output)]
+
+    def take_snapshot(self, ref, name):
+        self.run(['snapshot', ref, 'take', name], 'Error taking snapshot')
+
+    def clone(self, source_ref, snapshot, name, uuid):
+        self.run(['clonevm', source_ref, '--options', 'link', '--name', name, '--uuid', uuid,
+                  '--snapshot', snapshot, '--register'], 'Failed to clone VM')
+
+    # settings are (option, value) pairs in modifyvm's own terms, e.g. ('--memory', '512')
+    def modify(self, ref, settings):
+        args = ['modifyvm', ref]
+        for (option, value) in settings:
+            args.extend([option, value])
+        self.run(args, 'Error: failed to modify VM settings')
+
+    def vm_info(self, ref):
+        return dict(match.groups() for match in
+                    matches(self.info_regex, self.lines(['showvminfo', ref, '--machinereadable'],
+                                                        'Error: failed to read VM configuration')))
+
+    def set_extradata(self, ref, key, value):
+        self.run(['setextradata', ref, key, value], 'Error: failed to set extra data ' + key)
+
+    def start(self, ref, vm_type):
+        self.run(['startvm', ref, '--type', vm_type], 'Error trying to start VM')
+
+    def shutdown(self, ref):
+        self.run(['controlvm', ref, 'acpipowerbutton'], 'Failed to shut down VM')
+
+    def poweroff(self, ref):
+        self.run(['controlvm', ref, 'poweroff'], 'Failed to power-off VM')
+
+    def save_state(self, ref):
+        self.run(['controlvm', ref, 'savestate'], 'Failed to save VM state')
+
+    def delete(self, ref):
+        self.run(['unregistervm', ref, '--delete'], 'Failed to delete VM')
+
+    # unregisters the VM but leaves its files to delete_media; its disks are the hard disk images attached to it
+    # wherever they are, which for a linked clone are its differencing images, as 'unregistervm --delete' deletes
+    # them and leaves DVD and floppy images alone. A saved VM's state file is only queued for deletion by a plain
+    # unregistervm, so it is deleted along with the disks.
+    def unregister(self, ref):
+        info = self.vm_info(ref)
+        disks = [value for (key, value) in info.items() if self.attachment_regex.match(key) and
+                 self.disk_regex.search(value)]
+        state_file = info.get('VMState') == 'saved' and info.get('VMStateFile') or None
+        self.run(['unregistervm', ref], 'Failed to delete VM')
+        return dict(config_file=info['CfgFile'], disks=disks, state_file=state_file)
+
+    def delete_media(self, media):
+        for disk in media['disks']:
+            self.run(['closemedium', 'disk', disk, '--delete'], 'Failed to delete disk ' + disk)
+        if media.get('state_file') and os.path.isfile(media['state_file']):
+            os.remove(media['state_file'])
+        remove_machine_files(media['config_file'])
+
+    # starts waiting for the property to change, without blocking
+    def watch_guestproperty(self, ref, name, timeout):
+        return GuestPropertyWait(self.stream(['guestproperty', 'wait', ref, name, '--timeout',
+                                              str(max(int(timeout * 1000), 1)), '--fail-on-timeout']), timeout)
+
+    # the guest properties matching pattern in one call; the set is small, and patterns are passed differently
+    # since VirtualBox 7, so every property is listed and the pattern applied here
+    def guest_properties(self, ref, pattern='*'):
+        properties = {}
+        for match in matches(self.enumerate_regex, self.lines(['guestproperty', 'enumerate', ref],
+                                                             'Error: failed to enumerate guest properties')):
+            if fnmatch.fnmatchcase(match.group(1), pattern):
+                properties[match.group(1)] = match.group(2) if match.group(2) is not None else match.group(3)
+        return properties
+
+    def host_interfaces(self, kind):
+        return [match.group(1) for match in
+                matches(self.interface_regex, self.lines(['list', kind + 'ifs'],
+                                                         'Error: failed to find ' + kind + ' interfaces'))]
+
+
+# a 'guestproperty wait' started by watch_guestproperty; closing it before it has finished abandons it
+class GuestPropertyWait():
+    def __init__(self, output, timeout):
+        self.output = output
+        self.timeout = timeout
+        self.usage_regex = re.compile('^(Usage|Syntax error)|Unknown option')
+
+    # blocks until the property changes or the wait times out, and returns whether this VBoxManage can wait on
+    # properties. --fail-on-timeout exits with 2 once the timeout has passed, but 2 is also the exit status of a
+    # syntax error, which is what a VBoxManage without --fail-on-timeout reports at once, along with its usage
+    def finish(self):
+        usage = list(matches(self.usage_regex, self.output))
+        self.output.close()
+        if self.output.returncode == 0:
+            return True
+        return self.output.returncode == 2 and not usage and time() - self.output.start >= self.timeout * 0.9
+
+    def close(self):
+        self.output.close()
+
+
+# keeps one VirtualBox API session open for the whole invocation instead of starting VBoxManage per operation
+class VBoxApiBackend():
+    def __init__(self, module, timings=None):
+        if not HAS_VBOXAPI:
+            module.fail_json(msg='The vboxapi backend requires the VirtualBox Python API (vboxapi) to be installed')
+        self.module = module
+        self.timings = timings or Timings('vbox_instance')
+        # COM and XPCOM tie API objects to the thread that made them, so the API is used from one thread of the
+        # backend's own, which batch workers, deferred deletes and controller tasks hand their calls to in turn
+        self.requests = Queue()
+        connected = Queue()
+        thread = threading.Thread(target=self.serve, args=(connected,))
+        thread.daemon = True
+        thread.start()
+        error = connected.get()
+        if error is not None:
+            module.fail_json(msg='Error: failed to connect to VirtualBox: ' + error)
+
+    def serve(self, connected):
+        try:
+            self.manager = VirtualBoxManager(None, None)
+            self.constants = self.manager.constants
+            self.vbox = self.manager.getVirtualBox()
+            self.session = self.manager.getSessionObject(self.vbox)
+        except Exception as e:
+            connected.put(str(e))
+            return
+        connected.put(None)
+        while True:
+            function, args, reply = self.requests.get()
+            start = time()
+            try:
+                reply.put((start, True, function(*args)))
+            except Exception as e:
+                reply.put((start, False, e))
+
+    # the same API session for another task of a vmmanager_controller, failing through its module and timed on its
+    # own; the tasks take turns on the session like batch workers
+    def timed(self, module, timings):
+        backend = copy.copy(self)
+        backend.module = module
+        backend.timings = timings
+        return backend
+
+    # every operation goes through call, which runs it on the API thread and times it as kind, the name of the
+    # backend method that made it; constants are only looked up there too
+    def call(self, kind, error_msg, function, *args):
+        reply = Queue()
+        self.requests.put((function, args, reply))
+        start, succeeded, result = reply.get()
+        self.timings.command(kind, start, succeeded and 0 or 1, None)
+        if not succeeded:
+            self.module.fail_json(msg=error_msg + ': ' + str(result))
+        return result
+
+    def machines(self):
+        return self.manager.getArray(self.vbox, 'machines')
+
+    def wait(self, progress):
+        progress.waitForCompletion(-1)
+        if progress.resultCode != 0:
+            raise Exception(progress.errorInfo.text)
+
+    def locked(self, ref, lock_type, function):
+        self.vbox.findMachine(ref).lockMachine(self.session, getattr(self.constants, 'LockType_' + lock_type))
+        try:
+            return function(self.session)
+        finally:
+            self.session.unlockMachine()
+
+    def list_vms(self):
+        return self.call('list_vms', 'Error trying to get VM list',
+                         lambda: dict((m.name, m.id) for m in self.machines()))
+
+    def list_running(self):
+        def list_running():
+            online = (self.constants.MachineState_FirstOnline, self.constants.MachineState_LastOnline)
+            return set(m.id for m in self.machines() if online[0] <= m.state <= online[1])
+        return self.call('list_running', 'Error determining if target instance is running', list_running)
+
+    def snapshot_names(self, ref):
+        def walk(snapshot):
+            names = [snapshot.name]
+            for child in self.manager.getArray(snapshot, 'children'):
+                names.extend(walk(child))
+            return names
+
+        def names():
+            machine = self.vbox.findMachine(ref)
+            return walk(machine.findSnapshot('')) if machine.snapshotCount else []
+        return self.call('snapshot_names', 'Error listing snapshots', names)
+
+    def take_snapshot(self, ref, name):
+        def take(session):
+            progress = session.machine.takeSnapshot(name, '', True)
+            # VirtualBox 5.2+ returns the new snapshot id alongside the progress
+            self.wait(progress[0] if isinstance(progress, (list, tuple)) else progress)
+        self.call('take_snapshot', 'Error taking snapshot', self.locked, ref, 'Shared', take)
+
+    def clone(self, source_ref, snapshot, name, uuid):
+        def clone():
+            source = self.vbox.findMachine(source_ref)
+            target = self.vbox.createMachine('', name, [], source.OSTypeId, 'UUID=' + uuid)
+            self.wait(source.findSnapshot(snapshot).machine.cloneTo(target, self.constants.CloneMode_MachineState,
+                                                                    [self.constants.CloneOptions_Link]))
+            self.vbox.registerMachine(target)
+        self.call('clone', 'Failed to clone VM', clone)
+
+    def modify(self, ref, settings):
+        def modify(session):
+            attachment_types = dict(bridged=self.constants.NetworkAttachmentType_Bridged,
+                                    nat=self.constants.NetworkAttachmentType_NAT,
+                                    hostonly=self.constants.NetworkAttachmentType_HostOnly)
+            machine = session.machine
+            for (option, value) in settings:
+                match = re.match('^--(nic|bridgeadapter|hostonlyadapter)(\d+)$', option)
+                if option == '--memory':
+                    machine.memorySize = int(value)
+                elif option == '--name':
+                    machine.name = value
+                elif match and match.group(1) == 'nic':
+                    adapter = machine.getNetworkAdapter(int(match.group(2)) - 1)
+                    adapter.enabled = True
+                    adapter.attachmentType = attachment_types[value]
+                elif match and match.group(1) == 'bridgeadapter':
+                    machine.getNetworkAdapter(int(match.group(2)) - 1).bridgedInterface = value
+                elif match and match.group(1) == 'hostonlyadapter':
+                    machine.getNetworkAdapter(int(match.group(2)) - 1).hostOnlyInterface = value
+                else:
+                    raise Exception('unsupported setting ' + option)
+            machine.saveSettings()
+        self.call('modify', 'Error: failed to modify VM settings', self.locked, ref, 'Write', modify)
+
+    # the same keys and values as 'showvminfo --machinereadable', for the settings this module manages
+    def vm_info(self, ref):
+        states = dict(PoweredOff='poweroff', Saved='saved', Running='running', Paused='paused', Aborted='aborted')
+        attachment_types = dict(NAT='nat', Bridged='bridged', HostOnly='hostonly', Internal='intnet', Null='null')
+
+        def vm_info():
+            machine = self.vbox.findMachine(ref)
+            state = [name for (name, value) in self.constants.all_values('MachineState').items()
+                     if value == machine.state][0]
+            info = dict(name=machine.name, UUID=machine.id, memory=str(machine.memorySize),
+                        CfgFile=machine.settingsFilePath, VMState=states.get(state, state.lower()))
+            for slot in range(4):
+                adapter = machine.getNetworkAdapter(slot)
+                attachment_type = [name for (name, value) in
+                                   self.constants.all_values('NetworkAttachmentType').items()
+                                   if value == adapter.attachmentType][0]
+                info['nic' + str(slot + 1)] = attachment_types.get(attachment_type, 'none') \
+                    if adapter.enabled else 'none'
+                info['bridgeadapter' + str(slot + 1)] = adapter.bridgedInterface
+                info['hostonlyadapter' + str(slot + 1)] = adapter.hostOnlyInterface
+            return info
+        return self.call('vm_info', 'Error: failed to read VM configuration', vm_info)
+
+    def set_extradata(self, ref, key, value):
+        self.call('set_extradata', 'Error: failed to set extra data ' + key,
+                  lambda: self.vbox.findMachine(ref).setExtraData(key, value))
+
+    def start(self, ref, vm_type):
+        def start():
+            machine = self.vbox.findMachine(ref)
+            # the environment argument is a list from VirtualBox 6.0 and a string before that
+            try:
+                progress = machine.launchVMProcess(self.session, vm_type, [])
+            except Exception:
+                progress = machine.launchVMProcess(self.session, vm_type, '')
+            try:
+                self.wait(progress)
+            finally:
+                self.session.unlockMachine()
+        self.call('start', 'Error trying to start VM', start)
+
+    def shutdown(self, ref):
+        self.call('shutdown', 'Failed to shut down VM', self.locked, ref, 'Shared',
+                  lambda session: session.console.powerButton())
+
+    def poweroff(self, ref):
+        self.call('poweroff', 'Failed to power-off VM', self.locked, ref, 'Shared',
+                  lambda session: self.wait(session.console.powerDown()))
+
+    def save_state(self, ref):
+        def save_state(session):
+            # the machine saves its state from VirtualBox 6.0, the console before that
+            try:
+                progress = session.machine.saveState()
+            except AttributeError:
+                progress = session.console.saveState()
+            self.wait(progress)
+        self.call('save_state', 'Failed to save VM state', self.locked, ref, 'Shared', save_state)
+
+    def delete(self, ref):
+        self.delete_media(self.unregister(ref))
+
+    # deleteConfig removes the files in the background, so only the wait for it is left to delete_media
+    def unregister(self, ref):
+        def unregister():
+            machine = self.vbox.findMachine(ref)
+            media = machine.unregister(self.constants.CleanupMode_DetachAllReturnHardDisksOnly)
+            return machine.deleteConfig(media)
+        return self.call('unregister', 'Failed to delete VM', unregister)
+
+    def delete_media(self, progress):
+        self.call('delete_media', 'Failed to delete VM', self.wait, progress)
+
+    # property reads are in-process and cheap, so callers simply poll
+    def watch_guestproperty(self, ref, name, timeout):
+        return None
+
+    def guest_properties(self, ref, pattern='*'):
+        def guest_properties():
+            names, values, timestamps, flags = self.vbox.findMachine(ref).enumerateGuestProperties(pattern)
+            return dict(zip(names, values))
+        return self.call('guest_properties', 'Error: failed to enumerate guest properties', guest_properties)
+
+    def host_interfaces(self, kind):
+        def host_interfaces():
+            interface_type = dict(bridged=self.constants.HostNetworkInterfaceType_Bridged,
+                                  hostonly=self.constants.HostNetworkInterfaceType_HostOnly)[kind]
+            return [i.name for i in self.manager.getArray(self.vbox.host, 'networkInterfaces')
+                    if i.interfaceType == interface_type]
+        return self.call('host_interfaces', 'Error: failed to find ' + kind + ' interfaces', host_interfaces)
+
+
+# in-memory stand-in for VirtualBox, so that VBox can be exercised without a hypervisor
+class FakeBackend():
+    def __init__(self, module, vms=None, bridged_interfaces=None, hostonly_interfaces=None, timings=None):
+        self.module = module
+        self.timings = timings or Timings('vbox_instance')
+        self.lock = threading.RLock()
+        self.vms = {}
+        self.interfaces = dict(bridged=bridged_interfaces or ['en0: Wi-Fi (AirPort)'],
+                               hostonly=hostonly_interfaces or ['vboxnet0'])
+        self.calls = []
+        self.started = 0
+        for name in vms or []:
+            self.vms[name] = dict(uuid=str(uuid4()), running=False, snapshots=[], settings={}, properties={})
+
+    def machine(self, operation, ref):
+        self.calls.append((operation, ref))
+        for name, vm in self.vms.items():
+            if ref in (name, vm['uuid']):
+                return vm
+        self.module.fail_json(msg='Could not find a registered machine named ' + ref)
+
+    def list_vms(self):
+        with self.lock:
+            return dict((name, vm['uuid']) for name, vm in self.vms.items())
+
+    def list_running(self):
+        with self.lock:
+            return set(vm['uuid'] for vm in self.vms.values() if vm['running'])
+
+    def snapshot_names(self, ref):
+        with self.lock:
+            return list(self.machine('snapshot_names', ref)['snapshots'])
+
+    def take_snapshot(self, ref, name):
+        with self.lock:
+            self.machine('take_snapshot', ref)['snapshots'].append(name)
+
+    def clone(self, source_ref, snapshot, name, uuid):
+        with self.lock:
+            if snapshot not in self.machine('clone', source_ref)['snapshots']:
+                self.module.fail_json(msg='Failed to clone VM')
+            self.vms[name] = dict(uuid=uuid, running=False, snapshots=[], settings={}, properties={})
+
+    def modify(self, ref, settings):
+        with self.lock:
+            vm = self.machine('modify', ref)
+            if vm['running']:
+                self.module.fail_json(msg='Error: failed to modify VM settings')
+            for (option, value) in settings:
+                if option == '--name':
+                    for name in list(self.vms):
+                        if self.vms[name] is vm:
+                            self.vms[value] = self.vms.pop(name)
+                else:
+                    vm['settings'][option] = value
+
+    def set_extradata(self, ref, key, value):
+        with self.lock:
+            self.machine('set_extradata', ref).setdefault('extradata', {})[key] = value
+
+    def vm_info(self, ref):
+        with self.lock:
+            vm = self.machine('vm_info', ref)
+            name = [name for name in self.vms if self.vms[name] is vm][0]
+            info = dict(name=name, UUID=vm['uuid'], memory='512', nic1='nat', CfgFile='/fake/' + vm['uuid'] + '.vbox',
+                        VMState='running' if vm['running'] else vm.get('saved') and 'saved' or 'poweroff')
+            info.update((option.lstrip('-'), value) for (option, value) in vm['settings'].items())
+            return info
+
+    def start(self, ref, vm_type):
+        with self.lock:
+            vm = self.machine('start', ref)
+            vm['running'] = True
+            # a resumed guest keeps its address
+            if vm.pop('saved', False):
+                return
+            self.started += 1
+            vm['properties'].update({'/VirtualBox/GuestInfo/Net/0/V4/IP': '10.0.0.' + str(self.started % 250 + 2),
+                                     '/VirtualBox/GuestInfo/Net/0/MAC': '080027%06X' % self.started,
+                                     '/VirtualBox/GuestInfo/Net/0/Status': 'Up',
+                                     '/VirtualBox/GuestInfo/Net/Count': '1'})
+
+    # the fake guest honours the power button at once
+    def shutdown(self, ref):
+        with self.lock:
+            vm = self.machine('shutdown', ref)
+            vm['running'] = False
+            vm['properties'] = {}
+
+    def poweroff(self, ref):
+        with self.lock:
+            vm = self.machine('poweroff', ref)
+            vm['running'] = False
+            vm['properties'] = {}
+
+    def save_state(self, ref):
+        with self.lock:
+            vm = self.machine('save_state', ref)
+            vm['running'] = False
+            vm['saved'] = True
+
+    def delete(self, ref):
+        self.delete_media(self.unregister(ref))
+
+    def unregister(self, ref):
+        with self.lock:
+            vm = self.machine('unregister', ref)
+            for name in list(self.vms):
+                if self.vms[name] is vm:
+                    del self.vms[name]
+            return vm['uuid']
+
+    def delete_media(self, media):
+        with self.lock:
+            self.calls.append(('delete_media', media))
+
+    def watch_guestproperty(self, ref, name, timeout):
+        return None
+
+    def guest_properties(self, ref, pattern='*'):
+        with self.lock:
+            return dict((name, value) for (name, value) in self.machine('guest_properties', ref)['properties'].items()
+                        if fnmatch.fnmatchcase(name, pattern))
+
+    def host_interfaces(self, kind):
+        return list(self.interfaces[kind])
+
+
+# host network interfaces per kind (bridged/hostonly), shared between invocations through a state file; entries
+# expire after ttl seconds or as soon as the set of host NICs changes
+class InterfaceCache():
+    def __init__(self, backend, path, ttl):
+        self.backend = backend
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.loaded = {}
+
+    @staticmethod
+    def host_fingerprint():
+        if hasattr(socket, 'if_nameindex'):
+            return sorted(name for (index, name) in socket.if_nameindex())
+        if os.path.isdir('/sys/class/net'):
+            return sorted(os.listdir('/sys/class/net'))
+        return None
+
+    def interfaces(self, kind, refresh=False):
+        with self.lock:
+            if kind in self.loaded and not refresh:
+                return self.loaded[kind]
+            if self.ttl <= 0:
+                self.loaded[kind] = self.backend.host_interfaces(kind)
+                return self.loaded[kind]
+            # concurrent invocations queue on the file lock, so only the first one lists the interfaces
+            with StateFile(self.path) as cache:
+                entry = cache.get(kind)
+                fingerprint = self.host_fingerprint()
+                if refresh or not entry or time() - entry['time'] > self.ttl or entry['fingerprint'] != fingerprint:
+                    entry = dict(time=time(), fingerprint=fingerprint,
+                                 interfaces=self.backend.host_interfaces(kind))
+                    cache[kind] = entry
+            self.loaded[kind] = entry['interfaces']
+            return self.loaded[kind]
+
+    # the same cache for another task of a vmmanager_controller, listing through that task's backend
+    def timed(self, backend):
+        interfaces = copy.copy(self)
+        interfaces.backend = backend
+        return interfaces
+
+
+# a VM's current configuration as read by a single vm_info call, compared against desired modifyvm settings
+class MachineConfig():
+    def __init__(self, info):
+        self.info = info
+
+    @property
+    def state(self):
+        return self.info.get('VMState')
+
+    @property
+    def config_file(self):
+        return self.info.get('CfgFile')
+
+    def value(self, option):
+        return self.info.get(option.lstrip('-'))
+
+    def differences(self, settings):
+        return [(option, value) for (option, value) in settings if self.value(option) != value]
+
+
+# the guest's NICs in index order, each with the IPv4 and IPv6 address, MAC address and link status that the guest
+# additions report under /VirtualBox/GuestInfo/Net/<index>
+def nic_facts(properties):
+    nics = {}
+    for name, value in properties.items():
+        match = re.match('^/VirtualBox/GuestInfo/Net/(\d+)/(V4/IP|V6/IP|MAC|Status)$', name)
+        if match:
+            nic = nics.setdefault(int(match.group(1)), dict(index=int(match.group(1)), ipv4=None, ipv6=None,
+                                                             mac=None, status=None))
+            if match.group(2) == 'MAC' and len(value) == 12:
+                nic['mac'] = ':'.join(value[i:i + 2] for i in range(0, 12, 2)).lower()
+            elif match.group(2) == 'Status':
+                nic['status'] = value.lower()
+            else:
+                nic[match.group(2) == 'V4/IP' and 'ipv4' or 'ipv6'] = value or None
+    return [nics[index] for index in sorted(nics)]
+
+
+# names, UUIDs and running state of the registered VMs, listed once and kept current by the module's own changes
+class VMInventory():
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.RLock()
+        self.patterns = {}
+        # the listings, kept in a dict that the copies made by timed share
+        self.listings = dict(uuids=None, running=None, running_at=0)
+
+    # the same inventory for another task of a vmmanager_controller, listing through that task's backend so that the
+    # listings are timed in its result
+    def timed(self, backend):
+        inventory = copy.copy(self)
+        inventory.backend = backend
+        return inventory
+
+    @property
+    def vms(self):
+        with self.lock:
+            if self.listings['uuids'] is None:
+                with self.backend.timings.phase('inventory'):
+                    self.listings['uuids'] = self.backend.list_vms()
+            return self.listings['uuids']
+
+    @property
+    def running_uuids(self):
+        with self.lock:
+            if self.listings['running'] is None:
+                self.refresh_running(0)
+            return self.listings['running']
+
+    # lists the running VMs again unless that was done less than max_age seconds ago, so that workers waiting for
+    # their VMs to shut down share one listing
+    def refresh_running(self, max_age):
+        with self.lock:
+            if self.listings['running'] is None or time() - self.listings['running_at'] >= max_age:
+                with self.backend.timings.phase('inventory'):
+                    self.listings['running'] = self.backend.list_running()
+                self.listings['running_at'] = time()
+
+    def names(self):
+        with self.lock:
+            return list(self.vms.keys())
+
+    def uuid(self, name):
+        with self.lock:
+            return self.vms.get(name)
+
+    def is_running(self, name):
+        with self.lock:
+            uuid = self.uuid(name)
+            return uuid is not None and uuid in self.running_uuids
+
+    def match(self, pattern):
+        with self.lock:
+            if pattern not in self.patterns:
+                self.patterns[pattern] = re.compile('.*' + pattern + '.*')
+            regex = self.patterns[pattern]
+            return [name for name in self.vms if regex.match(name)]
+
+    def add(self, name, uuid):
+        with self.lock:
+            self.vms[name] = uuid
+
+    def remove(self, name):
+        with self.lock:
+            uuid = self.vms.pop(name, None)
+            if self.listings['running'] is not None:
+                self.listings['running'].discard(uuid)
+
+    def rename(self, name, new_name):
+        with self.lock:
+            self.vms[new_name] = self.vms.pop(name)
+
+    def set_running(self, name, running):
+        with self.lock:
+            if running:
+                self.running_uuids.add(self.uuid(name))
+            else:
+                self.running_uuids.discard(self.uuid(name))
+
+
 class VBox():
-    def __init__(self, module, vboxmanage, source_image, target_image, memsize, network_type, state):
+    net_properties = '/VirtualBox/GuestInfo/Net/*'
+    resume_probe_timeout = 10
+
+    def __init__(self, module, vboxmanage, source_image, target_image, memsize, network_type, state, inventory=None,
+                 ip_timeout=60, backend=None, interfaces=None, bridge_adapter='en0.+|eth.+', hostonly_adapter='.+',
+                 pool=None, scheduler=None, ip_nic=0, stop_timeout=0, suspended=None, probe_port=22):
         self.module = module
         self.vboxmanage = vboxmanage
         self.source_image = source_image
@@ -83,201 +964,559 @@ class VBox():
         self.memsize = memsize
         self.network_type = network_type
         self.state = state
+        self.backend = backend or VBoxManageBackend(module, vboxmanage)
+        self.inventory = inventory or VMInventory(self.backend)
+        self.interfaces = interfaces or InterfaceCache(self.backend, '', 0)
+        self.adapters = dict(bridged=bridge_adapter, hostonly=hostonly_adapter)
+        self.pool = pool
+        self.claimed_standby = False
+        self.scheduler = scheduler
+        self.admission_ticket = None
+        self.ip_timeout = ip_timeout
+        self.ip_nic = ip_nic
+        self.stop_timeout = stop_timeout
+        self.ip_discovery_time = None
+        self.nics = []
+        self.suspended = suspended
+        self.probe_port = probe_port
+        self.resumed = False
 
-    @staticmethod
-    def escape_spaces(s):
-        return s.replace(' ', '\ ')
+    # a target claimed from the warm pool runs under its standby name until it is next stopped and reconciled
+    @property
+    def vm_name(self):
+        return self.pool and self.pool.claimed(self.target_image) or self.target_image
 
-    @staticmethod
-    def exec_command(command):
-        p = subprocess.Popen(command, shell=True, executable='/bin/bash',
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        p.wait()
-        return p
+    # VBoxManage resolves a UUID directly, where a name has to be looked up against every registered VM
+    @property
+    def target_ref(self):
+        return self.inventory.uuid(self.vm_name) or self.vm_name
+
+    @property
+    def exists(self):
+        return self.inventory.uuid(self.vm_name) is not None
 
     @property
     def is_running(self):
-        p = self.exec_command(self.vboxmanage + ' list runningvms')
-        if p.returncode != 0:
-            self.module.fail_json(msg='Error determining if target instance is running')
-        for stdoutline in p.stdout.readlines():
-            if re.match('^"' + self.target_image + '"', stdoutline):
-                return True
-        return False
+        return self.inventory.is_running(self.vm_name)
+
+    @property
+    def ip_property(self):
+        return '/VirtualBox/GuestInfo/Net/' + str(self.ip_nic) + '/V4/IP'
+
+    # reads every guest NIC in one call, and returns the IPv4 address of ip_nic once it has one
+    def read_nics(self):
+        self.nics = nic_facts(self.backend.guest_properties(self.target_ref, self.net_properties))
+        for nic in self.nics:
+            if nic['index'] == self.ip_nic and nic['ipv4']:
+                if re.match('^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', nic['ipv4']):
+                    return nic['ipv4']
+                self.module.fail_json(msg='Error: unexpected stdout while trying to determine VM ip address')
+        return None
+
+    # a boot holds its admission until the guest has reported an IP address
+    def admit(self):
+        if self.scheduler:
+            self.admission_ticket = self.scheduler.admit(self.vm_name, self.memsize)
+            if self.admission_ticket is None:
+                self.module.fail_json(msg='Error: timed out waiting for host capacity to boot ' + self.target_image)
+
+    def release_admission(self):
+        if self.admission_ticket:
+            self.scheduler.release(self.admission_ticket)
+            self.admission_ticket = None
 
     @property
     def ipaddress(self):
-        ipregex = re.compile('^Value: (\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\n')
-        maxtries = 60
-        tries = 0
-        command = self.vboxmanage + ' guestproperty get ' + self.target_image + ' /VirtualBox/GuestInfo/Net/0/V4/IP'
-        while tries < maxtries:
-            p = self.exec_command(command)
-            if p.returncode != 0:
-                self.module.fail_json(msg='failed on command' + command)
-            else:
-                ipstdout = p.stdout.read()
-                if ipstdout == 'No value set!\n':
-                    sleep(1)
-                    tries += 1
-                elif ipregex.match(ipstdout):
-                    return ipregex.search(ipstdout).groups()[0]
+        try:
+            with self.backend.timings.phase('ip_wait', self.target_image):
+                start = time()
+                ipaddress = self.resumed_ipaddress() or self.wait_for_ipaddress()
+                self.ip_discovery_time = round(time() - start, 3)
+                return ipaddress
+        finally:
+            self.release_admission()
+
+    # a resumed guest keeps the address it was suspended with unless its lease has lapsed meanwhile, which is told by
+    # connecting to it rather than by waiting for the guest to report its address again
+    def resumed_ipaddress(self):
+        ipaddress = self.resumed and self.suspended and self.suspended.pop(self.target_ref)
+        if not ipaddress:
+            return None
+        if wait_for_ports([ipaddress], self.probe_port, self.resume_probe_timeout)[ipaddress] is None:
+            return None
+        self.read_nics()
+        return ipaddress
+
+    # blocks on changes of the address property where the backend can wait on them, and otherwise polls with
+    # exponential backoff; the NICs are read again after every change, as the other NICs' facts are not part of it
+    def wait_for_ipaddress(self):
+        deadline = time() + self.ip_timeout
+        wait_supported = True
+        delay = 0.25
+        while True:
+            # the wait is started before the NICs are read, so that an address reported in between ends it at once
+            wait = None
+            if wait_supported and time() < deadline:
+                wait = self.backend.watch_guestproperty(self.target_ref, self.ip_property, min(deadline - time(), 10))
+            try:
+                ipaddress = self.read_nics()
+                if ipaddress is not None or time() >= deadline:
+                    break
+                if wait is None:
+                    sleep(min(delay, max(deadline - time(), 0)))
+                    delay = min(delay * 2, 4)
                 else:
-                    self.module.fail_json(msg='Error: unexpected stdout while trying to determine VM ip address')
-        self.module.fail_json(msg='Timeout exceeded while trying to get VM ip address')
+                    wait_supported = wait.finish()
+            finally:
+                if wait is not None:
+                    wait.close()
+        if ipaddress is None:
+            self.module.fail_json(msg='Timeout exceeded while trying to get VM ip address')
+        return ipaddress
 
     def get_vms(self):
-        p = self.exec_command(self.vboxmanage + ' list vms')
-        if p.returncode != 0:
-            self.module.fail_json(msg='Error trying to get VM list')
-        vmlist = []
-        for stdoutline in p.stdout.readlines():
-            vmlist.append(re.search('"(.*)"', stdoutline).groups()[0])
-        return vmlist
-
-    def get_snapshots(self, source_image):
-        p = self.exec_command(self.vboxmanage + ' snapshot ' + source_image + ' list')
-        snapshotlist = []
-        for stdoutline in p.stdout.readlines():
-            if stdoutline != 'This machine does not have any snapshots\n':
-                (snapshot_name, snapshot_uuid) = re.search('Name: (.*) \(UUID: (.*)\)', stdoutline).groups()
-                snapshotlist.append({snapshot_name: snapshot_uuid})
-        return snapshotlist
+        return self.inventory.names()
 
     # take a snapshot called "ansible-snapshot" if none exists - this is used for linked cloning
-    def snapshot(self, source_image):
-        if 'ansible-snapshot' not in [item.keys()[0] for item in self.get_snapshots(source_image)]:
-            p = self.exec_command(self.vboxmanage + ' snapshot ' + source_image + ' take ansible-snapshot')
-            if p.returncode != 0:
-                self.module.fail_json(msg='Error taking snapshot')
+    def snapshot(self, source_ref):
+        if 'ansible-snapshot' not in self.backend.snapshot_names(source_ref):
+            self.backend.take_snapshot(source_ref, 'ansible-snapshot')
 
     def clone_vm(self):
-        source_image = ''
-        source_candidate_list = []
-        for source_candidate in self.get_vms():
-            if re.match('.*' + self.source_image + '.*', source_candidate):
-                source_candidate_list.append(source_candidate)
+        with self.backend.timings.phase('clone', self.target_image):
+            self._clone_vm()
+
+    def _clone_vm(self):
+        source_candidate_list = self.inventory.match(self.source_image)
         if len(source_candidate_list) > 1:
             self.module.fail_json(msg='Error: found more than one candidate for source image pattern: ".*'
                                       + self.source_image + '.*"')
         elif len(source_candidate_list) == 0:
             self.module.fail_json(msg='Error: cannot find a single candidate for source image pattern: ".*'
                                       + self.source_image + '.*"')
-        else:
-            source_image = source_candidate_list[0]
-        self.snapshot(source_image)
-        p = self.exec_command(self.vboxmanage + ' clonevm ' + source_image +
-                              ' --options link --name ' + self.target_image +
-                              '  --snapshot ansible-snapshot --register')
-        if p.returncode != 0:
-            self.module.fail_json(msg='Failed to clone VM')
-
-    def set_network_type(self):
-        p = self.exec_command(self.vboxmanage + ' modifyvm ' + self.target_image + ' --nic1 ' + self.network_type)
-        if p.returncode != 0:
-            self.module.fail_json(msg='Error setting network type')
-        # TODO: implement parameterisation of hostonly interface
-        if self.network_type == 'hostonly':
-            hostonly_interface_regex = re.compile('^Name:\s+(.+)$')
-            hostonly_interface_list = []
-            p = self.exec_command(self.vboxmanage + ' list hostonlyifs')
-            if p.returncode != 0:
-                self.module.fail_json(msg='Error: failed to find hostonly interfaces')
-            for stdoutline in p.stdout.readlines():
-                if hostonly_interface_regex.match(stdoutline):
-                    hostonly_interface_list.append(hostonly_interface_regex.search(stdoutline).groups()[0])
-            if len(hostonly_interface_list) != 1:
-                self.module.fail_json(msg='Error: failed to find exactly 1 matching bridged interface')
-
-            p = self.exec_command(self.vboxmanage + ' modifyvm ' + self.target_image +
-                                  ' --hostonlyadapter1 "' + hostonly_interface_list[0] + '"')
-            if p.returncode != 0:
-                self.module.fail_json(msg='Error setting hostonly adapter')
-        # TODO: implement parameterisation of bridged interface (to override non-mac "en0" convention)
-        elif self.network_type == 'bridged':
-            bridged_interface_regex = re.compile('^Name:\s+(en0.+|eth.+)$')
-            bridged_interface_list = []
-            p = self.exec_command(self.vboxmanage + ' list bridgedifs')
-            if p.returncode != 0:
-                self.module.fail_json(msg='Error: failed to find bridged interfaces')
-            for stdoutline in p.stdout.readlines():
-                if bridged_interface_regex.match(stdoutline):
-                    bridged_interface_list.append(bridged_interface_regex.search(stdoutline).groups()[0])
-            if len(bridged_interface_list) != 1:
-                self.module.fail_json(msg='Error: failed to find exactly 1 matching bridged interface')
-            p = self.exec_command(self.vboxmanage + ' modifyvm ' + self.target_image +
-                                  ' --bridgeadapter1 "' + bridged_interface_list[0] + '"')
-
-            if p.returncode != 0:
-                self.module.fail_json(msg='Error setting bridged adapter')
-
-    def set_memsize(self):
-        p = self.exec_command(self.vboxmanage + ' modifyvm ' + self.target_image + ' --memory ' + self.memsize)
-        if p.returncode != 0:
-            self.module.fail_json(msg='Error: failed to set memory size')
+        source_ref = self.inventory.uuid(source_candidate_list[0])
+        # choose the clone's UUID up front so the inventory can be updated without listing the VMs again
+        target_uuid = str(uuid4())
+        with source_lock(source_ref):
+            self.snapshot(source_ref)
+            self.backend.clone(source_ref, 'ansible-snapshot', self.target_image, target_uuid)
+        self.inventory.add(self.target_image, target_uuid)
+
+    # an adapter is selected by its exact name, or else by a regular expression matching the whole name
+    def interface_matches(self, kind, interface):
+        selector = self.adapters[kind]
+        return interface == selector or re.match('^(' + selector + ')$', interface) is not None
+
+    def host_interface(self, kind):
+        for refresh in (False, True):
+            interface_list = self.interfaces.interfaces(kind, refresh=refresh)
+            if self.adapters[kind] in interface_list:
+                return self.adapters[kind]
+            interface_list = [interface for interface in interface_list if self.interface_matches(kind, interface)]
+            # a cached listing that does not yield a match may be out of date, so it is listed again once
+            if len(interface_list) == 1:
+                return interface_list[0]
+        self.module.fail_json(msg='Error: failed to find exactly 1 ' + kind + ' interface matching "' +
+                                  self.adapters[kind] + '"')
+
+    def desired_settings(self, config):
+        settings = [('--name', self.target_image), ('--memory', self.memsize), ('--nic1', self.network_type)]
+        if self.network_type in ('bridged', 'hostonly'):
+            option = dict(bridged='--bridgeadapter1', hostonly='--hostonlyadapter1')[self.network_type]
+            adapter = config.value(option)
+            # an adapter that still satisfies the interface selection is kept, without listing the host's interfaces
+            if config.value('--nic1') != self.network_type or not adapter or \
+                    not self.interface_matches(self.network_type, adapter):
+                adapter = self.host_interface(self.network_type)
+            settings.append((option, adapter))
+        return settings
+
+    # applies every difference between the VM's configuration and the desired settings in one modify call
+    def reconcile(self):
+        with self.backend.timings.phase('configure', self.target_image):
+            return self._reconcile()
+
+    def _reconcile(self):
+        config = MachineConfig(self.backend.vm_info(self.target_ref))
+        self.resumed = config.state == 'saved'
+        # settings of a running or saved VM cannot be changed until it is powered off
+        if config.state in ('running', 'paused', 'saved'):
+            return []
+        changes = config.differences(self.desired_settings(config))
+        if changes:
+            vm_name = self.vm_name
+            self.backend.modify(self.target_ref, changes)
+            # a claimed standby VM takes on its target's name at its first reconcile
+            if vm_name != self.target_image:
+                self.inventory.rename(vm_name, self.target_image)
+                self.pool.release(self.target_image)
+                if self.scheduler:
+                    self.scheduler.rename(vm_name, self.target_image)
+        return changes
+
+    def claim_standby(self):
+        name = self.pool and self.pool.claim(self.target_image, self.inventory.is_running)
+        if not name:
+            return False
+        # a running VM cannot be renamed, so it is labelled with its target until the next reconcile
+        self.backend.set_extradata(self.inventory.uuid(name), 'ansible/target_image', self.target_image)
+        self.claimed_standby = True
+        return True
 
     def start_vm(self):
-        if self.target_image not in self.get_vms():
-            self.clone_vm()
-            self.set_network_type()
-            self.set_memsize()
-        p = self.exec_command(self.vboxmanage + ' startvm ' + self.target_image + ' --type gui')
-        if p.returncode != 0 or self.is_running is False:
-            self.module.fail_json(msg='Error trying to start VM')
+        if not self.exists and self.claim_standby():
+            return
+        self.admit()
+        try:
+            if not self.exists:
+                self.clone_vm()
+            self.reconcile()
+            with self.backend.timings.phase(self.resumed and 'resume' or 'boot', self.target_image):
+                self.backend.start(self.target_ref, 'gui')
+        except BaseException:
+            self.release_admission()
+            # the boot never happened, so its memory is not committed either
+            if self.scheduler:
+                self.scheduler.forget(self.vm_name)
+            raise
+        self.inventory.set_running(self.vm_name, True)
+
+    # presses the guest's ACPI power button and waits up to stop_timeout for it to power itself off
+    def shutdown(self):
+        self.backend.shutdown(self.target_ref)
+        deadline = time() + self.stop_timeout
+        while time() < deadline:
+            sleep(min(0.5, max(deadline - time(), 0)))
+            self.inventory.refresh_running(0.5)
+            if not self.is_running:
+                return True
+        return False
 
     def stop_vm(self):
         if self.is_running:
-            p = self.exec_command(self.vboxmanage + ' controlvm ' + self.target_image + ' poweroff')
-            if p.returncode != 0:
-                self.module.fail_json(msg='Failed to power-off VM')
+            if not (self.stop_timeout > 0 and self.shutdown()):
+                self.backend.poweroff(self.target_ref)
+            self.inventory.set_running(self.vm_name, False)
 
-    def delete_vm(self):
+    @property
+    def is_saved(self):
+        return MachineConfig(self.backend.vm_info(self.target_ref)).state == 'saved'
+
+    # saves a running guest's state to disk, keeping its address for the resume; returns False for a VM whose state
+    # is saved already
+    def suspend_vm(self):
+        if not self.exists:
+            self.module.fail_json(msg='Error: target instance ' + self.target_image + ' does not exist')
+        if not self.is_running:
+            if not self.is_saved:
+                self.module.fail_json(msg='Error: target instance ' + self.target_image +
+                                          ' is powered off; only a running VM can be suspended')
+            return False
+        with self.backend.timings.phase('suspend', self.target_image):
+            self._suspend_vm()
+        return True
+
+    def _suspend_vm(self):
+        ipaddress = self.read_nics()
+        self.backend.save_state(self.target_ref)
+        self.inventory.set_running(self.vm_name, False)
+        # a saved VM takes no host memory until it is resumed, which is admitted like a boot
+        if self.scheduler:
+            self.scheduler.forget(self.vm_name)
+        if self.suspended and ipaddress:
+            self.suspended.record(self.target_ref, ipaddress)
+
+    # with deferred, the VM is only unregistered here and its disks are deleted by deferred later
+    def delete_vm(self, deferred=None):
+        with self.backend.timings.phase('delete', self.target_image):
+            self._delete_vm(deferred)
+
+    def _delete_vm(self, deferred):
         if self.is_running:
             self.stop_vm()
-        p = self.exec_command(self.vboxmanage + ' unregistervm ' + self.target_image + ' --delete')
-        if p.returncode != 0:
-            self.module.fail_json(msg='Failed to delete VM')
+        vm_name = self.vm_name
+        if deferred is None:
+            self.backend.delete(self.target_ref)
+        else:
+            media = self.backend.unregister(self.target_ref)
+            deferred.add(self.target_image, lambda: self.backend.delete_media(media))
+        self.inventory.remove(vm_name)
+        if self.pool:
+            self.pool.release(self.target_image)
+        if self.scheduler:
+            self.scheduler.forget(vm_name)
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            vboxmanage=dict(default='/usr/bin/VBoxManage'),
-            source_image=dict(required=True),
-            target_image=dict(required=True),
-            memsize=dict(default='512'),
-            network_type=dict(default='bridged'),
-            state=dict(default='running'),
-        )
-    )
+# the VMs committed to the admission scheduler that are no longer registered or no longer running, having been
+# powered off from the guest, the GUI or VBoxManage; fusion_instance commits its VMs by their vmx path, and those
+# are left to it
+def missing_vms(backend, names):
+    names = [name for name in names if not name.endswith('.vmx')]
+    if not names:
+        return []
+    registered = backend.list_vms()
+    running = backend.list_running()
+    return [name for name in names if registered.get(name) not in running]
+
+
+# what 'unregistervm --delete' removes besides the disks and the saved state: the settings file, its backup, the
+# logs and the then empty snapshot and machine folders
+def remove_machine_files(config_file):
+    folder = os.path.dirname(config_file)
+    for path in (config_file, config_file + '-prev'):
+        if os.path.isfile(path):
+            os.remove(path)
+    shutil.rmtree(os.path.join(folder, 'Logs'), ignore_errors=True)
+    for path in (os.path.join(folder, 'Snapshots'), folder):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+
+# what a vmmanager_controller keeps warm between its tasks with the same settings: the backend with its API
+# session, the VM inventory and the host interfaces
+class ControllerSession():
+    def __init__(self, params):
+        self.backend = make_backend(IsolatedModule(None), dict(params, trace_file=None))
+        self.inventory = VMInventory(self.backend)
+        self.interfaces = InterfaceCache(self.backend, params['interface_cache'], params['interface_cache_ttl'])
+        self.created_at = time()
+
+    @staticmethod
+    def key(params):
+        return ('vbox_instance', params['backend'], params['vboxmanage'], params['interface_cache'],
+                params['interface_cache_ttl'])
+
+
+def make_backend(module, params, session=None):
+    timings = Timings('vbox_instance', params['trace_file'])
+    if session:
+        return session.backend.timed(module, timings)
+    if params['backend'] == 'vboxapi':
+        return VBoxApiBackend(module, timings)
+    return VBoxManageBackend(module, params['vboxmanage'], timings)
+
+
+def make_vbox(module, params, target_image, backend, inventory=None, interfaces=None, pool=None):
+    return VBox(module, params['vboxmanage'], params['source_image'], target_image, params['memsize'],
+                params['network_type'], params['state'], inventory=inventory, ip_timeout=params['ip_timeout'],
+                backend=backend,
+                interfaces=interfaces or InterfaceCache(backend, params['interface_cache'],
+                                                        params['interface_cache_ttl']),
+                bridge_adapter=params['bridge_adapter'], hostonly_adapter=params['hostonly_adapter'], pool=pool,
+                scheduler=make_scheduler(params, lambda names: missing_vms(backend, names)), ip_nic=params['ip_nic'],
+                stop_timeout=params['stop_timeout'],
+                suspended=SuspendedVMs(params['suspend_state']), probe_port=params['wait_for_port'])
+
 
-    vboxmanage = module.params["vboxmanage"]
-    source_image = module.params["source_image"]
+def make_pool(params):
+    return WarmPool(params['pool_state'], params['source_image'],
+                    dict(memsize=params['memsize'], network_type=params['network_type']))
+
+
+def make_inventory(backend, session):
+    if session:
+        return session.inventory.timed(backend)
+    return VMInventory(backend)
+
+
+def make_interfaces(params, backend, session):
+    if session:
+        return session.interfaces.timed(backend)
+    return InterfaceCache(backend, params['interface_cache'], params['interface_cache_ttl'])
+
+
+# clones and boots standby VMs until the pool holds size of them, and removes any beyond that
+def fill_pool(module, params, size, session=None):
+    backend = make_backend(IsolatedModule(module), params, session)
+    inventory = make_inventory(backend, session)
+    interfaces = make_interfaces(params, backend, session)
+    pool = make_pool(params)
+    missing, surplus = pool.resize(size, lambda standby: [name for name in standby if inventory.uuid(name)])
+
+    def worker(name):
+        v = make_vbox(IsolatedModule(module), params, name, backend, inventory=inventory, interfaces=interfaces)
+        if name in surplus:
+            v.delete_vm()
+        else:
+            # a standby's boot holds its admission until the guest has an address, as any other boot does, and a
+            # standby whose guest gets none is deleted rather than handed out
+            try:
+                v.start_vm()
+                v.ipaddress
+            except BaseException:
+                pool.abandon(name)
+                if v.exists:
+                    v.delete_vm()
+                raise
+            pool.add_standby(name)
+        return dict(target_image=name, changed=True, failed=False)
+
+    return run_batch(missing + surplus, worker, params['max_parallel']), backend.timings
+
+
+# a vmmanager_controller refills the pool in a thread of its own rather than a detached process
+def refill_pool(module, params, session=None):
+    getattr(module, 'run_detached', run_detached)(lambda: fill_pool(module, params, make_pool(params).size(), session))
+
+
+def run_batch_mode(module, params, session=None):
+    state = params['state']
+    backend = make_backend(IsolatedModule(module), params, session)
+    inventory = make_inventory(backend, session)
+    interfaces = make_interfaces(params, backend, session)
+    pool = make_pool(params)
+    known_at = {}
+    targets = params['target_images'] or pattern_targets(params, inventory, pool)
+    # a deletion only waits for a free worker when there are more targets than workers
+    deferred = None
+    if state == 'absent' and len(targets) > params['max_parallel']:
+        deferred = DeferredDeletes(params['max_parallel'])
+
+    def worker(target_image):
+        v = make_vbox(IsolatedModule(module), params, target_image, backend, inventory=inventory,
+                      interfaces=interfaces, pool=pool)
+        result = dict(target_image=target_image, changed=False, failed=False)
+        if state == 'running':
+            if not v.is_running:
+                v.start_vm()
+                result['changed'] = True
+                result['claimed_standby'] = v.claimed_standby
+                result['resumed'] = v.resumed
+            result['ipaddress'] = v.ipaddress
+            result['nics'] = v.nics
+            result['ip_discovery_time'] = v.ip_discovery_time
+            known_at[result['ipaddress']] = time()
+            result['msg'] = 'target instance: ' + target_image + ' running'
+        elif state == 'absent':
+            if v.exists:
+                v.delete_vm(deferred)
+                result['changed'] = True
+            result['msg'] = 'target instance: ' + target_image + ' deleted'
+        elif state == 'suspended':
+            # of the VMs a pattern matches, only the running ones are suspended
+            if v.is_running or not params['target_pattern']:
+                result['changed'] = v.suspend_vm()
+            result['msg'] = 'target instance: ' + target_image + ' suspended'
+        return result
+
+    results = run_batch(targets, worker, params['max_parallel'])
+    finish_batch(module, params, results, backend.timings, deferred, known_at, 'target instances',
+                 lambda: refill_pool(module, params, session))
+
+
+# runs the task, in the module's process or in a vmmanager_controller, which passes the session it keeps warm
+def run_task(module, session=None):
     target_image = module.params["target_image"]
-    memsize = module.params["memsize"]
-    network_type = module.params["network_type"]
     state = module.params["state"]
 
-    v = VBox(module, vboxmanage, source_image, target_image, memsize, network_type, state)
+    if state == 'pooled':
+        run_pool_mode(module, module.params, make_pool(module.params),
+                      lambda size: fill_pool(module, module.params, size, session))
+    check_targets(module)
+    if module.params["target_images"] or module.params["target_pattern"]:
+        run_batch_mode(module, module.params, session)
+
+    backend = make_backend(module, module.params, session)
+    v = make_vbox(module, module.params, target_image, backend, inventory=make_inventory(backend, session),
+                  interfaces=make_interfaces(module.params, backend, session), pool=make_pool(module.params))
 
     if state == 'running':
         msg = 'target instance: ' + target_image + ' running'
-        if v.is_running:
-            module.exit_json(changed=False, msg=msg, ansible_facts=dict(ipaddress=v.ipaddress))
-        else:
+        changed = not v.is_running
+        if changed:
             v.start_vm()
-            module.exit_json(changed=True, msg=msg, ansible_facts=dict(ipaddress=v.ipaddress))
+        ipaddress = v.ipaddress
+        if v.claimed_standby:
+            refill_pool(module, module.params, session)
+        ready_time = None
+        if module.params['wait_for_ready']:
+            ready_time = ready_times({ipaddress: time()}, module.params, backend.timings)[ipaddress]
+            if ready_time is None:
+                module.fail_json(msg='Timed out waiting for ' + target_image + ' to accept connections on port ' +
+                                     str(module.params['wait_for_port']), timings=backend.timings.summary())
+        module.exit_json(changed=changed, msg=msg, ip_discovery_time=v.ip_discovery_time,
+                         claimed_standby=v.claimed_standby, resumed=v.resumed, ready_time=ready_time,
+                         timings=backend.timings.summary(), ansible_facts=dict(ipaddress=ipaddress, nics=v.nics))
     if state == 'absent':
         msg = 'target instance: ' + target_image + ' deleted'
-        if v.target_image in v.get_vms():
+        if v.exists:
             v.delete_vm()
-            module.exit_json(changed=True, msg=msg)
+            module.exit_json(changed=True, msg=msg, timings=backend.timings.summary())
         else:
-            module.exit_json(changed=False, msg=msg)
+            module.exit_json(changed=False, msg=msg, timings=backend.timings.summary())
+    if state == 'suspended':
+        changed = v.suspend_vm()
+        module.exit_json(changed=changed, msg='target instance: ' + target_image + ' suspended',
+                         timings=backend.timings.summary())
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            vboxmanage=dict(default='/usr/bin/VBoxManage'),
+            source_image=dict(required=True),
+            target_image=dict(required=False),
+            target_images=dict(required=False, type='list'),
+            target_pattern=dict(required=False),
+            max_parallel=dict(default=4, type='int'),
+            memsize=dict(default='512'),
+            network_type=dict(default='bridged'),
+            bridge_adapter=dict(default='en0.+|eth.+'),
+            hostonly_adapter=dict(default='.+'),
+            interface_cache=dict(default='~/.ansible/tmp/vbox_host_interfaces.json'),
+            interface_cache_ttl=dict(default=300, type='int'),
+            ip_timeout=dict(default=60, type='int'),
+            ip_nic=dict(default=0, type='int'),
+            backend=dict(default='cli', choices=['cli', 'vboxapi']),
+            pool_size=dict(default=0, type='int'),
+            pool_state=dict(default='~/.ansible/tmp/vbox_pool.json'),
+            admission=dict(default=False, type='bool'),
+            admission_state=dict(default='~/.ansible/tmp/vmmanager_admission.json'),
+            max_memory_share=dict(default=0.8, type='float'),
+            boots_per_cpu=dict(default=0.5, type='float'),
+            admission_timeout=dict(default=600, type='int'),
+            wait_for_ready=dict(default=False, type='bool'),
+            wait_for_port=dict(default=22, type='int'),
+            ready_timeout=dict(default=300, type='int'),
+            trace_file=dict(required=False),
+            stop_timeout=dict(default=0, type='int'),
+            controller_socket=dict(default='~/.ansible/tmp/vmmanager.sock'),
+            suspend_state=dict(default='~/.ansible/tmp/vbox_suspended.json'),
+            state=dict(default='running', choices=['running', 'absent', 'pooled', 'suspended']),
+        ),
+        mutually_exclusive=[['target_image', 'target_images', 'target_pattern']],
+    )
+
+    run_on_controller(module, 'vbox_instance')
+    run_task(module)
 
 
 from ansible.module_utils.basic import *
-from time import sleep
+try:
+    from ansible.module_utils.vmmanager_common import *
+except ImportError:
+    # run by vmmanager_controller, vmmanager_inventory.py, the benchmark or the tests, with module_utils on sys.path
+    from vmmanager_common import *
+from time import sleep, time
+from uuid import uuid4
+import threading
+import socket
+import fnmatch
+import shutil
+import copy
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+try:
+    from vboxapi import VirtualBoxManager
+    HAS_VBOXAPI = True
+except ImportError:
+    HAS_VBOXAPI = False
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Long-lived controller for vbox_instance and fusion_instance. While it listens on its Unix socket, the modules hand
+# their tasks to it and only relay its result; when it is not running, they run their tasks in their own process as
+# before.
+#
+#   python vmmanager_controller.py --socket ~/.ansible/tmp/vmmanager.sock
+#
+# Tasks run in parallel in the controller, each in a thread of its own. Clones from one source image are serialised
+# between all of them, as its snapshot is shared, while tasks on other sources carry on. Between tasks with the same
+# hypervisor settings the controller keeps warm what the modules would otherwise rebuild on every run: VirtualBox's
+# VM inventory, host interfaces and API session, and Fusion's parsed DHCP leases and vmrest connection. They are
+# rebuilt after --ttl seconds, to pick up VMs changed outside the controller, and as soon as a task has changed VMs
+# through ones that had already been replaced.
+#
+# The controller runs in the foreground, under launchd, systemd or nohup; the socket is only accessible to its user.
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+from time import time
+
+try:
+    from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'module_utils'))
+
+import fusion_instance
+import vbox_instance
+
+modules = dict(vbox_instance=vbox_instance, fusion_instance=fusion_instance)
+
+
+# raised by a task's exit_json and fail_json; like the SystemExit they raise in a module's process, it is not caught
+# by the modules' handlers for failed commands
+class TaskExit(BaseException):
+    def __init__(self, failed, result):
+        BaseException.__init__(self, result.get('msg'))
+        self.failed = failed
+        self.result = result
+
+
+# stands in for the AnsibleModule of a task handed over by a module, whose params it was validated against
+class TaskModule():
+    def __init__(self, params):
+        self.params = params
+
+    def exit_json(self, **kwargs):
+        raise TaskExit(False, kwargs)
+
+    def fail_json(self, **kwargs):
+        raise TaskExit(True, kwargs)
+
+    def run_detached(self, function):
+        thread = threading.Thread(target=function)
+        thread.daemon = True
+        thread.start()
+
+
+class Controller():
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, module, params):
+        key = module.ControllerSession.key(params)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or time() - session.created_at > self.ttl:
+                session = self.sessions[key] = module.ControllerSession(params)
+            return key, session
+
+    # a task that changed VMs through a session that has since been replaced leaves the new one out of date
+    def retire(self, key, session):
+        with self.lock:
+            if self.sessions.get(key) is not session:
+                self.sessions.pop(key, None)
+
+    def run(self, module_name, params):
+        key = session = None
+        try:
+            module = modules[module_name]
+            key, session = self.session(module, params)
+            module.run_task(TaskModule(params), session)
+            failed, result = True, dict(msg='Error: the task ended without a result')
+        except TaskExit as e:
+            failed, result = e.failed, e.result
+        except Exception as e:
+            failed, result = True, dict(msg=str(e), exception=traceback.format_exc())
+        if session and (failed or result.get('changed')):
+            self.retire(key, session)
+        return dict(failed=failed, result=result)
+
+
+class TaskHandler(StreamRequestHandler):
+    def handle(self):
+        request_line = self.rfile.readline().decode('utf-8')
+        # another controller probing whether this one is alive sends nothing
+        if not request_line:
+            return
+        request = json.loads(request_line)
+        reply = self.server.controller.run(request['module'], request['params'])
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class ControllerServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+# a socket left behind by a controller that did not exit cleanly is replaced, one that is still served is not
+def claim_socket(path):
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error:
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    sys.stderr.write('vmmanager_controller: another controller is listening on ' + path + '\n')
+    sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Controller running vbox_instance and fusion_instance tasks')
+    parser.add_argument('--socket', default='~/.ansible/tmp/vmmanager.sock', help='Unix socket to listen on')
+    parser.add_argument('--ttl', type=float, default=60,
+                        help='seconds after which the VM inventory and hypervisor sessions are rebuilt')
+    options = parser.parse_args()
+    path = os.path.expanduser(options.socket)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    claim_socket(path)
+    os.umask(0o077)
+    server = ControllerServer(path, TaskHandler)
+    server.controller = Controller(options.ttl)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
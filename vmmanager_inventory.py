@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# Ansible dynamic inventory of the VirtualBox and VMware Fusion VMs on this host, built on vbox_instance and
+# fusion_instance. Every VM is listed with its running state and IP addresses; running VMs are grouped under
+# "running", and get ansible_host set to their first address.
+#
+#   ansible-playbook -i vmmanager_inventory.py site.yml
+#
+# Discovery costs one listing of all VMs and one of the running ones per hypervisor, plus at most one enumeration per
+# VM whose cached entry is stale; VirtualBox VMs that are new or renamed have their config files read from one more
+# listing of all VMs. Entries are cached in VMMANAGER_INVENTORY_CACHE and reused for up to
+# VMMANAGER_INVENTORY_TTL seconds, unless the VM's state or the mtime of its config file has changed, or it was
+# running without an address yet. --refresh ignores the cache. VMs sharing a name are told apart by their hypervisor
+# (web01@vbox, web01@fusion), and VirtualBox VMs sharing one by their UUID too.
+#
+# The hypervisors are configured through the environment, with the modules' defaults:
+#   VMMANAGER_VBOXMANAGE  path to VBoxManage (/usr/bin/VBoxManage)
+#   VMMANAGER_VMRUN       path to vmrun (/Applications/VMware Fusion.app/Contents/Library/vmrun)
+#   VMMANAGER_VMBASEDIR   Fusion's VM directory (~/Documents/Virtual Machines.localized)
+# a hypervisor whose executable is missing is skipped.
+import argparse
+import json
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'module_utils'))
+
+import fusion_instance
+import vbox_instance
+
+
+def config_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except (OSError, TypeError):
+        return None
+
+
+def is_fresh(entry, name, state, ttl, now):
+    return entry is not None and entry['name'] == name and entry['state'] == state and \
+        now - entry['fetched_at'] < ttl and entry['mtime'] == config_mtime(entry['config_file']) and \
+        (state != 'running' or entry['addresses'])
+
+
+def vbox_vms(cache, vboxmanage, ttl, now):
+    backend = vbox_instance.VBoxManageBackend(vbox_instance.IsolatedModule(None), vboxmanage)
+    inventory = vbox_instance.VMInventory(backend)
+    config_files = None
+    vms = {}
+    for name in inventory.names():
+        uuid = inventory.uuid(name)
+        state = inventory.is_running(name) and 'running' or 'poweroff'
+        entry = cache.get('vbox:' + uuid)
+        if not is_fresh(entry, name, state, ttl, now):
+            # a VM's config file only moves when it is renamed
+            if entry and entry['name'] == name:
+                config_file = entry['config_file']
+            else:
+                if config_files is None:
+                    config_files = backend.config_files()
+                config_file = config_files.get(uuid)
+            nics = []
+            if state == 'running':
+                nics = vbox_instance.nic_facts(backend.guest_properties(uuid, vbox_instance.VBox.net_properties))
+            entry = dict(hypervisor='vbox', name=name, uuid=uuid, state=state, nics=nics,
+                         addresses=[nic['ipv4'] for nic in nics if nic['ipv4']], config_file=config_file,
+                         mtime=config_mtime(config_file), fetched_at=now)
+        vms['vbox:' + uuid] = entry
+    return vms
+
+
+def fusion_vms(cache, vmrunexe, vmbasedir, ttl, now):
+    library = fusion_instance.BundleIndex(vmbasedir, '~/.ansible/tmp/fusion_library.json')
+    lease_index = fusion_instance.LeaseIndex(fusion_instance.DEFAULT_DHCP_LEASES)
+    running = None
+    vms = {}
+    for name, vmx in sorted(library.load().items()):
+        f = fusion_instance.Fusion(name, name, None, 'linked', 'yes', vmrunexe, vmbasedir, lease_index=lease_index,
+                                   library=library)
+        f.target_vmx = vmx
+        if running is None:
+            running = f.running_vmx()
+        state = vmx in running and 'running' or 'poweroff'
+        entry = cache.get('fusion:' + vmx)
+        if not is_fresh(entry, name, state, ttl, now):
+            nics = []
+            addresses = []
+            if state == 'running':
+                nics = f.nic_facts()
+                addresses = [nic['ipv4'] for nic in nics if nic['ipv4']] or [f.vmrun_ipaddress()]
+            entry = dict(hypervisor='fusion', name=name, state=state, nics=nics,
+                         addresses=[address for address in addresses if address], config_file=vmx,
+                         mtime=config_mtime(vmx), fetched_at=now)
+        vms['fusion:' + vmx] = entry
+    return vms
+
+
+def discover(refresh):
+    cache_path = os.environ.get('VMMANAGER_INVENTORY_CACHE', '~/.ansible/tmp/vmmanager_inventory.json')
+    ttl = int(os.environ.get('VMMANAGER_INVENTORY_TTL', 300))
+    vboxmanage = os.environ.get('VMMANAGER_VBOXMANAGE', '/usr/bin/VBoxManage')
+    vmrunexe = os.environ.get('VMMANAGER_VMRUN', '/Applications/VMware Fusion.app/Contents/Library/vmrun')
+    vmbasedir = os.environ.get('VMMANAGER_VMBASEDIR',
+                               os.path.expanduser('~') + '/Documents/Virtual Machines.localized')
+    # the cache stays locked during discovery, so concurrent runs wait for it and then reuse its entries
+    with vbox_instance.StateFile(cache_path) as cache:
+        now = time()
+        previous = dict(cache)
+        if refresh:
+            previous = {}
+        vms = {}
+        # one hypervisor failing leaves the other's VMs in the inventory
+        if os.path.isfile(vboxmanage):
+            try:
+                vms.update(vbox_vms(previous, vboxmanage, ttl, now))
+            except vbox_instance.VMFailure as e:
+                sys.stderr.write('vmmanager_inventory: VirtualBox: ' + str(e) + '\n')
+        if os.path.isfile(vmrunexe) and os.path.isdir(vmbasedir):
+            try:
+                vms.update(fusion_vms(previous, vmrunexe, vmbasedir, ttl, now))
+            except Exception as e:
+                sys.stderr.write('vmmanager_inventory: Fusion: ' + str(e) + '\n')
+        cache.clear()
+        cache.update(vms)
+    return vms
+
+
+# the inventory hostname of each VM by its key: its name, qualified by its hypervisor where VMs share the name, and
+# for VirtualBox VMs that share it among themselves by their UUID too
+def host_names(vms):
+    names = dict((key, entry['name']) for (key, entry) in vms.items())
+    for qualifier in (lambda entry: '@' + entry['hypervisor'], lambda entry: '-' + entry.get('uuid', '')):
+        counts = {}
+        for name in names.values():
+            counts[name] = counts.get(name, 0) + 1
+        for key in names:
+            if counts[names[key]] > 1:
+                names[key] += qualifier(vms[key])
+    return names
+
+
+def host_vars(entry):
+    hostvars = dict(vm_name=entry['name'], vm_hypervisor=entry['hypervisor'], vm_state=entry['state'],
+                    vm_ipaddresses=entry['addresses'], vm_config_file=entry['config_file'])
+    if entry.get('uuid'):
+        hostvars['vm_uuid'] = entry['uuid']
+    if entry.get('nics'):
+        hostvars['vm_nics'] = entry['nics']
+    if entry['addresses']:
+        hostvars['ansible_host'] = entry['addresses'][0]
+    return hostvars
+
+
+def inventory(vms):
+    groups = dict(vbox=dict(hosts=[]), fusion=dict(hosts=[]), running=dict(hosts=[]))
+    hostvars = {}
+    names = host_names(vms)
+    for key in sorted(vms):
+        entry = vms[key]
+        groups[entry['hypervisor']]['hosts'].append(names[key])
+        if entry['state'] == 'running':
+            groups['running']['hosts'].append(names[key])
+        hostvars[names[key]] = host_vars(entry)
+    groups['_meta'] = dict(hostvars=hostvars)
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ansible dynamic inventory of VirtualBox and VMware Fusion VMs')
+    parser.add_argument('--list', action='store_true', help='list all VMs (the default)')
+    parser.add_argument('--host', help='show the variables of one VM')
+    parser.add_argument('--refresh', action='store_true', help='ignore the cache')
+    options = parser.parse_args()
+    result = inventory(discover(options.refresh))
+    if options.host:
+        result = result['_meta']['hostvars'].get(options.host, {})
+    sys.stdout.write(json.dumps(result, indent=2, separators=(',', ': '), sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()